@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the separable grey method to the FFT one, on synthetic raw frames
+translated by known sub-pixel shifts :
+    - the relative RMS deviation of the separable grey images from the FFT
+      ones,
+    - the flow error of the alignment (block matching and ICA) computed on
+      each of them.
+
+The grey images are computed on the CPU, and only the numba kernels of the
+alignment are used, so the script also runs in the CUDA simulator
+(NUMBA_ENABLE_CUDASIM=1) with small sizes.
+
+Run from the root of the repository :
+    python -m benchmarks.grey_method_benchmark
+"""
+import math
+import argparse
+
+import numpy as np
+from numba import cuda
+from scipy.ndimage import gaussian_filter, shift
+
+from handheld_super_resolution.utils_image import compute_grey_images
+from handheld_super_resolution.block_matching import local_search
+from handheld_super_resolution.ICA import compute_hessian, ICA_get_new_flow
+from handheld_super_resolution.utils import DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_THREADS
+from benchmarks.subpixel_refinement_benchmark import ica_gradients
+
+
+def synthetic_rgb(imsize, rng):
+    # correlated colour channels, as in natural images
+    luminance = gaussian_filter(rng.random((imsize, imsize)), 2)
+    chroma = gaussian_filter(rng.random((imsize, imsize, 3)), (4, 4, 0))
+    rgb = luminance[:, :, None]*np.array([0.8, 1, 0.6]) + 0.3*chroma
+    return (rgb - rgb.min())/(rgb.max() - rgb.min())
+
+def mosaic(rgb):
+    # RGGB bayer pattern
+    raw = np.empty(rgb.shape[:2], DEFAULT_NUMPY_FLOAT_TYPE)
+    raw[::2, ::2] = rgb[::2, ::2, 0]
+    raw[::2, 1::2] = rgb[::2, 1::2, 1]
+    raw[1::2, ::2] = rgb[1::2, ::2, 1]
+    raw[1::2, 1::2] = rgb[1::2, 1::2, 2]
+    return raw
+
+def align(ref_grey, comp_grey, tile_size, search_radius, n_iter, sigma_blur):
+    n_tiles_y, n_tiles_x = ref_grey.shape[0]//tile_size, ref_grey.shape[1]//tile_size
+    threadsperblock = (DEFAULT_THREADS, DEFAULT_THREADS)
+    blockspergrid = (math.ceil(n_tiles_x/DEFAULT_THREADS), math.ceil(n_tiles_y/DEFAULT_THREADS))
+
+    cuda_ref = cuda.to_device(ref_grey)
+    cuda_comp = cuda.to_device(comp_grey)
+    alignments = cuda.to_device(np.zeros((n_tiles_y, n_tiles_x, 2), DEFAULT_NUMPY_FLOAT_TYPE))
+    local_search(cuda_ref, cuda_comp, tile_size, search_radius, alignments, 'L2')
+
+    gradx, grady = ica_gradients(ref_grey, sigma_blur)
+    cuda_gradx = cuda.to_device(gradx)
+    cuda_grady = cuda.to_device(grady)
+    # compute_hessian has no bound check : the hessian covers the whole grid
+    hessian = cuda.device_array((blockspergrid[1]*DEFAULT_THREADS, blockspergrid[0]*DEFAULT_THREADS, 2, 2),
+                                DEFAULT_NUMPY_FLOAT_TYPE)
+    compute_hessian[blockspergrid, threadsperblock](cuda_gradx, cuda_grady, tile_size, hessian)
+    for _ in range(n_iter):
+        ICA_get_new_flow[blockspergrid, threadsperblock](
+            cuda_ref, cuda_comp, cuda_gradx, cuda_grady, alignments, hessian, tile_size)
+
+    return alignments.copy_to_host()
+
+def run(n_trials, imsize, tile_size, search_radius, n_iter, sigma_blur, seed):
+    rng = np.random.default_rng(seed)
+    n_tiles = imsize // tile_size
+    # tiles whose shifted patch may leave the image are not evaluated
+    inner = slice(1, n_tiles - 1)
+
+    deviations = []
+    errors = {'FFT' : [], 'separable' : []}
+    flow_differences = []
+    for _ in range(n_trials):
+        rgb = synthetic_rgb(imsize, rng)
+        true_flow = rng.uniform(-search_radius + 0.5, search_radius - 0.5, 2) # x, y
+        # comp(X + flow) = ref(X)
+        comp_rgb = shift(rgb, (true_flow[1], true_flow[0], 0), order=3, mode='nearest')
+        ref_raw, comp_raw = mosaic(rgb), mosaic(comp_rgb)
+
+        flows = {}
+        for method in ['FFT', 'separable']:
+            ref_grey = compute_grey_images(ref_raw, method).astype(DEFAULT_NUMPY_FLOAT_TYPE)
+            comp_grey = compute_grey_images(comp_raw, method).astype(DEFAULT_NUMPY_FLOAT_TYPE)
+            if method == 'FFT':
+                fft_grey = ref_grey
+            else:
+                deviations.append(np.sqrt(np.mean((ref_grey - fft_grey)**2)/np.mean(fft_grey**2)))
+
+            flows[method] = align(ref_grey, comp_grey, tile_size, search_radius,
+                                  n_iter, sigma_blur)[inner, inner]
+            errors[method].append(np.linalg.norm(flows[method] - true_flow, axis=-1).ravel())
+        flow_differences.append(np.linalg.norm(flows['separable'] - flows['FFT'], axis=-1).ravel())
+
+    print('{} trials, {}x{} raw frames, tile size {}, {} ICA iterations'.format(
+        n_trials, imsize, imsize, tile_size, n_iter))
+    print('Relative RMS deviation of the separable grey : {:.3%}'.format(np.mean(deviations)))
+    for method in ['FFT', 'separable']:
+        print('Mean flow error with the {} grey : {:.4f} px'.format(
+            method, np.concatenate(errors[method]).mean()))
+    print('Mean flow difference between both : {:.4f} px'.format(
+        np.concatenate(flow_differences).mean()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=10)
+    parser.add_argument('--imsize', type=int, default=256)
+    parser.add_argument('--tile_size', type=int, default=16)
+    parser.add_argument('--search_radius', type=int, default=2)
+    parser.add_argument('--kanadeIter', type=int, default=3)
+    parser.add_argument('--sigma_blur', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run(args.trials, args.imsize, args.tile_size, args.search_radius,
+        args.kanadeIter, args.sigma_blur, args.seed)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the 'covariance' and 'inverse' values of params['kernel storage'].
+With 'covariance', the covariances are interpolated then inverted for every
+output pixel; with 'inverse', their inverses are stored and interpolated.
+Both are different estimators of the kernel between the grey pixels, so the
+PSNR of the merged image against the ground truth is measured for each.
+
+The burst is rendered from a Siemens star, whose edges take every
+orientation, so that the kernels are anisotropic. The frames are translated
+by known sub-pixel flows, mosaicked and noised with the noise model of
+monte_carlo_simulation.py at ISO 100. They are merged with their true flows
+and no robustness, so that only the kernels differ. The centre of the star,
+where the spokes are finer than the red and blue sampling, and the borders
+are not evaluated.
+
+The kernels are estimated on the CPU, and only the numba kernels of the
+merge are used, so the script also runs in the CUDA simulator
+(NUMBA_ENABLE_CUDASIM=1) with small sizes.
+
+Run from the root of the repository :
+    python -m benchmarks.kernel_storage_benchmark
+"""
+import math
+import argparse
+
+import numpy as np
+from numba import cuda
+
+from handheld_super_resolution.kernels import estimate_kernels
+from handheld_super_resolution.merge import merge, merge_ref
+from handheld_super_resolution.utils_image import computePSNR
+from handheld_super_resolution.utils import DEFAULT_NUMPY_FLOAT_TYPE
+from benchmarks.merge_engine_benchmark import get_merging_params
+
+# colour of the star, for the r, g and b channels
+STAR_COLOUR = np.array([0.9, 1, 0.8])
+
+
+def siemens_star(y, x, center, n_spokes):
+    # rgb values of the star at the positions y, x
+    luminance = 0.5 + 0.4*np.sin(n_spokes*np.arctan2(y - center, x - center))
+    return luminance[..., None]*STAR_COLOUR
+
+def render_raw(imsize, flow, center, n_spokes, noise, rng):
+    # comp(X + flow) = ref(X), with a RGGB bayer pattern
+    y, x = np.mgrid[:imsize, :imsize].astype(np.float64)
+    rgb = siemens_star(y - flow[1], x - flow[0], center, n_spokes)
+    raw = np.empty((imsize, imsize))
+    raw[::2, ::2] = rgb[::2, ::2, 0]
+    raw[::2, 1::2] = rgb[::2, 1::2, 1]
+    raw[1::2, ::2] = rgb[1::2, ::2, 1]
+    raw[1::2, 1::2] = rgb[1::2, 1::2, 2]
+    raw += np.sqrt(noise['alpha']*raw + noise['beta'])*rng.standard_normal(raw.shape)
+    return raw.astype(DEFAULT_NUMPY_FLOAT_TYPE)
+
+def merge_burst(raws, flows, params):
+    options = {'verbose' : 0}
+    imsize = raws[0].shape[0]
+    output_shape = (round(params['scale']*imsize), round(params['scale']*imsize), 3)
+    tile_size = params['tuning']['tileSize']
+    n_tiles = -(-imsize//tile_size)
+
+    num = cuda.to_device(np.zeros(output_shape, DEFAULT_NUMPY_FLOAT_TYPE))
+    den = cuda.to_device(np.zeros(output_shape, DEFAULT_NUMPY_FLOAT_TYPE))
+    cuda_r = cuda.to_device(np.ones((imsize//2, imsize//2), DEFAULT_NUMPY_FLOAT_TYPE))
+    for raw, flow in zip(raws, flows):
+        covs = cuda.to_device(estimate_kernels(raw, options, params))
+        if flow is None:
+            merge_ref(cuda.to_device(raw), covs, num, den, options, params)
+        else:
+            alignments = np.empty((n_tiles, n_tiles, 2), DEFAULT_NUMPY_FLOAT_TYPE)
+            alignments[:] = flow
+            merge(cuda.to_device(raw), cuda.to_device(alignments), covs, cuda_r,
+                  num, den, options, params)
+    return num.copy_to_host(), den.copy_to_host()
+
+def run(n_trials, imsize, n_frames, scales, n_spokes, snr, seed):
+    rng = np.random.default_rng(seed)
+    center = (imsize - 1)/2
+    # the spokes are sampled by the red and blue channels (every 2 pixels)
+    # where their period is above 4 pixels
+    min_radius = 4*n_spokes/(2*math.pi)
+    margin = 4
+    noise = get_merging_params(snr, 1, 'handheld', 'gather')['noise']
+
+    print('{} trials, {} frames of {}x{}, Siemens star with {} spokes'.format(
+        n_trials, n_frames, imsize, imsize, n_spokes))
+    print('{:>6} | {:>16} | {:>16} | {:>16}'.format(
+        'scale', 'covariance (dB)', 'inverse (dB)', 'inverse gap (dB)'))
+    for scale in scales:
+        psnrs = {'covariance' : [], 'inverse' : []}
+        for _ in range(n_trials):
+            flows = [None] + [rng.uniform(-2, 2, 2) for _ in range(n_frames - 1)] # x, y
+            raws = [render_raw(imsize, (0, 0) if flow is None else flow, center, n_spokes, noise, rng)
+                    for flow in flows]
+
+            # the output pixel (i, j) is at the position (i, j)/scale of the reference
+            output_size = round(scale*imsize)
+            y, x = np.mgrid[:output_size, :output_size]/scale
+            radius = np.hypot(y - center, x - center)
+            evaluated = ((radius >= min_radius) &
+                         (margin <= y) & (y < imsize - margin) &
+                         (margin <= x) & (x < imsize - margin))
+            ground_truth = siemens_star(y, x, center, n_spokes)[evaluated].astype(DEFAULT_NUMPY_FLOAT_TYPE)
+
+            for kernel_storage in ['covariance', 'inverse']:
+                params = get_merging_params(snr, scale, 'handheld', 'gather')
+                params['kernel storage'] = kernel_storage
+                num, den = merge_burst(raws, flows, params)
+                output = num[evaluated]/den[evaluated]
+                psnrs[kernel_storage].append(computePSNR(ground_truth, np.clip(output, 0, 1)))
+
+        covariance_psnr, inverse_psnr = np.mean(psnrs['covariance']), np.mean(psnrs['inverse'])
+        print('{:>6} | {:>16.2f} | {:>16.2f} | {:>+16.2f}'.format(
+            scale, covariance_psnr, inverse_psnr, inverse_psnr - covariance_psnr))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--imsize', type=int, default=128)
+    parser.add_argument('--frames', type=int, default=8)
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--spokes', type=int, default=16)
+    parser.add_argument('--snr', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run(args.trials, args.imsize, args.frames, args.scales, args.spokes, args.snr, args.seed)
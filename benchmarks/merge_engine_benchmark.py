@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Times the 'gather' and 'tiled' merging engines on a synthetic raw frame,
+for the merge of a compared frame (merge) and of the reference frame
+(merge_ref), at several scales. The outputs of both engines are compared
+as well.
+
+The timings are only meaningful on a CUDA GPU. In the CUDA simulator
+(NUMBA_ENABLE_CUDASIM=1), use a small --imsize to check that it runs.
+
+Run from the root of the repository :
+    python -m benchmarks.merge_engine_benchmark
+"""
+import time
+import argparse
+
+import numpy as np
+from numba import cuda
+
+from handheld_super_resolution.params import get_params
+from handheld_super_resolution.kernels import estimate_kernels
+from handheld_super_resolution.merge import merge, merge_ref
+from handheld_super_resolution.utils import DEFAULT_NUMPY_FLOAT_TYPE
+from benchmarks.grey_method_benchmark import synthetic_rgb, mosaic
+
+
+def get_merging_params(snr, scale, kernel, engine):
+    params = get_params(snr)
+    merging_params = params['merging'].copy()
+    merging_params.update({'scale' : scale,
+                           'kernel' : kernel,
+                           'engine' : engine,
+                           'mode' : 'bayer',
+                           # noise model of monte_carlo_simulation.py, at ISO 100
+                           'noise' : {'alpha' : 1.80710882e-4, 'beta' : 3.1937599182128e-6, 'ISO' : 100},
+                           'exif' : {'CFA Pattern' : np.array([[0, 1], [1, 2]])},
+                           'accumulated robustness denoiser' : {'on' : False}})
+    # as in process(), the tiles of the flow are the ones of block matching
+    merging_params['tuning'] = dict(merging_params['tuning'],
+                                    tileSize=params['block matching']['tuning']['tileSizes'][0])
+    return merging_params
+
+def time_merge(merge_function, args, output_shape, repeats):
+    """
+    Returns the mean time of merge_function(*args, num, den) and the
+    accumulators of the last call.
+    """
+    timings = []
+    for i in range(repeats + 1):
+        num = cuda.to_device(np.zeros(output_shape, DEFAULT_NUMPY_FLOAT_TYPE))
+        den = cuda.to_device(np.zeros(output_shape, DEFAULT_NUMPY_FLOAT_TYPE))
+        cuda.synchronize()
+        t = time.perf_counter()
+        merge_function(*args, num, den)
+        cuda.synchronize()
+        # the first call includes the compilation
+        if i > 0:
+            timings.append(time.perf_counter() - t)
+    return np.mean(timings), num.copy_to_host(), den.copy_to_host()
+
+def run(imsize, scales, kernel, max_flow, snr, repeats, seed):
+    rng = np.random.default_rng(seed)
+    options = {'verbose' : 0}
+
+    raw = mosaic(synthetic_rgb(imsize, rng))
+    cuda_raw = cuda.to_device(raw)
+    cuda_r = cuda.to_device(np.ones((imsize//2, imsize//2), DEFAULT_NUMPY_FLOAT_TYPE))
+
+    print('{}x{} raw frame, {} kernel, flows up to {} px'.format(imsize, imsize, kernel, max_flow))
+    print('{:>6} | {:>9} | {:>11} | {:>11} | {:>8} | {:>10}'.format(
+        'scale', 'function', 'gather (ms)', 'tiled (ms)', 'speedup', 'max diff'))
+    for scale in scales:
+        results = {}
+        for engine in ['gather', 'tiled']:
+            params = get_merging_params(snr, scale, kernel, engine)
+            tile_size = params['tuning']['tileSize']
+            n_tiles = (-(-raw.shape[0]//tile_size), -(-raw.shape[1]//tile_size))
+            if engine == 'gather':
+                # the same inputs are given to both engines
+                covs = estimate_kernels(cuda_raw, options, params)
+                alignments = cuda.to_device(
+                    rng.uniform(-max_flow, max_flow, n_tiles + (2,)).astype(DEFAULT_NUMPY_FLOAT_TYPE))
+            output_shape = (round(scale*imsize), round(scale*imsize), 3)
+
+            results[engine, 'merge'] = time_merge(
+                lambda *args: merge(*args, options, params),
+                (cuda_raw, alignments, covs, cuda_r), output_shape, repeats)
+            results[engine, 'merge_ref'] = time_merge(
+                lambda *args: merge_ref(*args, options, params),
+                (cuda_raw, covs), output_shape, repeats)
+
+        for function in ['merge', 'merge_ref']:
+            gather_time, gather_num, gather_den = results['gather', function]
+            tiled_time, tiled_num, tiled_den = results['tiled', function]
+            max_diff = max(np.abs(gather_num - tiled_num).max(), np.abs(gather_den - tiled_den).max())
+            print('{:>6} | {:>9} | {:>11.3f} | {:>11.3f} | {:>8.2f} | {:>10.2e}'.format(
+                scale, function, 1e3*gather_time, 1e3*tiled_time, gather_time/tiled_time, max_diff))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--imsize', type=int, default=2048)
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--kernel', type=str, default='handheld', choices=['handheld', 'iso'])
+    parser.add_argument('--max_flow', type=float, default=2,
+                        help='amplitude of the random flow of the tiles')
+    parser.add_argument('--snr', type=float, default=30)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run(args.imsize, args.scales, args.kernel, args.max_flow, args.snr, args.repeats, args.seed)
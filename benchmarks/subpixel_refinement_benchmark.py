@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the flow error of the finest block matching level, with and
+without the quadratic subpixel refinement, followed by a varying number of
+ICA iterations, on synthetic sub-pixel translations.
+
+Only the numba kernels of the pipeline are used, so the script also runs in
+the CUDA simulator (NUMBA_ENABLE_CUDASIM=1) with small sizes. The gradients
+of the ICA are computed with scipy, as init_ICA does with torch.
+
+Run from the root of the repository :
+    python -m benchmarks.subpixel_refinement_benchmark
+"""
+import math
+import argparse
+
+import numpy as np
+from numba import cuda
+from scipy.ndimage import gaussian_filter, gaussian_filter1d, correlate1d, shift
+
+from handheld_super_resolution.block_matching import local_search, subpixel_refinement
+from handheld_super_resolution.ICA import compute_hessian, ICA_get_new_flow
+from handheld_super_resolution.utils import DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_THREADS
+
+
+def ica_gradients(img, sigma_blur):
+    # same as init_ICA : gaussian blur then unnormalised [-1, 0, 1] kernels,
+    # with zero padding
+    radius = int(4*sigma_blur + 0.5)
+    temp = gaussian_filter1d(img, sigma_blur, axis=0, mode='constant', truncate=radius/sigma_blur)
+    temp = gaussian_filter1d(temp, sigma_blur, axis=1, mode='constant', truncate=radius/sigma_blur)
+    gradx = correlate1d(temp, [-1, 0, 1], axis=1, mode='constant')
+    grady = correlate1d(temp, [-1, 0, 1], axis=0, mode='constant')
+    return gradx.astype(DEFAULT_NUMPY_FLOAT_TYPE), grady.astype(DEFAULT_NUMPY_FLOAT_TYPE)
+
+def run(n_trials, imsize, tile_size, search_radius, max_iter, sigma_blur, seed):
+    rng = np.random.default_rng(seed)
+    n_tiles = imsize // tile_size
+    # tiles whose shifted patch may leave the image are not evaluated
+    inner = slice(1, n_tiles - 1)
+
+    threadsperblock = (DEFAULT_THREADS, DEFAULT_THREADS)
+    blockspergrid = (math.ceil(n_tiles/DEFAULT_THREADS), math.ceil(n_tiles/DEFAULT_THREADS))
+
+    # errors[refinement][n_iter] : list of the flow errors of all the tiles
+    errors = {refined: [[] for _ in range(max_iter + 1)] for refined in (False, True)}
+    for _ in range(n_trials):
+        ref = gaussian_filter(rng.random((imsize, imsize)), 1.5)
+        ref = (ref - ref.min())/(ref.max() - ref.min())
+        true_flow = rng.uniform(-search_radius + 0.5, search_radius - 0.5, 2) # x, y
+        # alt(X + flow) = ref(X)
+        alt = shift(ref, (true_flow[1], true_flow[0]), order=3, mode='nearest')
+
+        ref = ref.astype(DEFAULT_NUMPY_FLOAT_TYPE)
+        alt = alt.astype(DEFAULT_NUMPY_FLOAT_TYPE)
+        cuda_ref = cuda.to_device(ref)
+        cuda_alt = cuda.to_device(alt)
+        gradx, grady = ica_gradients(ref, sigma_blur)
+        cuda_gradx = cuda.to_device(gradx)
+        cuda_grady = cuda.to_device(grady)
+        # compute_hessian has no bound check : the hessian covers the whole grid
+        n_grid = blockspergrid[0]*DEFAULT_THREADS
+        hessian = cuda.device_array((n_grid, n_grid, 2, 2), DEFAULT_NUMPY_FLOAT_TYPE)
+        compute_hessian[blockspergrid, threadsperblock](cuda_gradx, cuda_grady, tile_size, hessian)
+
+        for refined in (False, True):
+            alignments = cuda.to_device(np.zeros((n_tiles, n_tiles, 2), DEFAULT_NUMPY_FLOAT_TYPE))
+            neighbourhoods = None
+            if refined:
+                neighbourhoods = cuda.to_device(np.full((n_tiles, n_tiles, 3, 3), np.nan,
+                                                        DEFAULT_NUMPY_FLOAT_TYPE))
+            local_search(cuda_ref, cuda_alt, tile_size, search_radius,
+                         alignments, 'L2', 'brute force', neighbourhoods)
+            if refined:
+                subpixel_refinement(cuda_ref, cuda_alt, tile_size, alignments, 'L2', neighbourhoods)
+
+            for n_iter in range(max_iter + 1):
+                if n_iter > 0:
+                    ICA_get_new_flow[blockspergrid, threadsperblock](
+                        cuda_ref, cuda_alt, cuda_gradx, cuda_grady, alignments, hessian, tile_size)
+                flow = alignments.copy_to_host()[inner, inner]
+                errors[refined][n_iter].append(np.linalg.norm(flow - true_flow, axis=-1).ravel())
+
+    print('Mean flow error (px) over {} trials, tile size {}'.format(n_trials, tile_size))
+    print('{:>10} | {:>10} | {:>10}'.format('ICA iter', 'integer BM', 'refined BM'))
+    for n_iter in range(max_iter + 1):
+        print('{:>10} | {:>10.4f} | {:>10.4f}'.format(
+            n_iter,
+            np.concatenate(errors[False][n_iter]).mean(),
+            np.concatenate(errors[True][n_iter]).mean()))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--imsize', type=int, default=128)
+    parser.add_argument('--tile_size', type=int, default=16)
+    parser.add_argument('--search_radius', type=int, default=2)
+    parser.add_argument('--max_iter', type=int, default=5)
+    parser.add_argument('--sigma_blur', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run(args.trials, args.imsize, args.tile_size, args.search_radius,
+        args.max_iter, args.sigma_blur, args.seed)
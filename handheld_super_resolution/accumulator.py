@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:02:37 2026
+
+This script contains the state of the accumulators of Alg. 1, along with
+everything that only depends on the reference frame J_1 (grey frame, local
+stats and kernels). Saving this state
+allows to extend a burst with new frames later on, without processing the
+reference frame or the frames that were already merged again.
+
+The state is saved as a directory containing one .npy file per array,
+which can be memory-mapped when loaded, and a state.json file with the
+bookkeeping informations.
+
+
+@author: jamyl
+"""
+
+import os
+import json
+
+import numpy as np
+from numba import cuda
+
+from .grey_frame import GreyFrame
+from .utils import to_host
+
+
+STATE_FILE = 'state.json'
+
+
+class AccumulatorState:
+    def __init__(self, ref_img, ref_frame,
+                 ref_local_stats, ref_kernels,
+                 num, den, accumulated_r=None,
+                 n_merged=0, reference_path=None, merged_paths=None, cache_key=None,
+                 params_key=None):
+        """
+        Parameters
+        ----------
+        ref_img : device Array[imshape_y, imshape_x]
+            Reference frame J_1
+        ref_frame : GreyFrame
+            Reference grey image G_1, with its pyramid, gradients and hessian
+        ref_local_stats : device Array
+            Local statistics of J_1 used by the robustness
+        ref_kernels : device Array[imshape_y//2, imshape_x//2, 3]
+            Covariance Matrices Omega_1
+        num : device Array[s*imshape_y, s*imshape_x, 3]
+            Numerator of the accumulator
+        den : device Array[s*imshape_y, s*imshape_x, 3]
+            Denominator of the accumulator
+        accumulated_r : device Array[imshape_y//2, imshape_x//2], optional
+            Accumulated robustness. The default is None.
+        n_merged : int, optional
+            Number of frames accumulated so far. The default is 0.
+        reference_path : str, optional
+            Path of the reference raw file. The default is None.
+        merged_paths : list of str, optional
+            Paths of the raw files that have already been processed
+            (merged or rejected). The default is None.
+        cache_key : str, optional
+            Hash of the reference frame, used to address the computation
+            cache. The default is None.
+        params_key : str, optional
+            Hash of the parameters the state was computed with, so that the
+            burst is only extended with the same ones. The default is None.
+
+        """
+        self.ref_img = ref_img
+        self.ref_frame = ref_frame
+        self.ref_local_stats = ref_local_stats
+        self.ref_kernels = ref_kernels
+        self.num = num
+        self.den = den
+        self.accumulated_r = accumulated_r
+
+        self.n_merged = n_merged
+        self.reference_path = reference_path
+        self.merged_paths = [] if merged_paths is None else list(merged_paths)
+        self.cache_key = cache_key
+        self.params_key = params_key
+
+    def _arrays(self):
+        arrays = {'ref_img' : self.ref_img,
+                  'ref_padded_grey' : self.ref_frame.padded,
+                  'ref_gradx' : self.ref_frame.gradx,
+                  'ref_grady' : self.ref_frame.grady,
+                  'hessian' : self.ref_frame.hessian,
+                  'ref_local_stats' : self.ref_local_stats,
+                  'ref_kernels' : self.ref_kernels,
+                  'num' : self.num,
+                  'den' : self.den}
+        if self.accumulated_r is not None:
+            arrays['accumulated_r'] = self.accumulated_r
+        for lv, level in enumerate(self.ref_frame.pyramid):
+            arrays['pyramid_{}'.format(lv)] = level
+        return arrays
+
+    def save(self, path):
+        """
+        Saves the state in the directory path, which is created if needed.
+
+        """
+        os.makedirs(path, exist_ok=True)
+
+        arrays = self._arrays()
+        for name, cuda_array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), to_host(cuda_array))
+
+        with open(os.path.join(path, STATE_FILE), 'w') as state_file:
+            json.dump({'n_merged' : self.n_merged,
+                       'reference_path' : self.reference_path,
+                       'merged_paths' : self.merged_paths,
+                       'cache_key' : self.cache_key,
+                       'params_key' : self.params_key,
+                       'pyramid_levels' : len(self.ref_frame.pyramid),
+                       'grey_shape' : self.ref_frame.imshape,
+                       'accumulated_r' : self.accumulated_r is not None},
+                      state_file, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a state saved with save(). The arrays are memory-mapped and
+        directly moved to the GPU.
+
+        """
+        with open(os.path.join(path, STATE_FILE), 'r') as state_file:
+            metadata = json.load(state_file)
+
+        def load_array(name):
+            return cuda.to_device(np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+
+        reference_pyramid = [load_array('pyramid_{}'.format(lv))
+                             for lv in range(metadata['pyramid_levels'])]
+        ref_frame = GreyFrame(load_array('ref_padded_grey'), metadata['grey_shape'], reference_pyramid,
+                              load_array('ref_gradx'), load_array('ref_grady'), load_array('hessian'))
+        accumulated_r = load_array('accumulated_r') if metadata['accumulated_r'] else None
+
+        return cls(load_array('ref_img'), ref_frame,
+                   load_array('ref_local_stats'), load_array('ref_kernels'),
+                   load_array('num'), load_array('den'), accumulated_r,
+                   n_merged=metadata['n_merged'],
+                   reference_path=metadata['reference_path'],
+                   merged_paths=metadata['merged_paths'],
+                   cache_key=metadata.get('cache_key'),
+                   params_key=metadata.get('params_key'))
@@ -20,17 +20,54 @@ import torch.nn.functional as F
 
 from .utils import getTime, clamp, DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_CUDA_FLOAT_TYPE, DEFAULT_TORCH_FLOAT_TYPE, DEFAULT_THREADS
 from .utils_image import cuda_downsample
+from .params import get_search_engines
 
+# The ref patchs are streamed by chunks of this size, so that any tile size
+# can be processed.
+CHUNK_SIZE = 32
 
-def init_block_matching(ref_img, options, params):
+
+def pad_image(img, tileSize):
+    """
+    Circular padding of the image, so that the tiles contain all the image
+    pixels. When the image is already a multiple of the tile size, it is
+    not copied.
+
+    Parameters
+    ----------
+    img : device Array[imshape_y, imshape_x]
+        Grey image
+    tileSize : int
+        Tile size of the finest level
+
+    Returns
+    -------
+    th_img_padded : torch.Tensor[1, 1, padded_imshape_y, padded_imshape_x]
+        Padded image
+
+    """
+    h, w = img.shape
+    
+    # if needed, pad images so that getTiles contains all image pixels
+    paddingBottom = (tileSize - h % (tileSize)) * (h % (tileSize) != 0)
+    paddingRight = (tileSize - w % (tileSize)) * (w % (tileSize) != 0)
+    
+    th_img = torch.as_tensor(img, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")[None, None]
+    
+    if paddingBottom == 0 and paddingRight == 0:
+        return th_img
+    return F.pad(th_img, (0, paddingRight, 0, paddingBottom), 'circular')
+
+
+def compute_pyramid(th_img_padded, options, params):
     '''
-    Returns the pyramid representation of ref_img, that will be used for 
-    future block matching
+    Returns the pyramid representation of a padded grey image, that is used
+    for block matching
 
     Parameters
     ----------
-    ref_img : device Array[imshape_y, imshape_x]
-        Reference image J_1
+    th_img_padded : torch.Tensor[1, 1, padded_imshape_y, padded_imshape_x]
+        Grey image, padded by pad_image()
     options : dict
         options.
     params : dict
@@ -38,61 +75,42 @@ def init_block_matching(ref_img, options, params):
 
     Returns
     -------
-    referencePyramid : list [device Array]
+    pyramid : list [device Array]
         pyramid representation of the image
 
     '''
-    # Initialization.
-    h, w = ref_img.shape  # height and width should be identical for all images
-    
-    tileSize = params['tuning']['tileSizes'][0]
-    
-    # if needed, pad images with zeros so that getTiles contains all image pixels
-    paddingPatchesHeight = (tileSize - h % (tileSize)) * (h % (tileSize) != 0)
-    paddingPatchesWidth = (tileSize - w % (tileSize)) * (w % (tileSize) != 0)
-
-    # combine the two to get the total padding
-    paddingTop = 0
-    paddingBottom = paddingPatchesHeight
-    paddingLeft = 0
-    paddingRight = paddingPatchesWidth
-    
-	# pad all images (by mirroring image edges)
-	# separate reference and alternate images
-    # ref_img_padded = np.pad(ref_img, ((paddingTop, paddingBottom), (paddingLeft, paddingRight)), 'symmetric')
-    
-    th_ref_img = torch.as_tensor(ref_img, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")[None, None]
-    
-    th_ref_img_padded = F.pad(th_ref_img, (paddingLeft, paddingRight, paddingTop, paddingBottom), 'circular')
-
-
-
     # For convenience
     currentTime, verbose = time.perf_counter(), options['verbose'] > 2
     # factors, tileSizes, distances, searchRadia and subpixels are described fine-to-coarse
     factors = params['tuning']['factors']
 
 
-    # construct 4-level coarse-to fine pyramid of the reference
+    # construct 4-level coarse-to fine pyramid
 
-    referencePyramid = hdrplusPyramid(th_ref_img_padded, factors)
+    pyramid = hdrplusPyramid(th_img_padded, factors)
     if verbose:
-        currentTime = getTime(currentTime, ' --- Create ref pyramid')
+        cuda.synchronize()
+        currentTime = getTime(currentTime, ' --- Create pyramid')
     
-    return referencePyramid
+    return pyramid
 
 
-def align_image_block_matching(img, referencePyramid, options, params, debug=False):
+def align_image_block_matching(alternatePyramid, referencePyramid, options, params, debug=False,
+                               first_level=0, last_level=None, previous_alignments=None):
     """
-    Align the reference image with the img : returns a patchwise flow such that
-    for patches py, px :
+    Align the reference image with the img, given their pyramid
+    representations : returns a patchwise flow such that for patches py, px :
         img[py, px] ~= ref_img[py + alignments[py, px, 1], 
                                px + alignments[py, px, 0]]
+    
+    The alignment can be restricted to a range of pyramid levels, for example
+    to only align the coarsest levels, and to resume the alignment of the
+    finer levels later on.
 
     Parameters
     ----------
-    img : device Array[imshape_y, imshape_x]
-        Image to be compared J_i (i>1)
+    alternatePyramid : list [device Array]
+        Pyramid representation of the image to be compared J_i (i>1)
     referencePyramid : list [device Array]
         Pyramid representation of the ref image J_1
     options : dict
@@ -101,36 +119,21 @@ def align_image_block_matching(img, referencePyramid, options, params, debug=Fal
         parameters.
     debug : Bool, optional
         When True, a list with the alignment at each step is returned. The default is False.
+    first_level : int, optional
+        Index of the first level to align, coarse-to-fine. The default is 0.
+    last_level : int, optional
+        Index of the last level to align (excluded), coarse-to-fine. The
+        default is None, meaning that all the levels are aligned.
+    previous_alignments : device Array, optional
+        Alignments obtained on the level first_level - 1. They are required
+        when first_level > 0. The default is None.
 
     Returns
     -------
     alignments : device Array[n_patchs_y, n_patchs_x, 2]
-        Patchwise flow : V_n(p) for each patch (p)
+        Patchwise flow : V_n(p) for each patch (p), on the level last_level - 1
 
     """
-    # Initialization.
-    h, w = img.shape  # height and width should be identical for all images
-    
-    tileSize = params['tuning']['tileSizes'][0]
-    # if needed, pad images with zeros so that getTiles contains all image pixels
-    paddingPatchesHeight = (tileSize - h % (tileSize)) * (h % (tileSize) != 0)
-    paddingPatchesWidth = (tileSize - w % (tileSize)) * (w % (tileSize) != 0)
-
-    # combine the two to get the total padding
-    paddingTop = 0
-    paddingBottom = paddingPatchesHeight
-    paddingLeft = 0
-    paddingRight = paddingPatchesWidth
-    
-	# pad all images (by mirroring image edges)
-	# separate reference and alternate images
-    
-    th_img = torch.as_tensor(img, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")[None, None]
-    
-
-    img_padded = F.pad(th_img, (paddingLeft, paddingRight, paddingTop, paddingBottom), 'circular')
-    
-
     # For convenience
     currentTime, verbose = time.perf_counter(), options['verbose'] > 2
     # factors, tileSizes, distances, searchRadia and subpixels are described fine-to-coarse
@@ -138,6 +141,8 @@ def align_image_block_matching(img, referencePyramid, options, params, debug=Fal
     tileSizes = params['tuning']['tileSizes']
     distances = params['tuning']['distances']
     searchRadia = params['tuning']['searchRadia']
+    searchEngines = get_search_engines(params['tuning'])
+    subpixelRefinement = params['tuning']['subpixelRefinement']
 
     upsamplingFactors = factors[1:] + [1]
     previousTileSizes = tileSizes[1:] + [None]
@@ -145,18 +150,16 @@ def align_image_block_matching(img, referencePyramid, options, params, debug=Fal
 
     # Align alternate image to the reference image
 
-    # 4-level coarse-to fine pyramid of alternate image
-    alternatePyramid = hdrplusPyramid(img_padded, factors)
-    if verbose:
-        cuda.synchronize()
-        currentTime = getTime(currentTime, ' --- Create alt pyramid')
+    if last_level is None:
+        last_level = len(referencePyramid)
+    assert (first_level == 0) == (previous_alignments is None)
 
     # succesively align from coarsest to finest level of the pyramid
-    alignments = None
+    alignments = previous_alignments
     if debug:
         debug_list = []
     
-    for lv in range(len(referencePyramid)):
+    for lv in range(first_level, last_level):
         alignments = align_on_a_level(
             referencePyramid[lv],
             alternatePyramid[lv],
@@ -166,7 +169,9 @@ def align_image_block_matching(img, referencePyramid, options, params, debug=Fal
             previousTileSizes[-lv - 1],
             searchRadia[-lv - 1],
             distances[-lv - 1],
-            alignments
+            alignments,
+            searchEngines[-lv - 1],
+            subpixelRefinement and lv == len(referencePyramid) - 1
         )
 
         if debug:
@@ -180,11 +185,116 @@ def align_image_block_matching(img, referencePyramid, options, params, debug=Fal
     return alignments
 
 
+def align_image_from_prior(alternatePyramid, referencePyramid, prior_alignments, options, params):
+    """
+    Align the reference image with the img, starting from a prior on the
+    alignment (such as the flow of the previous frame of the burst) : only
+    the finest level of the pyramid is searched, within
+    params['tuning']['priorSearchRadius'] around the prior.
+
+    Parameters
+    ----------
+    alternatePyramid : list [device Array]
+        Pyramid representation of the image to be compared J_i (i>1)
+    referencePyramid : list [device Array]
+        Pyramid representation of the ref image J_1
+    prior_alignments : device Array[n_patchs_y, n_patchs_x, 2]
+        Prior on the patchwise flow, on the tile grid of the finest level.
+    options : dict
+        options.
+    params : dict
+        parameters.
+
+    Returns
+    -------
+    alignments : device Array[n_patchs_y, n_patchs_x, 2]
+        Patchwise flow : V_n(p) for each patch (p)
+
+    """
+    tileSize = params['tuning']['tileSizes'][0]
+    finestLevel = alternatePyramid[-1]
+    
+    currentTime, verbose = time.perf_counter(), options['verbose'] > 2
+    
+    # The block matching works with integer alignments
+    th_prior = torch.as_tensor(prior_alignments, device="cuda")
+    alignments = cuda.as_cuda_array(torch.round(th_prior).to(DEFAULT_TORCH_FLOAT_TYPE).contiguous())
+    
+    neighbourhoods = None
+    if params['tuning']['subpixelRefinement']:
+        n_patchs_y, n_patchs_x, _ = alignments.shape
+        neighbourhoods = cuda.to_device(np.full((n_patchs_y, n_patchs_x, 3, 3), np.nan,
+                                                dtype=DEFAULT_NUMPY_FLOAT_TYPE))
+    
+    local_search(referencePyramid[-1], finestLevel,
+                 tileSize, params['tuning']['priorSearchRadius'],
+                 alignments, params['tuning']['distances'][0], get_search_engines(params['tuning'])[0],
+                 neighbourhoods)
+    
+    if params['tuning']['subpixelRefinement']:
+        subpixel_refinement(referencePyramid[-1], finestLevel,
+                            tileSize, alignments, params['tuning']['distances'][0],
+                            neighbourhoods)
+    
+    if verbose:
+        cuda.synchronize()
+        currentTime = getTime(currentTime, ' --- Align finest level from prior')
+    
+    return alignments
+
+
+def upscale_alignments(alignments, level, params, tile_size, n_tiles):
+    """
+    Converts the alignments estimated on a coarse level of the pyramid to
+    the tile grid of the finest level, with a nearest neighbour interpolation.
+
+    Parameters
+    ----------
+    alignments : device Array[n_coarse_tiles_y, n_coarse_tiles_x, 2]
+        Alignments on the coarse level
+    level : int
+        Index of the level, coarse-to-fine
+    params : dict
+        Block matching parameters
+    tile_size : int
+        Tile size of the fine grid
+    n_tiles : tuple(int, int)
+        Number of tiles of the fine grid
+
+    Returns
+    -------
+    upscaled_alignments : device Array[n_tiles_y, n_tiles_x, 2]
+        Alignments on the fine tile grid, expressed in fine pixels.
+
+    """
+    factors = params['tuning']['factors']
+    tileSizes = params['tuning']['tileSizes']
+    
+    # factors and tile sizes are described fine-to-coarse
+    fine_to_coarse_id = len(factors) - 1 - level
+    level_factor = int(np.prod(factors[:fine_to_coarse_id + 1]))
+    # size of a coarse tile, in fine pixels
+    coarse_tile_size = level_factor * tileSizes[fine_to_coarse_id]
+    
+    th_alignments = torch.as_tensor(alignments, device="cuda")
+    n_coarse_tiles_y, n_coarse_tiles_x, _ = th_alignments.shape
+    
+    # the coarse tile containing the center of each fine tile is picked
+    tile_centers_y = torch.arange(n_tiles[0], device="cuda") * tile_size + tile_size//2
+    tile_centers_x = torch.arange(n_tiles[1], device="cuda") * tile_size + tile_size//2
+    coarse_ids_y = torch.clamp(tile_centers_y // coarse_tile_size, max=n_coarse_tiles_y - 1)
+    coarse_ids_x = torch.clamp(tile_centers_x // coarse_tile_size, max=n_coarse_tiles_x - 1)
+    
+    th_upscaled = th_alignments[coarse_ids_y][:, coarse_ids_x] * level_factor
+    
+    return cuda.as_cuda_array(th_upscaled.contiguous())
+
 def hdrplusPyramid(image, factors=[1, 2, 4, 4], kernel='gaussian'):
     '''Construct 4-level coarse-to-fine gaussian pyramid
     as described in the HDR+ paper and its supplement (Section 3.2 of the IPOL article).
     Args:
-            image: input image (expected to be a grayscale image downsampled from a Bayer raw image)
+            image: input image (expected to be a grayscale image downsampled from a Bayer raw image).
+                   numpy arrays are downsampled on the CPU, and the levels are then numpy arrays
             factors: [int], dowsampling factors (fine-to-coarse)
             kernel: convolution kernel to apply before downsampling (default: gaussian kernel)'''
     # Start with the finest level computed from the input
@@ -199,19 +309,23 @@ def hdrplusPyramid(image, factors=[1, 2, 4, 4], kernel='gaussian'):
 
     # torch to numba, remove batch, channel dimensions
     for i, pyramidLevel in enumerate(pyramidLevels):
-        pyramidLevels[i] = cuda.as_cuda_array(pyramidLevel.squeeze())
+        if isinstance(pyramidLevel, np.ndarray):
+            pyramidLevels[i] = pyramidLevel.squeeze()
+        else:
+            pyramidLevels[i] = cuda.as_cuda_array(pyramidLevel.squeeze())
         
     # Reverse the pyramid to get it coarse-to-fine
     return pyramidLevels[::-1]
 
 def align_on_a_level(referencePyramidLevel, alternatePyramidLevel, options, upsamplingFactor, tileSize, 
-                     previousTileSize, searchRadius, distance, previousAlignments):
+                     previousTileSize, searchRadius, distance, previousAlignments, searchEngine='brute force',
+                     subpixelRefinement=False):
     """
-    Alignment will always be an integer with this function, however it is 
-    set to DEFAULT_FLOAT_TYPE. This enables to directly use the outputed
-    alignment for ICA without any casting from int to float, which would be hard
-    to perform on GPU : Numba is completely powerless and cannot make the
-    casting.
+    Alignment will always be an integer with this function (unless
+    subpixelRefinement is True), however it is set to DEFAULT_FLOAT_TYPE.
+    This enables to directly use the outputed alignment for ICA without any
+    casting from int to float, which would be hard to perform on GPU : Numba
+    is completely powerless and cannot make the casting.
 
     """
     
@@ -246,16 +360,33 @@ def align_on_a_level(referencePyramidLevel, alternatePyramidLevel, options, upsa
         cuda.synchronize()
         currentTime = getTime(currentTime, ' ---- Upsample alignments')
     
-    local_search(referencePyramidLevel, alternatePyramidLevel,
-                 tileSize, searchRadius,
-                 upsampledAlignments, distance)
+    # The brute force search stores the distance surface around the best
+    # shifts for the subpixel refinement
+    neighbourhoods = None
+    if subpixelRefinement:
+        neighbourhoods = cuda.to_device(np.full((h, w, 3, 3), np.nan, dtype=DEFAULT_NUMPY_FLOAT_TYPE))
+    
+    skipped_fraction = local_search(referencePyramidLevel, alternatePyramidLevel,
+                                    tileSize, searchRadius,
+                                    upsampledAlignments, distance, searchEngine,
+                                    neighbourhoods)
     
     if verbose:
         cuda.synchronize()
         currentTime = getTime(currentTime, ' ---- Patchs aligned')
+        if skipped_fraction is not None:
+            print(' ---- {:.1%} of the distance computations skipped'.format(skipped_fraction))
         
     # In the original HDR block matching, supixel precision is obtained here.
-    # We do not need that as we use the ICA after block matching
+    # It is optional, since the ICA is performed after block matching, but
+    # it lets the ICA start closer to the optimum.
+    if subpixelRefinement:
+        subpixel_refinement(referencePyramidLevel, alternatePyramidLevel,
+                            tileSize, upsampledAlignments, distance, neighbourhoods)
+        
+        if verbose:
+            cuda.synchronize()
+            currentTime = getTime(currentTime, ' ---- Subpixel refinement')
 
     return upsampledAlignments
     
@@ -313,16 +444,6 @@ def cuda_upsample_alignments(referencePyramidLevel, alternatePyramidLevel, upsam
     subtile_pos_y = subtile_y*tileSize
     subtile_pos_x = subtile_x*tileSize
     
-    # copying ref patch into local memory, because it needs to be read 3 times
-    # TODO this should be rewritten to allow patchs bigger than 32
-    local_ref = cuda.local.array((32, 32), DEFAULT_CUDA_FLOAT_TYPE)
-    for i in range(tileSize):
-        for j in range(tileSize):
-            idx = subtile_pos_x + j
-            idy = subtile_pos_y + i            
-            local_ref[i, j] = referencePyramidLevel[idy, idx]
-    
-    
     # position of the new tile within the old tile
     ups_subtile_x = subtile_x%repeatFactor
     ups_subtile_y = subtile_y%repeatFactor
@@ -356,56 +477,50 @@ def cuda_upsample_alignments(referencePyramidLevel, alternatePyramidLevel, upsam
                                                                  clamp(prev_tile_x + x_shift, 0, n_tiles_x_prev - 1),
                                                                  1] * upsamplingFactor
     
-    # Choosing the best of the 3 alignments by minimising L1 dist
-    dist = +1/0
+    # The ref patch is streamed into local memory chunk by chunk, because
+    # each chunk needs to be read 3 times
+    local_ref = cuda.local.array((CHUNK_SIZE, CHUNK_SIZE), DEFAULT_CUDA_FLOAT_TYPE)
+    
+    dist_0_shift = 0
+    dist_vert_shift = 0
+    dist_horizontal_shift = 0
+    for chunk_pos_y in range(subtile_pos_y, subtile_pos_y + tileSize, CHUNK_SIZE):
+        chunk_h = min(CHUNK_SIZE, subtile_pos_y + tileSize - chunk_pos_y)
+        for chunk_pos_x in range(subtile_pos_x, subtile_pos_x + tileSize, CHUNK_SIZE):
+            chunk_w = min(CHUNK_SIZE, subtile_pos_x + tileSize - chunk_pos_x)
+            
+            load_chunk(referencePyramidLevel, chunk_pos_y, chunk_pos_x, chunk_h, chunk_w, local_ref)
+            
+            # Choosing the best of the 3 alignments by minimising L1 dist
+            dist_0_shift += chunk_L1_dist(local_ref, chunk_h, chunk_w, alternatePyramidLevel,
+                                          chunk_pos_y + int(candidate_alignment_0_shift[1]),
+                                          chunk_pos_x + int(candidate_alignment_0_shift[0]))
+            dist_vert_shift += chunk_L1_dist(local_ref, chunk_h, chunk_w, alternatePyramidLevel,
+                                             chunk_pos_y + int(candidate_alignment_vert_shift[1]),
+                                             chunk_pos_x + int(candidate_alignment_vert_shift[0]))
+            dist_horizontal_shift += chunk_L1_dist(local_ref, chunk_h, chunk_w, alternatePyramidLevel,
+                                                   chunk_pos_y + int(candidate_alignment_horizontal_shift[1]),
+                                                   chunk_pos_x + int(candidate_alignment_horizontal_shift[0]))
+    
+    dist = math.inf
     optimal_flow_x = 0
     optimal_flow_y = 0
     
     # 0 shift
-    dist_ = 0
-    for i in range(tileSize):
-        for j in range(tileSize):
-            new_idy = subtile_pos_y + i + int(candidate_alignment_0_shift[1])
-            new_idx = subtile_pos_x + j + int(candidate_alignment_0_shift[0])
-            if (0 <= new_idx < w and
-                0 <= new_idy < h):
-                dist_ += abs(local_ref[i, j] - alternatePyramidLevel[new_idy, new_idx])
-            else:
-                dist_ = 1/0
-    if dist_ < dist:
-        dist = dist_
+    if dist_0_shift < dist:
+        dist = dist_0_shift
         optimal_flow_x = candidate_alignment_0_shift[0]
         optimal_flow_y = candidate_alignment_0_shift[1]
         
     # vertical shift
-    dist_ = 0
-    for i in range(tileSize):
-        for j in range(tileSize):
-            new_idy = subtile_pos_y + i + int(candidate_alignment_vert_shift[1])
-            new_idx = subtile_pos_x + j + int(candidate_alignment_vert_shift[0])
-            if (0 <= new_idx < w and
-                0 <= new_idy < h):
-                dist_ += abs(local_ref[i, j] - alternatePyramidLevel[new_idy, new_idx])
-            else:
-                dist_ = 1/0
-    if dist_ < dist:
-        dist = dist_
+    if dist_vert_shift < dist:
+        dist = dist_vert_shift
         optimal_flow_x = candidate_alignment_vert_shift[0]
         optimal_flow_y = candidate_alignment_vert_shift[1]
             
     # horizontal shift
-    dist_ = 0
-    for i in range(tileSize):
-        for j in range(tileSize):
-            new_idy = subtile_pos_y + i + int(candidate_alignment_horizontal_shift[1])
-            new_idx = subtile_pos_x + j + int(candidate_alignment_horizontal_shift[0])
-            if (0 <= new_idx < w and
-                0 <= new_idy < h):
-                dist_ += abs(local_ref[i, j] - alternatePyramidLevel[new_idy, new_idx])
-            else:
-                dist_ = 1/0
-    if dist_ < dist:
-        dist = dist_
+    if dist_horizontal_shift < dist:
+        dist = dist_horizontal_shift
         optimal_flow_x = candidate_alignment_horizontal_shift[0]
         optimal_flow_y = candidate_alignment_horizontal_shift[1]
     
@@ -413,11 +528,235 @@ def cuda_upsample_alignments(referencePyramidLevel, alternatePyramidLevel, upsam
     upsampledAlignments[subtile_y, subtile_x, 0] = optimal_flow_x
     upsampledAlignments[subtile_y, subtile_x, 1] = optimal_flow_y
 
+@cuda.jit(device=True)
+def load_chunk(referencePyramidLevel, chunk_pos_y, chunk_pos_x, chunk_h, chunk_w, local_ref):
+    for i in range(chunk_h):
+        for j in range(chunk_w):
+            local_ref[i, j] = referencePyramidLevel[chunk_pos_y + i, chunk_pos_x + j]
+
+@cuda.jit(device=True)
+def chunk_L1_dist(local_ref, chunk_h, chunk_w, alternatePyramidLevel, pos_y, pos_x):
+    """
+    L1 distance between a chunk of the ref patch and the chunk of the
+    alternate level starting at (pos_y, pos_x). It is infinite if the
+    chunk is not entirely contained in the alternate level.
+    """
+    h, w = alternatePyramidLevel.shape
+    if not (0 <= pos_y and pos_y + chunk_h <= h and
+            0 <= pos_x and pos_x + chunk_w <= w):
+        return math.inf
+    
+    dist = 0
+    for i in range(chunk_h):
+        for j in range(chunk_w):
+            dist += abs(local_ref[i, j] - alternatePyramidLevel[pos_y + i, pos_x + j])
+    return dist
+
+@cuda.jit(device=True)
+def chunk_L2_dist(local_ref, chunk_h, chunk_w, alternatePyramidLevel, pos_y, pos_x):
+    """
+    L2 distance between a chunk of the ref patch and the chunk of the
+    alternate level starting at (pos_y, pos_x). It is infinite if the
+    chunk is not entirely contained in the alternate level.
+    """
+    h, w = alternatePyramidLevel.shape
+    if not (0 <= pos_y and pos_y + chunk_h <= h and
+            0 <= pos_x and pos_x + chunk_w <= w):
+        return math.inf
+    
+    dist = 0
+    for i in range(chunk_h):
+        for j in range(chunk_w):
+            diff = local_ref[i, j] - alternatePyramidLevel[pos_y + i, pos_x + j]
+            dist += diff*diff
+    return dist
+
+
+@cuda.jit(device=True)
+def patch_dist(referencePyramidLevel, alternatePyramidLevel, patch_pos_y, patch_pos_x,
+               tileSize, flow_y, flow_x, l2_dist, ref_loaded, local_ref):
+    """
+    Distance between the ref patch and the alternate patch shifted by
+    (flow_y, flow_x). The ref patch is streamed chunk by chunk into
+    local_ref, unless ref_loaded is True : the patch then fits in a single
+    chunk which is already loaded.
+    """
+    dist = 0
+    for chunk_pos_y in range(patch_pos_y, patch_pos_y + tileSize, CHUNK_SIZE):
+        chunk_h = min(CHUNK_SIZE, patch_pos_y + tileSize - chunk_pos_y)
+        for chunk_pos_x in range(patch_pos_x, patch_pos_x + tileSize, CHUNK_SIZE):
+            chunk_w = min(CHUNK_SIZE, patch_pos_x + tileSize - chunk_pos_x)
+            
+            if not ref_loaded:
+                load_chunk(referencePyramidLevel, chunk_pos_y, chunk_pos_x, chunk_h, chunk_w, local_ref)
+            
+            if l2_dist:
+                dist += chunk_L2_dist(local_ref, chunk_h, chunk_w, alternatePyramidLevel,
+                                      chunk_pos_y + flow_y, chunk_pos_x + flow_x)
+            else:
+                dist += chunk_L1_dist(local_ref, chunk_h, chunk_w, alternatePyramidLevel,
+                                      chunk_pos_y + flow_y, chunk_pos_x + flow_x)
+    return dist
+
+@cuda.jit(device=True)
+def complete_neighbourhood(referencePyramidLevel, alternatePyramidLevel, patch_pos_y, patch_pos_x,
+                           tileSize, flow_y, flow_x, l2_dist, ref_loaded, local_ref, neighbourhood):
+    """
+    Computes the distances of the 3x3 neighbourhood of the shift
+    (flow_y, flow_x) that are missing (NaN).
+    """
+    single_chunk = tileSize <= CHUNK_SIZE
+    for i in range(3):
+        for j in range(3):
+            if math.isnan(neighbourhood[i, j]):
+                if single_chunk and not ref_loaded:
+                    load_chunk(referencePyramidLevel, patch_pos_y, patch_pos_x, tileSize, tileSize, local_ref)
+                    ref_loaded = True
+                neighbourhood[i, j] = patch_dist(referencePyramidLevel, alternatePyramidLevel,
+                                                 patch_pos_y, patch_pos_x, tileSize,
+                                                 flow_y + i - 1, flow_x + j - 1,
+                                                 l2_dist, ref_loaded, local_ref)
 
 
+def subpixel_refinement(referencePyramidLevel, alternatePyramidLevel,
+                        tileSize, alignments, distance, neighbourhoods=None):
+    """
+    Refines the integer alignments by fitting a 2D quadratic to the 3x3
+    distance surface around the best shift, as in the original HDR+ block
+    matching. The alignments are updated in place.
+
+    Parameters
+    ----------
+    neighbourhoods : device Array[n_patchs_y, n_patchs_x, 3, 3], optional
+        Distances of the 3x3 shifts around the best one, as stored by the
+        brute force search. Only the missing (NaN) distances are computed.
+        If None, the 9 distances are computed.
+
+    """
+    n_patchs_y, n_patchs_x, _ = alignments.shape
+    
+    if neighbourhoods is None:
+        neighbourhoods = cuda.to_device(np.full((n_patchs_y, n_patchs_x, 3, 3), np.nan,
+                                                dtype=DEFAULT_NUMPY_FLOAT_TYPE))
+    
+    threadsperblock = (DEFAULT_THREADS, DEFAULT_THREADS)
+    blockspergrid_x = math.ceil(n_patchs_x/threadsperblock[1])
+    blockspergrid_y = math.ceil(n_patchs_y/threadsperblock[0])
+    blockspergrid = (blockspergrid_x, blockspergrid_y)
+    
+    cuda_subpixel_refinement[blockspergrid, threadsperblock](
+        referencePyramidLevel, alternatePyramidLevel,
+        tileSize, distance == 'L2', neighbourhoods, alignments)
+
+@cuda.jit
+def cuda_subpixel_refinement(referencePyramidLevel, alternatePyramidLevel,
+                             tileSize, l2_dist, neighbourhoods, alignments):
+    n_patchs_y, n_patchs_x, _ = alignments.shape
+    tile_x, tile_y = cuda.grid(2)
+    if not(0 <= tile_y < n_patchs_y and
+           0 <= tile_x < n_patchs_x):
+        return
+    
+    flow_x = int(alignments[tile_y, tile_x, 0])
+    flow_y = int(alignments[tile_y, tile_x, 1])
+    
+    patch_pos_x = tile_x * tileSize
+    patch_pos_y = tile_y * tileSize
+    
+    # distances of the 3x3 shifts around the best one
+    dists = cuda.local.array((3, 3), DEFAULT_CUDA_FLOAT_TYPE)
+    for i in range(3):
+        for j in range(3):
+            dists[i, j] = neighbourhoods[tile_y, tile_x, i, j]
+    
+    local_ref = cuda.local.array((CHUNK_SIZE, CHUNK_SIZE), DEFAULT_CUDA_FLOAT_TYPE)
+    complete_neighbourhood(referencePyramidLevel, alternatePyramidLevel, patch_pos_y, patch_pos_x,
+                           tileSize, flow_y, flow_x, l2_dist, False, local_ref, dists)
+    
+    # Least square fit of D(x, y) = a x^2 + b y^2 + c xy + d x + e y + f
+    # on the 3x3 grid. The coefficients have a closed form.
+    sum_x_border = 0
+    sum_x_center = 0
+    sum_y_border = 0
+    sum_y_center = 0
+    sum_xD = 0
+    sum_yD = 0
+    sum_xyD = 0
+    for i in range(3):
+        for j in range(3):
+            D = dists[i, j]
+            if D == math.inf:
+                # the neighbourhood is partly outside of the image
+                return
+            x = j - 1
+            y = i - 1
+            if x == 0:
+                sum_x_center += D
+            else:
+                sum_x_border += D
+            if y == 0:
+                sum_y_center += D
+            else:
+                sum_y_border += D
+            sum_xD += x*D
+            sum_yD += y*D
+            sum_xyD += x*y*D
+    
+    a = (sum_x_border - 2*sum_x_center)/6
+    b = (sum_y_border - 2*sum_y_center)/6
+    c = sum_xyD/4
+    d = sum_xD/6
+    e = sum_yD/6
+    
+    # The minimum solves [[2a, c], [c, 2b]] [x, y] = -[d, e], and only
+    # exists if the quadratic is positive definite
+    det = 4*a*b - c*c
+    if not (a > 0 and det > 0):
+        return
+    
+    subpixel_x = (-2*b*d + c*e)/det
+    subpixel_y = (-2*a*e + c*d)/det
+    
+    # The integer shift was the best one : the refinement cannot exceed half a pixel
+    alignments[tile_y, tile_x, 0] = flow_x + clamp(subpixel_x, -0.5, 0.5)
+    alignments[tile_y, tile_x, 1] = flow_y + clamp(subpixel_y, -0.5, 0.5)
+
 def local_search(referencePyramidLevel, alternatePyramidLevel,
                  tileSize, searchRadius,
-                 upsampledAlignments, distance):
+                 upsampledAlignments, distance, searchEngine='brute force',
+                 neighbourhoods=None):
+    """
+    Searches the best shift of every tile within searchRadius around the
+    upsampled alignments, which are updated in place.
+
+    If neighbourhoods (device Array[n_patchs_y, n_patchs_x, 3, 3]) is given,
+    the brute force search stores the distances of the 3x3 shifts around
+    the best one, for the subpixel refinement. The other engines leave it
+    untouched.
+
+    Returns
+    -------
+    skipped_fraction : float or None
+        Fraction of the pixel distances that were not computed, for the
+        'partial distance' engine. None for the other engines.
+
+    """
+    if searchEngine == 'partial distance':
+        return partial_distance_local_search(referencePyramidLevel, alternatePyramidLevel,
+                                             tileSize, searchRadius,
+                                             upsampledAlignments, distance)
+    elif searchEngine == 'sliding sum':
+        sliding_sum_local_search(referencePyramidLevel, alternatePyramidLevel,
+                                 tileSize, searchRadius,
+                                 upsampledAlignments, distance)
+        return
+    elif searchEngine == 'FFT':
+        fft_local_search(referencePyramidLevel, alternatePyramidLevel,
+                         tileSize, searchRadius,
+                         upsampledAlignments, distance)
+        return
+    elif searchEngine != 'brute force':
+        raise ValueError('Unknown search engine : {}'.format(searchEngine))
 
     h, w, _ = upsampledAlignments.shape
     
@@ -426,21 +765,79 @@ def local_search(referencePyramidLevel, alternatePyramidLevel,
     blockspergrid_y = math.ceil(h/threadsperblock[0])
     blockspergrid = (blockspergrid_x, blockspergrid_y)
 
-    if distance == 'L1':
-        cuda_L1_local_search[blockspergrid, threadsperblock](referencePyramidLevel, alternatePyramidLevel,
-                                                      tileSize, searchRadius,
-                                                      upsampledAlignments)
-    elif distance == 'L2':
-        cuda_L2_local_search[blockspergrid, threadsperblock](referencePyramidLevel, alternatePyramidLevel,
-                                                      tileSize, searchRadius,
-                                                      upsampledAlignments)
-    else:
+    if distance not in ('L1', 'L2'):
         raise ValueError('Unknown distance : {}'.format(distance))
+    
+    store_neighbourhoods = neighbourhoods is not None
+    if not store_neighbourhoods:
+        # dummy array, numba needs a typed argument
+        neighbourhoods = cuda.device_array((1, 1, 3, 3), DEFAULT_NUMPY_FLOAT_TYPE)
+    
+    cuda_local_search[blockspergrid, threadsperblock](referencePyramidLevel, alternatePyramidLevel,
+                                                      tileSize, searchRadius, distance == 'L2',
+                                                      upsampledAlignments,
+                                                      store_neighbourhoods, neighbourhoods)
         
-        
+def get_spiral_order(searchRadius):
+    """
+    Returns the shifts of the search window sorted by their distance to the
+    center, so that the most likely shifts are evaluated first.
+
+    Returns
+    -------
+    spiral : Array[(2r+1)^2, 2]
+        Shifts (y, x)
+
+    """
+    shifts = [(y, x) for y in range(-searchRadius, searchRadius + 1)
+                     for x in range(-searchRadius, searchRadius + 1)]
+    # sort is stable : the scan order is kept within a ring
+    shifts.sort(key=lambda shift: (max(abs(shift[0]), abs(shift[1])),
+                                   shift[0]*shift[0] + shift[1]*shift[1]))
+    return np.array(shifts, dtype=np.int32)
+
+def partial_distance_local_search(referencePyramidLevel, alternatePyramidLevel,
+                                  tileSize, searchRadius,
+                                  upsampledAlignments, distance):
+    """
+    Same search as cuda_local_search, but the
+    candidate shifts are evaluated in a spiral order starting from the
+    upsampled alignment, and the distance of a candidate is aborted as soon
+    as it exceeds the best distance found so far. The selected shifts are
+    the same as the ones of the brute force search.
+
+    Returns
+    -------
+    skipped_fraction : float
+        Fraction of the pixel distances that were not computed.
+
+    """
+    if distance not in ['L1', 'L2']:
+        raise ValueError('Unknown distance : {}'.format(distance))
+    
+    n_patchs_y, n_patchs_x, _ = upsampledAlignments.shape
+    spiral = cuda.to_device(get_spiral_order(searchRadius))
+    
+    # number of pixel distances computed
+    counter = cuda.to_device(np.zeros(1, dtype=np.int64))
+    
+    threadsperblock = (DEFAULT_THREADS, DEFAULT_THREADS)
+    blockspergrid_x = math.ceil(n_patchs_x/threadsperblock[1])
+    blockspergrid_y = math.ceil(n_patchs_y/threadsperblock[0])
+    blockspergrid = (blockspergrid_x, blockspergrid_y)
+    
+    cuda_partial_distance_local_search[blockspergrid, threadsperblock](
+        referencePyramidLevel, alternatePyramidLevel,
+        tileSize, searchRadius, spiral, distance == 'L2',
+        upsampledAlignments, counter)
+    
+    n_total = n_patchs_y * n_patchs_x * tileSize**2 * (2*searchRadius + 1)**2
+    return 1 - int(counter.copy_to_host()[0]) / max(1, n_total)
+
 @cuda.jit
-def cuda_L1_local_search(referencePyramidLevel, alternatePyramidLevel,
-                         tileSize, searchRadius, upsampledAlignments):
+def cuda_partial_distance_local_search(referencePyramidLevel, alternatePyramidLevel,
+                                       tileSize, searchRadius, spiral, l2_dist,
+                                       upsampledAlignments, counter):
     n_patchs_y, n_patchs_x, _ = upsampledAlignments.shape
     h, w = alternatePyramidLevel.shape
     tile_x, tile_y = cuda.grid(2)
@@ -448,56 +845,218 @@ def cuda_L1_local_search(referencePyramidLevel, alternatePyramidLevel,
            0 <= tile_x < n_patchs_x):
         return
     
-    local_flow = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
-    local_flow[0] = upsampledAlignments[tile_y, tile_x, 0]
-    local_flow[1] = upsampledAlignments[tile_y, tile_x, 1]
+    flow_x = int(upsampledAlignments[tile_y, tile_x, 0])
+    flow_y = int(upsampledAlignments[tile_y, tile_x, 1])
 
     # position of the pixel in the top left corner of the patch
     patch_pos_x = tile_x * tileSize
     patch_pos_y = tile_y * tileSize
     
-    # TODO this should be rewritten to allow patchs bigger than 32
-    local_ref = cuda.local.array((32, 32), DEFAULT_CUDA_FLOAT_TYPE)
-    for i in range(tileSize):
-        for j in range(tileSize):
-            idx = patch_pos_x + j
-            idy = patch_pos_y + i
-            local_ref[i, j] = referencePyramidLevel[idy, idx]
-        
-    min_dist = +1/0 #init as infty
+    n_shifts = 2*searchRadius + 1
+    n_computed = 0
+    
+    min_dist = math.inf
+    # index of the best shift in the scan order of the brute force search,
+    # used to solve ties the same way
+    min_scan_id = n_shifts*n_shifts
     min_shift_y = 0
     min_shift_x = 0
-    # window search
+    for spiral_id in range(n_shifts*n_shifts):
+        search_shift_y = spiral[spiral_id, 0]
+        search_shift_x = spiral[spiral_id, 1]
+        scan_id = (search_shift_y + searchRadius)*n_shifts + search_shift_x + searchRadius
+        
+        pos_y = patch_pos_y + flow_y + search_shift_y
+        pos_x = patch_pos_x + flow_x + search_shift_x
+        # the distance is infinite if the patch is not entirely in the image
+        if not (0 <= pos_y and pos_y + tileSize <= h and
+                0 <= pos_x and pos_x + tileSize <= w):
+            continue
+        
+        dist = 0
+        for i in range(tileSize):
+            for j in range(tileSize):
+                diff = referencePyramidLevel[patch_pos_y + i, patch_pos_x + j] - alternatePyramidLevel[pos_y + i, pos_x + j]
+                if l2_dist:
+                    dist += diff*diff
+                else:
+                    dist += abs(diff)
+            n_computed += tileSize
+            # the candidate cannot beat the best one anymore
+            if dist > min_dist:
+                break
+        
+        if dist < min_dist or (dist == min_dist and scan_id < min_scan_id):
+            min_dist = dist
+            min_scan_id = scan_id
+            min_shift_y = search_shift_y
+            min_shift_x = search_shift_x
+    
+    cuda.atomic.add(counter, 0, n_computed)
+    
+    upsampledAlignments[tile_y, tile_x, 0] = flow_x + min_shift_x
+    upsampledAlignments[tile_y, tile_x, 1] = flow_y + min_shift_y
+    
+def as_tensor(array):
+    """
+    Returns a torch view of a numba device array, or of a numpy array, so
+    that the same code can run on GPU or on CPU.
+
+    """
+    if cuda.is_cuda_array(array):
+        return torch.as_tensor(array, device="cuda")
+    return torch.as_tensor(array)
+
+def sliding_sum_local_search(referencePyramidLevel, alternatePyramidLevel,
+                             tileSize, searchRadius,
+                             upsampledAlignments, distance):
+    """
+    Same search as cuda_local_search, but the
+    loop on the candidate shifts is the outer one : for each shift, the
+    difference image between the reference level and the alternate level
+    warped by the (tile-wise constant) alignments is computed for the whole
+    level at once, and summed on the tile grid. The cost is then independent
+    of the tile size, and the memory accesses are coalesced.
+
+    The tiles form a regular grid, so the summed-area lookup reduces to a
+    sum over the tile axes, which also avoids the precision loss of float32
+    integral images on large levels.
+
+    The arrays can either be numba device arrays or numpy arrays, in which
+    case the search is run on CPU. upsampledAlignments is updated in place.
+
+    """
+    th_ref = as_tensor(referencePyramidLevel).to(DEFAULT_TORCH_FLOAT_TYPE)
+    th_alt = as_tensor(alternatePyramidLevel).to(DEFAULT_TORCH_FLOAT_TYPE)
+    th_alignments = as_tensor(upsampledAlignments)
+    device = th_alignments.device
+    
+    n_patchs_y, n_patchs_x, _ = th_alignments.shape
+    h, w = th_alt.shape
+    
+    th_ref = th_ref[:n_patchs_y*tileSize, :n_patchs_x*tileSize]
+    
+    # Pixelwise initial positions in the alternate level
+    flows = th_alignments.to(torch.int64)
+    flows = flows.repeat_interleave(tileSize, dim=0).repeat_interleave(tileSize, dim=1)
+    ys = torch.arange(n_patchs_y*tileSize, device=device)[:, None] + flows[:, :, 1]
+    xs = torch.arange(n_patchs_x*tileSize, device=device)[None, :] + flows[:, :, 0]
+    
+    min_dist = torch.full((n_patchs_y, n_patchs_x), float('inf'), dtype=DEFAULT_TORCH_FLOAT_TYPE, device=device)
+    min_shift_y = torch.zeros((n_patchs_y, n_patchs_x), dtype=th_alignments.dtype, device=device)
+    min_shift_x = torch.zeros((n_patchs_y, n_patchs_x), dtype=th_alignments.dtype, device=device)
+    
+    # same scan order as the brute force search, so that ties are solved the same way
     for search_shift_y in range(-searchRadius, searchRadius + 1):
+        new_ys = ys + search_shift_y
+        valid_y = (new_ys >= 0) & (new_ys < h)
+        new_ys = new_ys.clamp(0, h - 1)
         for search_shift_x in range(-searchRadius, searchRadius + 1):
-            # computing dist
-            dist = 0
-            for i in range(tileSize):
-                for j in range(tileSize):
-                    new_idx = patch_pos_x + j + int(local_flow[0]) + search_shift_x
-                    new_idy = patch_pos_y + i + int(local_flow[1]) + search_shift_y
-                    
-                    if (0 <= new_idx < w and
-                        0 <= new_idy < h):
-                        diff = local_ref[i, j] - alternatePyramidLevel[new_idy, new_idx]
-                        dist += abs(diff)
-                    else:
-                        dist = +1/0
-                    
-                    
-            if dist < min_dist :
-                min_dist = dist
-                min_shift_y = search_shift_y
-                min_shift_x = search_shift_x
+            new_xs = xs + search_shift_x
+            valid = valid_y & (new_xs >= 0) & (new_xs < w)
+            new_xs = new_xs.clamp(0, w - 1)
+            
+            diff = th_ref - th_alt[new_ys, new_xs]
+            if distance == 'L1':
+                diff = diff.abs()
+            elif distance == 'L2':
+                diff = diff*diff
+            else:
+                raise ValueError('Unknown distance : {}'.format(distance))
+            
+            # A tile that is partly outside of the image has an infinite distance
+            diff = torch.where(valid, diff, float('inf'))
+            dist = diff.reshape(n_patchs_y, tileSize, n_patchs_x, tileSize).sum(dim=(1, 3))
+            
+            better = dist < min_dist
+            min_dist = torch.where(better, dist, min_dist)
+            min_shift_y[better] = search_shift_y
+            min_shift_x[better] = search_shift_x
     
-    upsampledAlignments[tile_y, tile_x, 0] = local_flow[0] + min_shift_x
-    upsampledAlignments[tile_y, tile_x, 1] = local_flow[1] + min_shift_y
+    th_alignments[:, :, 0] += min_shift_x
+    th_alignments[:, :, 1] += min_shift_y
+
+def fft_local_search(referencePyramidLevel, alternatePyramidLevel,
+                     tileSize, searchRadius,
+                     upsampledAlignments, distance):
+    """
+    Same search as cuda_local_search with the L2 distance, but the whole
+    distance surface of each tile is obtained at once, with
+        ||R - A_s||^2 = ||R||^2 - 2 <R, A_s> + ||A_s||^2
+    where the correlation <R, A_s> is computed for every shift s by FFT,
+    batched over all the tiles, and ||A_s||^2 with box sums. The cost grows
+    with log(searchRadius) instead of searchRadius^2, which pays off for
+    the large search radii of the coarse levels.
+
+    Only the L2 distance can be computed this way. The arrays can either be
+    numba device arrays or numpy arrays, in which case the search is run on
+    CPU. upsampledAlignments is updated in place.
+
+    """
+    if distance != 'L2':
+        raise ValueError('The FFT search engine only supports the L2 distance, got {}'.format(distance))
     
+    th_ref = as_tensor(referencePyramidLevel).to(DEFAULT_TORCH_FLOAT_TYPE)
+    th_alt = as_tensor(alternatePyramidLevel).to(DEFAULT_TORCH_FLOAT_TYPE)
+    th_alignments = as_tensor(upsampledAlignments)
+    device = th_alignments.device
+    
+    n_patchs_y, n_patchs_x, _ = th_alignments.shape
+    h, w = th_alt.shape
+    window_size = tileSize + 2*searchRadius
+    n_shifts = 2*searchRadius + 1
+    
+    # Reference tiles [n_patchs, Ts, Ts]
+    ref_tiles = th_ref[:n_patchs_y*tileSize, :n_patchs_x*tileSize]
+    ref_tiles = ref_tiles.reshape(n_patchs_y, tileSize, n_patchs_x, tileSize).transpose(1, 2)
+    ref_tiles = ref_tiles.reshape(-1, tileSize, tileSize)
+    
+    # Search windows of the alternate level [n_patchs, Ts + 2r, Ts + 2r]
+    flows = th_alignments.to(torch.int64).reshape(-1, 2)
+    tile_ids = torch.arange(n_patchs_y*n_patchs_x, device=device)
+    window_range = torch.arange(window_size, device=device) - searchRadius
+    ys = ((tile_ids // n_patchs_x)*tileSize + flows[:, 1])[:, None] + window_range[None, :]
+    xs = ((tile_ids % n_patchs_x)*tileSize + flows[:, 0])[:, None] + window_range[None, :]
+    valid = (((ys >= 0) & (ys < h))[:, :, None] &
+             ((xs >= 0) & (xs < w))[:, None, :])
+    windows = th_alt[ys.clamp(0, h - 1)[:, :, None], xs.clamp(0, w - 1)[:, None, :]]
+    windows = torch.where(valid, windows, 0.)
+    
+    # Correlation for every shift. Ref tiles are zero padded to the window
+    # size : the circular correlation does not wrap for shifts in [0, 2r].
+    fft_windows = torch.fft.rfft2(windows)
+    fft_ref = torch.fft.rfft2(ref_tiles, s=(window_size, window_size))
+    correlation = torch.fft.irfft2(fft_windows * fft_ref.conj(), s=(window_size, window_size))
+    correlation = correlation[:, :n_shifts, :n_shifts]
+    
+    # Box sums of the squared windows, and of the pixels outside of the image
+    def box_sums(images):
+        integral = F.pad(images.cumsum(1).cumsum(2), (1, 0, 1, 0))
+        return (integral[:, tileSize:, tileSize:] - integral[:, :n_shifts, tileSize:]
+                - integral[:, tileSize:, :n_shifts] + integral[:, :n_shifts, :n_shifts])
+    
+    window_energy = box_sums(windows*windows)
+    n_invalid = box_sums((~valid).to(DEFAULT_TORCH_FLOAT_TYPE))
+    ref_energy = (ref_tiles*ref_tiles).sum(dim=(1, 2))
+    
+    dist = ref_energy[:, None, None] - 2*correlation + window_energy
+    # A tile that is partly outside of the image has an infinite distance
+    dist = torch.where(n_invalid > 0.5, float('inf'), dist)
+    
+    # argmin returns the first minimum, in the scan order of the brute force search
+    best_shift = dist.reshape(-1, n_shifts*n_shifts).argmin(dim=1)
+    all_invalid = torch.isinf(dist.reshape(-1, n_shifts*n_shifts)).all(dim=1)
+    min_shift_y = torch.where(all_invalid, 0, best_shift // n_shifts - searchRadius)
+    min_shift_x = torch.where(all_invalid, 0, best_shift % n_shifts - searchRadius)
+    
+    th_alignments[:, :, 0] += min_shift_x.reshape(n_patchs_y, n_patchs_x).to(th_alignments.dtype)
+    th_alignments[:, :, 1] += min_shift_y.reshape(n_patchs_y, n_patchs_x).to(th_alignments.dtype)
+
 @cuda.jit
-def cuda_L2_local_search(referencePyramidLevel, alternatePyramidLevel,
-                         tileSize, searchRadius, upsampledAlignments):
+def cuda_local_search(referencePyramidLevel, alternatePyramidLevel,
+                      tileSize, searchRadius, l2_dist, upsampledAlignments,
+                      store_neighbourhoods, neighbourhoods):
     n_patchs_y, n_patchs_x, _ = upsampledAlignments.shape
-    h, w = alternatePyramidLevel.shape
     tile_x, tile_y = cuda.grid(2)
     if not(0 <= tile_y < n_patchs_y and
            0 <= tile_x < n_patchs_x):
@@ -506,45 +1065,67 @@ def cuda_L2_local_search(referencePyramidLevel, alternatePyramidLevel,
     local_flow = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
     local_flow[0] = upsampledAlignments[tile_y, tile_x, 0]
     local_flow[1] = upsampledAlignments[tile_y, tile_x, 1]
+    flow_x = int(local_flow[0])
+    flow_y = int(local_flow[1])
 
     # position of the pixel in the top left corner of the patch
     patch_pos_x = tile_x * tileSize
     patch_pos_y = tile_y * tileSize
     
-    # TODO this should be rewritten to allow patchs bigger than 32
-    local_ref = cuda.local.array((32, 32), DEFAULT_CUDA_FLOAT_TYPE)
-    for i in range(tileSize):
-        for j in range(tileSize):
-            idx = patch_pos_x + j
-            idy = patch_pos_y + i
-            local_ref[i, j] = referencePyramidLevel[idy, idx]
-        
-    min_dist = +1/0 #init as infty
+    # A patch fitting in a single chunk is loaded once for the whole window.
+    # Bigger patchs are streamed chunk by chunk for every shift, so that the
+    # best shift is tracked while scanning and the search radius is not
+    # bounded.
+    local_ref = cuda.local.array((CHUNK_SIZE, CHUNK_SIZE), DEFAULT_CUDA_FLOAT_TYPE)
+    single_chunk = tileSize <= CHUNK_SIZE
+    if single_chunk:
+        load_chunk(referencePyramidLevel, patch_pos_y, patch_pos_x, tileSize, tileSize, local_ref)
+    
+    # Distances of the 3x3 shifts around the best one so far. The ones
+    # scanned before the best shift was found are missing (NaN), except
+    # the left one, and are computed at the end.
+    neighbourhood = cuda.local.array((3, 3), DEFAULT_CUDA_FLOAT_TYPE)
+    for i in range(3):
+        for j in range(3):
+            neighbourhood[i, j] = math.nan
+    
+    min_dist = math.inf
     min_shift_y = 0
     min_shift_x = 0
     # window search
     for search_shift_y in range(-searchRadius, searchRadius + 1):
+        prev_dist = math.nan
         for search_shift_x in range(-searchRadius, searchRadius + 1):
-            # computing dist
-            dist = 0
-            for i in range(tileSize):
-                for j in range(tileSize):
-                    new_idx = patch_pos_x + j + int(local_flow[0]) + search_shift_x
-                    new_idy = patch_pos_y + i + int(local_flow[1]) + search_shift_y
-                    
-                    if (0 <= new_idx < w and
-                        0 <= new_idy < h):
-                        diff = local_ref[i, j] - alternatePyramidLevel[new_idy, new_idx]
-                        dist += diff*diff
-                    else:
-                        dist = +1/0
-                    
-                    
+            dist = patch_dist(referencePyramidLevel, alternatePyramidLevel,
+                              patch_pos_y, patch_pos_x, tileSize,
+                              flow_y + search_shift_y, flow_x + search_shift_x,
+                              l2_dist, single_chunk, local_ref)
+            
             if dist < min_dist :
                 min_dist = dist
                 min_shift_y = search_shift_y
                 min_shift_x = search_shift_x
+                if store_neighbourhoods:
+                    for i in range(3):
+                        for j in range(3):
+                            neighbourhood[i, j] = math.nan
+                    neighbourhood[1, 0] = prev_dist
+                    neighbourhood[1, 1] = dist
+            elif (store_neighbourhoods and
+                  abs(search_shift_y - min_shift_y) <= 1 and
+                  abs(search_shift_x - min_shift_x) <= 1):
+                neighbourhood[search_shift_y - min_shift_y + 1,
+                              search_shift_x - min_shift_x + 1] = dist
+            prev_dist = dist
     
     upsampledAlignments[tile_y, tile_x, 0] = local_flow[0] + min_shift_x
     upsampledAlignments[tile_y, tile_x, 1] = local_flow[1] + min_shift_y
     
+    if store_neighbourhoods:
+        # the shifts of the previous row and outside of the window
+        complete_neighbourhood(referencePyramidLevel, alternatePyramidLevel, patch_pos_y, patch_pos_x,
+                               tileSize, flow_y + min_shift_y, flow_x + min_shift_x,
+                               l2_dist, single_chunk, local_ref, neighbourhood)
+        for i in range(3):
+            for j in range(3):
+                neighbourhoods[tile_y, tile_x, i, j] = neighbourhood[i, j]
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 20:26:51 2026
+
+This script contains a content-addressed cache of the intermediate results
+that do not depend on the merging parameters : the reference-side state
+(grey frame, pyramid, gradients, hessian and local stats), and for each
+compared frame its flow and its robustness map. When the same burst is
+processed several times with different merging parameters, only the
+kernels and the merge are computed again.
+
+The entries are addressed by a hash of the frames and of the subset of
+parameters they depend on. They are kept on the host in memory, with a
+least recently used eviction, and optionally saved on disk.
+
+
+@author: jamyl
+"""
+
+import os
+import json
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+META_KEY = '__meta__'
+
+# Parameters on which each cached result depends
+REFERENCE_PARAMS = ['mode', 'grey method', 'block matching', 'kanade', 'robustness']
+ALIGNMENT_PARAMS = ['mode', 'grey method', 'block matching', 'kanade',
+                    'global motion', 'temporal prior', 'frame rejection']
+ROBUSTNESS_PARAMS = ['mode', 'robustness', 'frame rejection']
+# Parameters on which a saved accumulator state depends : a burst can only
+# be extended with the same ones
+STATE_PARAMS = ['mode', 'grey method', 'scale', 'roi', 'block matching', 'kanade',
+                'robustness', 'merging', 'accumulated robustness denoiser']
+
+
+def hash_array(array):
+    """
+    Returns a hash of the content, shape and type of a host array.
+
+    """
+    array = np.ascontiguousarray(array)
+    h = hashlib.blake2b(digest_size=16)
+    h.update(str((array.shape, array.dtype.str)).encode())
+    h.update(array.view(np.uint8).data)
+    return h.hexdigest()
+
+def _to_jsonable(obj):
+    if isinstance(obj, np.ndarray):
+        return {'array' : hash_array(obj)}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+def select_params(params, names):
+    """
+    Returns the subset of the parameters on which a cached result depends.
+
+    """
+    return {name : params[name] for name in names}
+
+def make_key(*parts):
+    """
+    Returns the key of an entry, from any number of json serializable parts
+    (such as parameter dictionaries, hashes or arrays).
+
+    """
+    serialized = json.dumps(parts, sort_keys=True, default=_to_jsonable)
+    return hashlib.blake2b(serialized.encode(), digest_size=16).hexdigest()
+
+
+class ComputationCache:
+    def __init__(self, max_entries=64, path=None):
+        """
+        Parameters
+        ----------
+        max_entries : int, optional
+            Maximum number of entries kept in memory. The least recently used
+            entries are evicted first. The default is 64.
+        path : str, optional
+            If given, the entries are also saved in this directory, and
+            looked up there when they are not in memory. The default is None.
+
+        """
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()
+
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def __contains__(self, key):
+        return key in self._entries or (self.path is not None and
+                                        os.path.exists(self._file(key)))
+
+    def get(self, key):
+        """
+        Returns the entry of key, or None if it is not cached. An entry is a
+        dict whose values are host arrays, lists of host arrays or json
+        serializable objects.
+
+        """
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+        if self.path is not None and os.path.exists(self._file(key)):
+            entry = self._load(key)
+            self._insert(key, entry)
+            return entry
+
+        return None
+
+    def put(self, key, entry):
+        self._insert(key, entry)
+        if self.path is not None:
+            self._save(key, entry)
+
+    def _insert(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def _save(self, key, entry):
+        arrays = {}
+        meta = {}
+        for name, value in entry.items():
+            if isinstance(value, np.ndarray):
+                arrays[name] = value
+            elif isinstance(value, list) and len(value) > 0 and isinstance(value[0], np.ndarray):
+                for i, array in enumerate(value):
+                    arrays['{}/{}'.format(name, i)] = array
+                meta[name] = {'list' : len(value)}
+            else:
+                meta[name] = {'value' : value}
+        arrays[META_KEY] = np.array(json.dumps(meta))
+
+        # writing in a temporary file first, so that an interrupted save does
+        # not leave a corrupted entry
+        tmp_file = self._file(key) + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_file, self._file(key))
+
+    def _load(self, key):
+        with np.load(self._file(key)) as data:
+            meta = json.loads(str(data[META_KEY]))
+            entry = {name : data[name] for name in data.files
+                     if name != META_KEY and '/' not in name}
+            for name, value in meta.items():
+                if 'list' in value:
+                    entry[name] = [data['{}/{}'.format(name, i)] for i in range(value['list'])]
+                else:
+                    entry[name] = value['value']
+        return entry
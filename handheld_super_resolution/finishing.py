@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 17:08:45 2026
+
+This script contains the fused finishing stage : the normalisation of the
+accumulators, the color correction, the sharpening, the devignetting, the
+tone curve, the gamma compression and the quantization are done by a
+single CUDA kernel, that directly writes the final uint8 or uint16 image.
+
+Each block of threads processes a tile of the output. The color corrected
+tile and its halo are first loaded in shared memory, so that the gaussian
+blur of the unsharp mask can be computed tile-wise.
+
+Contrary to raw2rgb.postprocess(), the tone curve is the global smoothstep
+only : the Mertens exposure fusion cannot be computed tile-wise.
+
+
+@author: jamyl
+"""
+
+import math
+
+import numpy as np
+from numba import cuda
+
+from . import raw2rgb
+from .utils import clamp, DEFAULT_CUDA_FLOAT_TYPE, DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_THREADS
+
+# Maximum radius of the gaussian kernel of the unsharp mask. It is fixed,
+# since the size of the shared memory must be known at compile time.
+# It allows a sharpening radius (std of the gaussian) up to 3.
+MAX_SHARPENING_RADIUS = 12
+
+TILE_SIZE = DEFAULT_THREADS
+HALO_TILE_SIZE = TILE_SIZE + 2*MAX_SHARPENING_RADIUS
+
+GAMMA = 2.2
+
+
+def finish(handheld_output, raw, xyz2cam, params, den=None):
+    """
+    Applies the fused finishing stage to the output of the pipeline and
+    moves the final image to the host.
+
+    Parameters
+    ----------
+    handheld_output : device Array[s*imshape_y, s*imshape_x, 3]
+        Output of the pipeline. If den is given, it is the numerator of the
+        accumulators, and the normalisation is fused with the finishing.
+    raw : rawpy object
+        Reference raw file
+    xyz2cam : Array[3, 3]
+        Color matrix of the camera
+    params : dict
+        Post processing parameters
+    den : device Array[s*imshape_y, s*imshape_x, 3], optional
+        Denominator of the accumulators. The default is None.
+
+    Returns
+    -------
+    output_image : Array[s*imshape_y, s*imshape_x, 3]
+        uint8 or uint16 final image
+
+    """
+    if params['do color correction']:
+        rgb2cam = raw2rgb.get_color_matrix(raw, xyz2cam)
+        cam2rgb = np.linalg.inv(rgb2cam)
+    else:
+        cam2rgb = np.eye(3)
+
+    return fused_finishing(handheld_output, cam2rgb, params, den).copy_to_host()
+
+def get_sharpening_kernel(sigma):
+    """
+    Returns the 1D gaussian kernel used by the unsharp mask. It is truncated
+    at 4 sigmas, as in skimage.
+
+    """
+    radius = int(4*sigma + 0.5)
+    assert radius <= MAX_SHARPENING_RADIUS, \
+        "The sharpening radius cannot exceed {}".format(MAX_SHARPENING_RADIUS/4)
+
+    x = np.arange(-radius, radius+1)
+    kernel = np.exp(-0.5 * x**2 / sigma**2)
+    return (kernel / kernel.sum()).astype(DEFAULT_NUMPY_FLOAT_TYPE)
+
+def fused_finishing(num, cam2rgb, params, den=None):
+    """
+    Launches the fused finishing kernel.
+
+    Parameters
+    ----------
+    num : device Array[imshape_y, imshape_x, 3]
+        Image, or numerator of the accumulators if den is given.
+    cam2rgb : Array[3, 3]
+        Color correction matrix.
+    params : dict
+        Post processing parameters
+    den : device Array[imshape_y, imshape_x, 3], optional
+        Denominator of the accumulators. The default is None.
+
+    Returns
+    -------
+    output : device Array[imshape_y, imshape_x, 3]
+        uint8 or uint16 final image
+
+    """
+    imshape_y, imshape_x, _ = num.shape
+
+    normalize = den is not None
+    if not normalize:
+        # numba is strict on types and dimension : let's use a consistent
+        # object even when it is not used.
+        den = cuda.device_array((1, 1, 1), DEFAULT_NUMPY_FLOAT_TYPE)
+
+    do_sharpening = params['do sharpening']
+    if do_sharpening:
+        sharpening_kernel = get_sharpening_kernel(params['sharpening']['radius'])
+        amount = params['sharpening']['ammount']
+    else:
+        sharpening_kernel = np.ones(1, DEFAULT_NUMPY_FLOAT_TYPE)
+        amount = 0.
+
+    if params['bit depth'] == 8:
+        output = cuda.device_array((imshape_y, imshape_x, 3), np.uint8)
+    else:
+        output = cuda.device_array((imshape_y, imshape_x, 3), np.uint16)
+    max_value = 2**params['bit depth'] - 1
+
+    threadsperblock = (TILE_SIZE, TILE_SIZE)
+    blockspergrid_x = math.ceil(imshape_x/threadsperblock[1])
+    blockspergrid_y = math.ceil(imshape_y/threadsperblock[0])
+    blockspergrid = (blockspergrid_x, blockspergrid_y)
+
+    cuda_fused_finishing[blockspergrid, threadsperblock](
+        num, den, normalize,
+        cuda.to_device(cam2rgb.astype(DEFAULT_NUMPY_FLOAT_TYPE)),
+        do_sharpening, cuda.to_device(sharpening_kernel), amount,
+        params['do devignette'], params['do tonemapping'], params['do gamma'],
+        max_value, output)
+
+    return output
+
+@cuda.jit(device=True)
+def reflect(idx, size):
+    # scipy's 'reflect' mode : d c b a | a b c d | d c b a
+    if idx < 0:
+        idx = -idx - 1
+    elif idx >= size:
+        idx = 2*size - idx - 1
+    return clamp(idx, 0, size - 1)
+
+@cuda.jit
+def cuda_fused_finishing(num, den, normalize, cam2rgb,
+                         do_sharpening, sharpening_kernel, amount,
+                         do_devignette, do_tonemapping, do_gamma,
+                         max_value, output):
+    imshape_y, imshape_x, _ = num.shape
+    tx, ty = cuda.threadIdx.x, cuda.threadIdx.y
+    tile_x0 = cuda.blockIdx.x * TILE_SIZE
+    tile_y0 = cuda.blockIdx.y * TILE_SIZE
+    idx = tile_x0 + tx
+    idy = tile_y0 + ty
+
+    # color corrected tile and its halo
+    tile = cuda.shared.array((HALO_TILE_SIZE, HALO_TILE_SIZE, 3), DEFAULT_CUDA_FLOAT_TYPE)
+    # horizontally blurred tile
+    h_blurred = cuda.shared.array((HALO_TILE_SIZE, TILE_SIZE, 3), DEFAULT_CUDA_FLOAT_TYPE)
+
+    pixel = cuda.local.array(3, DEFAULT_CUDA_FLOAT_TYPE)
+    blurred = cuda.local.array(3, DEFAULT_CUDA_FLOAT_TYPE)
+
+    radius = sharpening_kernel.size // 2
+    halo = MAX_SHARPENING_RADIUS if do_sharpening else 0
+
+    #___ Loading the normalized and color corrected tile (and halo)
+    for i in range(ty, TILE_SIZE + 2*halo, TILE_SIZE):
+        y = reflect(tile_y0 - halo + i, imshape_y)
+        for j in range(tx, TILE_SIZE + 2*halo, TILE_SIZE):
+            x = reflect(tile_x0 - halo + j, imshape_x)
+
+            for c in range(3):
+                if normalize:
+                    pixel[c] = num[y, x, c] / den[y, x, c]
+                else:
+                    pixel[c] = num[y, x, c]
+
+            for c in range(3):
+                val = (cam2rgb[c, 0] * pixel[0] +
+                       cam2rgb[c, 1] * pixel[1] +
+                       cam2rgb[c, 2] * pixel[2])
+                tile[i, j, c] = clamp(val, 0., 1.)
+
+    cuda.syncthreads()
+
+    #___ Separable gaussian blur of the unsharp mask
+    if do_sharpening:
+        for i in range(ty, TILE_SIZE + 2*halo, TILE_SIZE):
+            for c in range(3):
+                acc = 0.
+                for k in range(-radius, radius + 1):
+                    acc += sharpening_kernel[k + radius] * tile[i, tx + halo + k, c]
+                h_blurred[i, tx, c] = acc
+
+        cuda.syncthreads()
+
+        for c in range(3):
+            acc = 0.
+            for k in range(-radius, radius + 1):
+                acc += sharpening_kernel[k + radius] * h_blurred[ty + halo + k, tx, c]
+            blurred[c] = acc
+
+    if not (0 <= idy < imshape_y and
+            0 <= idx < imshape_x):
+        return
+
+    #___ Pointwise operations
+    if do_devignette:
+        # same filter as raw2rgb.devignette()
+        if imshape_y > 1:
+            vy = abs(-imshape_y/imshape_x * math.pi/2 + idy * imshape_y/imshape_x * math.pi/(imshape_y - 1))
+        else:
+            vy = imshape_y/imshape_x * math.pi/2
+        if imshape_x > 1:
+            vx = abs(-math.pi/2 + idx * math.pi/(imshape_x - 1))
+        else:
+            vx = math.pi/2
+        vignette = 2 - math.cos(vy * vx)**4
+    else:
+        vignette = 1.
+
+    for c in range(3):
+        val = tile[ty + halo, tx + halo, c]
+        if do_sharpening:
+            val = clamp(val + (val - blurred[c]) * amount, 0., 1.)
+
+        val *= vignette
+
+        if do_tonemapping:
+            val = clamp(val, 0., 1.)
+            val = 3*val*val - 2*val*val*val
+
+        val = clamp(val, 0., 1.)
+        if do_gamma:
+            val = val ** (1/GAMMA)
+
+        output[idy, idx, c] = round(clamp(val, 0., 1.) * max_value)
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:41:12 2026
+
+This script contains the frame rejection procedure : a cheap quality gate
+applied to each compared frame J_n (n>1), so that blurry, misaligned or
+mostly rejected frames are dropped before the kernel estimation and the
+merge, which are the most expensive stages.
+
+Three criteria are checked, from the cheapest to the most expensive :
+    - The sharpness of the grey image G_n, relative to the one of G_1
+    - The global alignment residual after ICA, relative to the brightness of G_1
+    - The mean value of the robustness mask r_n
+
+
+@author: jamyl
+"""
+
+import math
+
+from numba import cuda
+import torch as th
+
+from .linalg import bilinear_interpolation
+from .utils import DEFAULT_CUDA_FLOAT_TYPE, DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_TORCH_FLOAT_TYPE, DEFAULT_THREADS
+
+
+def init_frame_rejection(ref_grey):
+    """
+    Computes the statistics of the reference grey image G_1 against which
+    the compared frames are evaluated.
+
+    Parameters
+    ----------
+    ref_grey : device Array[imshape_y, imshape_x]
+        Reference grey image G_1
+
+    Returns
+    -------
+    ref_sharpness : float
+        Sharpness of G_1
+    ref_brightness : float
+        Mean value of G_1
+
+    """
+    ref_sharpness = compute_sharpness(ref_grey)
+    ref_brightness = th.as_tensor(ref_grey, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda").mean().item()
+
+    return ref_sharpness, ref_brightness
+
+def compute_sharpness(grey_img):
+    """
+    Returns the mean energy of the finite differences of a grey image. Since
+    the grey image is low-passed, this is mostly driven by the image content
+    and drops when the frame is blurry.
+
+    Parameters
+    ----------
+    grey_img : device Array[imshape_y, imshape_x]
+        Grey image G_n
+
+    Returns
+    -------
+    sharpness : float
+
+    """
+    th_img = th.as_tensor(grey_img, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")
+
+    gradx = th_img[:, 1:] - th_img[:, :-1]
+    grady = th_img[1:, :] - th_img[:-1, :]
+
+    return (th.mean(gradx*gradx) + th.mean(grady*grady)).item()
+
+def compute_alignment_residual(comp_grey, ref_grey, flows, tile_size):
+    """
+    Returns the global alignment residual of the compared frame, defined
+    as the mean over tiles of the mean absolute difference between G_1(x)
+    and G_n(x + V_n(x)).
+
+    Parameters
+    ----------
+    comp_grey : device Array[imshape_y, imshape_x]
+        Compared grey image G_n
+    ref_grey : device Array[imshape_y, imshape_x]
+        Reference grey image G_1
+    flows : device Array[n_tiles_y, n_tiles_x, 2]
+        Patchwise flow V_n(p) outputed by ICA
+    tile_size : int
+        Tile size used for the alignment
+
+    Returns
+    -------
+    residual : float
+
+    """
+    n_tiles_y, n_tiles_x, _ = flows.shape
+    tile_residuals = cuda.device_array((n_tiles_y, n_tiles_x), DEFAULT_NUMPY_FLOAT_TYPE)
+
+    threadsperblock = (DEFAULT_THREADS, DEFAULT_THREADS)
+    blockspergrid_x = math.ceil(n_tiles_x/threadsperblock[1])
+    blockspergrid_y = math.ceil(n_tiles_y/threadsperblock[0])
+    blockspergrid = (blockspergrid_x, blockspergrid_y)
+
+    cuda_compute_alignment_residual[blockspergrid, threadsperblock](
+        comp_grey, ref_grey, flows, tile_size, tile_residuals)
+
+    # Tiles that are entirely warped outside of the image have a nan residual
+    th_tile_residuals = th.as_tensor(tile_residuals, device="cuda")
+
+    return th.nanmean(th_tile_residuals).item()
+
+@cuda.jit
+def cuda_compute_alignment_residual(comp_grey, ref_grey, flows, tile_size, tile_residuals):
+    patch_idx, patch_idy = cuda.grid(2)
+    imsize_y, imsize_x = comp_grey.shape
+    n_patchs_y, n_patchs_x, _ = flows.shape
+
+    if not(0 <= patch_idy < n_patchs_y and
+           0 <= patch_idx < n_patchs_x):
+        return
+
+    patch_pos_x = tile_size * patch_idx
+    patch_pos_y = tile_size * patch_idy
+
+    local_flow = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
+    local_flow[0] = flows[patch_idy, patch_idx, 0]
+    local_flow[1] = flows[patch_idy, patch_idx, 1]
+
+    buffer_val = cuda.local.array((2, 2), DEFAULT_CUDA_FLOAT_TYPE)
+    pos = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE) # y, x
+
+    residual = 0
+    n_pixels = 0
+    for i in range(tile_size):
+        for j in range(tile_size):
+            pixel_global_idx = patch_pos_x + j
+            pixel_global_idy = patch_pos_y + i
+
+            new_idx = local_flow[0] + pixel_global_idx
+            new_idy = local_flow[1] + pixel_global_idy
+
+            # -1 for bilinear interpolation
+            if (0 <= pixel_global_idx < imsize_x and
+                0 <= pixel_global_idy < imsize_y and
+                0 <= new_idx < imsize_x - 1 and
+                0 <= new_idy < imsize_y - 1):
+
+                normalised_pos_x, floor_x = math.modf(new_idx)
+                normalised_pos_y, floor_y = math.modf(new_idy)
+                floor_x = int(floor_x)
+                floor_y = int(floor_y)
+
+                pos[0] = normalised_pos_y
+                pos[1] = normalised_pos_x
+
+                buffer_val[0, 0] = comp_grey[floor_y, floor_x]
+                buffer_val[0, 1] = comp_grey[floor_y, floor_x + 1]
+                buffer_val[1, 0] = comp_grey[floor_y + 1, floor_x]
+                buffer_val[1, 1] = comp_grey[floor_y + 1, floor_x + 1]
+
+                comp_val = bilinear_interpolation(buffer_val, pos)
+
+                residual += abs(comp_val - ref_grey[pixel_global_idy, pixel_global_idx])
+                n_pixels += 1
+
+    if n_pixels > 0:
+        tile_residuals[patch_idy, patch_idx] = residual/n_pixels
+    else:
+        tile_residuals[patch_idy, patch_idx] = 0/0 # nan
+
+def check_sharpness(comp_grey, ref_sharpness, params):
+    """
+    Returns the reason of the rejection of G_n if it is too blurry compared
+    to G_1, None otherwise.
+
+    """
+    min_sharpness = params['tuning']['min sharpness']
+
+    sharpness = compute_sharpness(comp_grey)/ref_sharpness
+    if sharpness < min_sharpness:
+        return "sharpness {:.2f} < {:.2f}".format(sharpness, min_sharpness)
+    return None
+
+def check_alignment(comp_grey, ref_grey, ref_brightness, flows, params):
+    """
+    Returns the reason of the rejection of J_n if it could not be properly
+    aligned on J_1, None otherwise.
+
+    """
+    max_residual = params['tuning']['max residual']
+    tile_size = params['tuning']['tileSize']
+
+    residual = compute_alignment_residual(comp_grey, ref_grey, flows, tile_size)/ref_brightness
+
+    # a nan residual means that the frame was entirely aligned outside of the image
+    if not residual <= max_residual:
+        return "alignment residual {:.3f} > {:.3f}".format(residual, max_residual)
+    return None
+
+def check_robustness(robustness, params):
+    """
+    Returns the reason of the rejection of J_n if its robustness mask r_n
+    is almost everywhere null, None otherwise.
+
+    """
+    min_robustness = params['tuning']['min robustness']
+
+    mean_robustness = th.as_tensor(robustness, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda").mean().item()
+    if mean_robustness < min_robustness:
+        return "mean robustness {:.3f} < {:.3f}".format(mean_robustness, min_robustness)
+    return None
+
+def reject_frame(debug_dict, im_id, reason, verbose):
+    """
+    Reports the rejection of the compared image im_id+1 (the reference image
+    being the image 0), both in the debug dict and (if verbose) in the console.
+
+    """
+    debug_dict['rejected frames'].append({'frame': im_id+1,
+                                          'reason': reason})
+    if verbose:
+        print('Image {} rejected : {}'.format(im_id+1, reason))
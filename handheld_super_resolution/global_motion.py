@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 18:12:04 2026
+
+This script contains the global motion fast path of the registration : when
+the motion between two frames is nearly global (tripod, or small handheld
+shake on a static scene), a parametric model (affine or homography) is
+fitted on the alignments of the coarse levels of the pyramid. If the model
+explains these alignments well enough, the patchwise flow of the finest
+level is directly generated from it : the block matching of the finest
+level is skipped, and ICA only needs a few iterations to refine it.
+
+The model is fitted with an iteratively reweighted least squares (IRLS),
+so that a few outlying tiles (noise, small moving objects) do not bias it.
+
+
+@author: jamyl
+"""
+
+import time
+
+import numpy as np
+from numba import cuda
+
+from .block_matching import align_image_block_matching
+from .utils import getTime, DEFAULT_NUMPY_FLOAT_TYPE
+
+N_MODEL_PARAMS = {'affine' : 6,
+                  'homography' : 8}
+
+
+def align_image_global_motion(frame, referencePyramid, options, bm_params, params):
+    """
+    Aligns the coarse levels of the pyramid with block matching, and fits a
+    global model on the obtained alignments. If the residual of the fit is
+    low enough, the flow of the finest level is generated from the model.
+    Otherwise, the block matching of the finest level is resumed from the
+    coarse alignments, so that no work is lost.
+
+    Parameters
+    ----------
+    frame : GreyFrame
+        Grey frame of the image to be compared J_i (i>1)
+    referencePyramid : list [device Array]
+        Pyramid representation of the ref image J_1
+    options : dict
+        options.
+    bm_params : dict
+        Block matching parameters
+    params : dict
+        Global motion parameters
+
+    Returns
+    -------
+    alignments : device Array[n_patchs_y, n_patchs_x, 2]
+        Patchwise flow : V_n(p) for each patch (p)
+    global_fit : bool
+        Whether the alignments were generated from the global model.
+
+    """
+    currentTime, verbose = time.perf_counter(), options['verbose'] > 2
+
+    n_levels = len(referencePyramid)
+    # factors and tile sizes are described fine-to-coarse
+    factors = bm_params['tuning']['factors']
+    tileSizes = bm_params['tuning']['tileSizes']
+    level_factor = int(np.prod(factors[:2]))
+
+    coarse_alignments = align_image_block_matching(frame.pyramid, referencePyramid, options, bm_params,
+                                                   last_level=n_levels - 1)
+
+    model, residual = fit_global_motion(coarse_alignments.copy_to_host(), level_factor, tileSizes[1],
+                                        frame.imshape, params)
+    if verbose:
+        currentTime = getTime(currentTime, ' --- Fit global motion')
+        print(' --- Global motion residual : {}'.format(residual))
+
+    if model is not None and residual <= params['tuning']['max residual']:
+        tileSize = tileSizes[0]
+        n_tiles_y = referencePyramid[-1].shape[0] // tileSize
+        n_tiles_x = referencePyramid[-1].shape[1] // tileSize
+        flow = global_motion_flow(model, (n_tiles_y, n_tiles_x), tileSize)
+        return cuda.to_device(flow), True
+
+    alignments = align_image_block_matching(frame.pyramid, referencePyramid, options, bm_params,
+                                            first_level=n_levels - 1,
+                                            previous_alignments=coarse_alignments)
+    return alignments, False
+
+def fit_global_motion(alignments, level_factor, tile_size, imshape, params):
+    """
+    Fits a global model on the alignments of a coarse level of the pyramid,
+    using IRLS with Cauchy weights.
+
+    Parameters
+    ----------
+    alignments : Array[n_tiles_y, n_tiles_x, 2]
+        Alignments of the coarse level, in coarse pixels
+    level_factor : int
+        Downsampling factor between the finest level and the coarse level
+    tile_size : int
+        Tile size of the coarse level
+    imshape : tuple(int, int)
+        Shape of the finest level, without padding
+    params : dict
+        Global motion parameters
+
+    Returns
+    -------
+    model : Array[3, 3] or None
+        Homography (whose last row is [0, 0, 1] for an affine model) mapping
+        the finest level coordinates (x, y) of J_1 to the ones of J_n. None
+        if there are not enough tiles to fit the model.
+    residual : float
+        Mean distance between the alignments and the model, in coarse
+        pixels.
+
+    """
+    model_type = params['tuning']['model']
+    n_tiles_y, n_tiles_x, _ = alignments.shape
+
+    # tile centers, in finest level pixels
+    centers_y, centers_x = np.meshgrid(np.arange(n_tiles_y), np.arange(n_tiles_x), indexing='ij')
+    centers_x = level_factor * (centers_x * tile_size + tile_size/2)
+    centers_y = level_factor * (centers_y * tile_size + tile_size/2)
+
+    # Tiles overlapping the padding are not reliable
+    valid = ((np.arange(n_tiles_y)[:, None] + 1) * tile_size * level_factor <= imshape[0]) & \
+            ((np.arange(n_tiles_x)[None, :] + 1) * tile_size * level_factor <= imshape[1])
+
+    x = centers_x[valid]
+    y = centers_y[valid]
+    flow = alignments[valid].astype(np.float64) * level_factor
+
+    if x.size < N_MODEL_PARAMS[model_type]:
+        return None, np.inf
+
+    # Normalising the coordinates for the conditioning of the system
+    center_x, center_y = imshape[1]/2, imshape[0]/2
+    norm = max(imshape)/2
+    xn = (x - center_x)/norm
+    yn = (y - center_y)/norm
+    xn_p = (x + flow[:, 0] - center_x)/norm
+    yn_p = (y + flow[:, 1] - center_y)/norm
+
+    weights = np.ones_like(xn)
+    for _ in range(params['tuning']['IRLS iter']):
+        normalised_model = solve_model(xn, yn, xn_p, yn_p, weights, model_type)
+        errors = np.hypot(*(apply_model(normalised_model, xn, yn) - np.stack((xn_p, yn_p))))
+
+        # Cauchy weights, with a scale robustly estimated from the errors.
+        # The scale cannot be lower than the quantization of the alignments.
+        scale = max(1.4826 * np.median(errors), 0.5 * level_factor/norm)
+        weights = 1/(1 + (errors/scale)**2)
+
+    # Going back to pixel coordinates
+    to_normalised = np.array([[1/norm, 0, -center_x/norm],
+                              [0, 1/norm, -center_y/norm],
+                              [0, 0, 1]])
+    model = np.linalg.inv(to_normalised) @ normalised_model @ to_normalised
+
+    residual = np.mean(errors) * norm/level_factor
+
+    return model, residual
+
+def solve_model(x, y, x_p, y_p, weights, model_type):
+    """
+    Solves the weighted least squares problem of the model fitting. The
+    homography is linearised (DLT), with its last coefficient set to 1.
+
+    """
+    n = x.size
+    zeros = np.zeros(n)
+    ones = np.ones(n)
+
+    if model_type == 'affine':
+        A = np.concatenate((np.stack((x, y, ones, zeros, zeros, zeros), axis=1),
+                            np.stack((zeros, zeros, zeros, x, y, ones), axis=1)))
+    else:
+        A = np.concatenate((np.stack((x, y, ones, zeros, zeros, zeros, -x*x_p, -y*x_p), axis=1),
+                            np.stack((zeros, zeros, zeros, x, y, ones, -x*y_p, -y*y_p), axis=1)))
+    b = np.concatenate((x_p, y_p))
+
+    sqrt_w = np.sqrt(np.concatenate((weights, weights)))
+    h, *_ = np.linalg.lstsq(A * sqrt_w[:, None], b * sqrt_w, rcond=None)
+
+    model = np.eye(3)
+    model[:2] = h[:6].reshape(2, 3)
+    if model_type == 'homography':
+        model[2, :2] = h[6:]
+    return model
+
+def apply_model(model, x, y):
+    """
+    Maps the coordinates (x, y) with the model.
+
+    """
+    denom = model[2, 0] * x + model[2, 1] * y + model[2, 2]
+    x_p = (model[0, 0] * x + model[0, 1] * y + model[0, 2]) / denom
+    y_p = (model[1, 0] * x + model[1, 1] * y + model[1, 2]) / denom
+    return np.stack((x_p, y_p))
+
+def global_motion_flow(model, n_tiles, tile_size):
+    """
+    Generates the patchwise flow of the finest level from a global model,
+    by evaluating it at the center of each tile.
+
+    Parameters
+    ----------
+    model : Array[3, 3]
+        Global model
+    n_tiles : tuple(int, int)
+        Number of tiles of the finest level
+    tile_size : int
+        Tile size of the finest level
+
+    Returns
+    -------
+    flow : Array[n_tiles_y, n_tiles_x, 2]
+        Patchwise flow
+
+    """
+    centers_y, centers_x = np.meshgrid(np.arange(n_tiles[0]), np.arange(n_tiles[1]), indexing='ij')
+    centers_x = centers_x * tile_size + tile_size/2
+    centers_y = centers_y * tile_size + tile_size/2
+
+    x_p, y_p = apply_model(model, centers_x, centers_y)
+    flow = np.stack((x_p - centers_x, y_p - centers_y), axis=-1)
+
+    return np.ascontiguousarray(flow, dtype=DEFAULT_NUMPY_FLOAT_TYPE)
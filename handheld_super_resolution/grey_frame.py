@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 19:03:26 2026
+
+This script contains the grey frame structure : the grey image G_n of a
+frame is padded once to the tile grid, and this single buffer is shared by
+the block matching (its pyramid, whose finest level is the padded image
+itself) and by ICA (the unpadded view). For the reference frame, the
+gradients and the hessian used by ICA are also stored.
+
+
+@author: jamyl
+"""
+
+from numba import cuda
+
+from .block_matching import pad_image, compute_pyramid
+from .ICA import init_ICA
+from .utils import to_host
+
+
+class GreyFrame:
+    def __init__(self, padded, imshape, pyramid,
+                 gradx=None, grady=None, hessian=None):
+        """
+        Parameters
+        ----------
+        padded : device Array[padded_imshape_y, padded_imshape_x]
+            Grey image G_n, padded to a multiple of the tile size
+        imshape : tuple(int, int)
+            Shape of the grey image before padding
+        pyramid : list [device Array]
+            Pyramid of G_n used for block matching, coarse-to-fine
+        gradx, grady : device Array[imshape_y, imshape_x], optional
+            Gradients of G_n (reference only). The default is None.
+        hessian : device Array[n_tiles_y, n_tiles_x, 2, 2], optional
+            Hessian of G_n used by ICA (reference only). The default is None.
+
+        """
+        self.padded = padded
+        self.imshape = tuple(imshape)
+        self.pyramid = pyramid
+        self.gradx = gradx
+        self.grady = grady
+        self.hessian = hessian
+
+    def to_host(self):
+        """
+        Returns a dict of host arrays, from which the frame can be rebuilt
+        with from_host().
+
+        """
+        arrays = {'padded' : to_host(self.padded),
+                  'imshape' : list(self.imshape),
+                  'pyramid' : [to_host(level) for level in self.pyramid]}
+        for name in ['gradx', 'grady', 'hessian']:
+            if getattr(self, name) is not None:
+                arrays[name] = to_host(getattr(self, name))
+        return arrays
+
+    @classmethod
+    def from_host(cls, arrays):
+        """
+        Moves a frame returned by to_host() back to the GPU.
+
+        """
+        optional = [cuda.to_device(arrays[name]) if name in arrays else None
+                    for name in ['gradx', 'grady', 'hessian']]
+        return cls(cuda.to_device(arrays['padded']), arrays['imshape'],
+                   [cuda.to_device(level) for level in arrays['pyramid']],
+                   *optional)
+
+    @property
+    def grey(self):
+        """
+        Unpadded view of the grey image G_n.
+
+        """
+        return self.padded[:self.imshape[0], :self.imshape[1]]
+
+
+def init_grey_frame(grey, options, params, reference=False):
+    """
+    Pads the grey image and computes its pyramid and, for the reference,
+    its gradients and hessian.
+
+    Parameters
+    ----------
+    grey : device Array[imshape_y, imshape_x]
+        Grey image G_n
+    options : dict
+        options.
+    params : dict
+        parameters.
+    reference : bool, optional
+        Whether the frame is the reference frame. The default is False.
+
+    Returns
+    -------
+    frame : GreyFrame
+
+    """
+    tile_size = params['block matching']['tuning']['tileSizes'][0]
+    th_padded = pad_image(grey, tile_size)
+
+    pyramid = compute_pyramid(th_padded, options, params['block matching'])
+    frame = GreyFrame(cuda.as_cuda_array(th_padded[0, 0]), grey.shape, pyramid)
+
+    if reference:
+        frame.gradx, frame.grady, frame.hessian = init_ICA(frame.grey, options, params['kanade'])
+
+    return frame
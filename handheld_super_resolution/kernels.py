@@ -14,12 +14,13 @@ import math
 
 import numpy as np
 from numba import cuda
-import torch as th
-import torch.nn.functional as F
 
 from .linalg import get_eighen_elmts_2x2
-from .utils import clamp, DEFAULT_CUDA_FLOAT_TYPE, DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_TORCH_FLOAT_TYPE, DEFAULT_THREADS, getTime
-from .utils_image import compute_grey_images, GAT
+from .utils import clamp, EPSILON_DIV, DEFAULT_CUDA_FLOAT_TYPE, DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_THREADS, getTime
+
+TILE_SIZE = DEFAULT_THREADS
+# The gradients of a pixel use its 8 neighbours
+HALO_TILE_SIZE = TILE_SIZE + 2
 
 
 def estimate_kernels(img, options, params):
@@ -28,10 +29,15 @@ def estimate_kernels(img, options, params):
     Returns the kernels covariance matrices for the frame J_n, sampled at the
     center of every bayer quad (or at the center of every grey pixel in grey
     mode).
+    
+    The decimation to grey, the variance stabilization, the gradients, the
+    structure tensor and the covariances are computed by a single tiled
+    kernel, that reads the raw frame once. numpy frames are processed on the
+    CPU.
 
     Parameters
     ----------
-    img : device Array[imshape_y, imshape_x]
+    img : device Array[imshape_y, imshape_x] or Array[imshape_y, imshape_x]
         Raw image J_n
     options : dict
         options
@@ -42,11 +48,15 @@ def estimate_kernels(img, options, params):
             parameters driving the kernel shape
         params['noise'] : dict
             cointain noise model informations
+        params['kernel storage'] : {"covariance", "inverse"}
+            Whether the covariances or their inverses are stored
 
     Returns
     -------
-    covs : device Array[imshape_y//2, imshape_x//2, 2, 2]
-        Covariance matrices Omega_n, sampled at the center of each bayer quad.
+    covs : device Array[imshape_y//2, imshape_x//2, 3] or Array[imshape_y//2, imshape_x//2, 3]
+        Covariance matrices Omega_n (or their inverses), sampled at the center
+        of each bayer quad. Since they are symmetric, only the coefficients
+        [0, 0], [0, 1] and [1, 1] are stored.
 
     """    
     bayer_mode = params['mode']=='bayer'
@@ -59,72 +69,39 @@ def estimate_kernels(img, options, params):
     k_stretch = params['tuning']['k_stretch']
     k_shrink = params['tuning']['k_shrink']
     
+    store_inverse = params['kernel storage'] == 'inverse'
+    
     alpha = params['noise']['alpha']
     beta = params['noise']['beta']
     iso = params['noise']['ISO']/100
     
-    if verbose_3:
-        cuda.synchronize()
-        t1 = time.perf_counter()
-    
-    #__ Decimate to grey
-    if bayer_mode : 
-        img_grey = compute_grey_images(img, method="decimating")
-        
-        if verbose_3:
-            cuda.synchronize()
-            t1 = getTime(t1, "- Decimated Image")
-    else :
-        img_grey = img # no need to copy now, they will be copied to gpu later.
-        
-    grey_imshape_y, grey_imshape_x = grey_imshape = img_grey.shape
-    
-    #__ Performing Variance Stabilization Transform
-    
-    img_grey = GAT(img_grey, alpha, iso, beta)
+    if bayer_mode:
+        grey_imshape = img.shape[0]//2, img.shape[1]//2
+    else:
+        grey_imshape = img.shape
+    grey_imshape_y, grey_imshape_x = grey_imshape
     
-    if verbose_3:
-        cuda.synchronize()
-        t1 = getTime(t1, "- Variance Stabilized")
-        
-    #__ Computing grads
-    th_grey_img = th.as_tensor(img_grey, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")[None, None]
-    
-    
-    grad_kernel1 = np.array([[[[-0.5, 0.5]]],
-                              
-                              [[[ 0.5, 0.5]]]])
-    grad_kernel1 = th.as_tensor(grad_kernel1, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")
-    
-    grad_kernel2 = np.array([[[[0.5], 
-                                [0.5]]],
-                              
-                              [[[-0.5], 
-                                [0.5]]]])
-    grad_kernel2 = th.as_tensor(grad_kernel2, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")
-
-
-    tmp = F.conv2d(th_grey_img, grad_kernel1)
-    th_full_grad = F.conv2d(tmp, grad_kernel2, groups=2)
-    # The default padding mode reduces the shape of grey_img of 1 pixel in each
-    # direction, as expected
+    if isinstance(img, np.ndarray):
+        covs = cpu_estimate_kernels(img, bayer_mode, alpha, iso, beta,
+                                    k_detail, k_denoise, D_th, D_tr, k_stretch, k_shrink,
+                                    store_inverse)
+        return covs
     
-    cuda_full_grads = cuda.as_cuda_array(th_full_grad.squeeze().transpose(0,1).transpose(1, 2))
-    # shape [y, x, 2]
     if verbose_3:
         cuda.synchronize()
-        t1 = getTime(t1, "- Gradients computed")
+        t1 = time.perf_counter()
         
-    covs = cuda.device_array(grey_imshape + (2,2), DEFAULT_NUMPY_FLOAT_TYPE)
+    covs = cuda.device_array(grey_imshape + (3,), DEFAULT_NUMPY_FLOAT_TYPE)
 
-    threadsperblock = (DEFAULT_THREADS, DEFAULT_THREADS)
+    threadsperblock = (TILE_SIZE, TILE_SIZE)
     blockspergrid_x = math.ceil(grey_imshape_x/threadsperblock[1])
     blockspergrid_y = math.ceil(grey_imshape_y/threadsperblock[0])
     blockspergrid = (blockspergrid_x, blockspergrid_y)
     
-    cuda_estimate_kernel[blockspergrid, threadsperblock](cuda_full_grads,
+    cuda_estimate_kernel[blockspergrid, threadsperblock](img, bayer_mode,
+                                    alpha, iso, beta,
                                     k_detail, k_denoise, D_th, D_tr, k_stretch, k_shrink,
-                                    covs)  
+                                    store_inverse, covs)  
     if verbose_3:
         cuda.synchronize()
         t1 = getTime(t1, "- Covariances estimated")
@@ -132,13 +109,43 @@ def estimate_kernels(img, options, params):
     return covs
 
 @cuda.jit
-def cuda_estimate_kernel(full_grads,
+def cuda_estimate_kernel(img, bayer_mode,
+                         alpha, iso, beta,
                          k_detail, k_denoise,
                          D_th, D_tr,
                          k_stretch, k_shrink,
-                         covs):
-    pixel_idx, pixel_idy = cuda.grid(2)
-    imshape_y, imshape_x, _, _ = covs.shape
+                         store_inverse, covs):
+    imshape_y, imshape_x, _ = covs.shape
+    tx, ty = cuda.threadIdx.x, cuda.threadIdx.y
+    tile_x0 = cuda.blockIdx.x * TILE_SIZE
+    tile_y0 = cuda.blockIdx.y * TILE_SIZE
+    pixel_idx = tile_x0 + tx
+    pixel_idy = tile_y0 + ty
+    
+    # variance stabilized grey tile, with a halo of 1 pixel on each side
+    tile = cuda.shared.array((HALO_TILE_SIZE, HALO_TILE_SIZE), DEFAULT_CUDA_FLOAT_TYPE)
+    
+    #___ Loading the decimated and variance stabilized tile
+    for i in range(ty, HALO_TILE_SIZE, TILE_SIZE):
+        y = tile_y0 - 1 + i
+        for j in range(tx, HALO_TILE_SIZE, TILE_SIZE):
+            x = tile_x0 - 1 + j
+            if (0 <= y < imshape_y and
+                0 <= x < imshape_x):
+                if bayer_mode:
+                    c = (img[2*y, 2*x] + img[2*y, 2*x + 1] +
+                         img[2*y + 1, 2*x] + img[2*y + 1, 2*x + 1])/4
+                else:
+                    c = img[y, x]
+                
+                # Generalized Anscombe Transform
+                VST = alpha*c/iso + 3/8 * alpha*alpha + beta
+                VST = max(0, VST)
+                tile[i, j] = 2/alpha * iso*iso * math.sqrt(VST)
+            else:
+                tile[i, j] = 0
+    
+    cuda.syncthreads()
 
     if not(0 <= pixel_idy < imshape_y and
            0 <= pixel_idx < imshape_x) :
@@ -150,17 +157,23 @@ def cuda_estimate_kernel(full_grads,
     structure_tensor[1, 0] = 0
     structure_tensor[1, 1] = 0
     
-
+    # The gradients are computed at the corners of the grey pixels. There
+    # are imshape - 1 of them in each direction.
     for i in range(0, 2):
         for j in range(0, 2):
             x = pixel_idx - 1 + j
             y = pixel_idy - 1 + i
             
-            if (0 <= y < full_grads.shape[0] and
-                0 <= x < full_grads.shape[1]):
+            if (0 <= y < imshape_y - 1 and
+                0 <= x < imshape_x - 1):
+                # position of the top left pixel in the tile
+                ti = ty + i
+                tj = tx + j
                 
-                full_grad_x = full_grads[y, x, 0]
-                full_grad_y = full_grads[y, x, 1]
+                full_grad_x = 0.25*(tile[ti, tj+1] - tile[ti, tj] +
+                                    tile[ti+1, tj+1] - tile[ti+1, tj])
+                full_grad_y = 0.25*(tile[ti+1, tj] - tile[ti, tj] +
+                                    tile[ti+1, tj+1] - tile[ti, tj+1])
 
                 structure_tensor[0, 0] += full_grad_x * full_grad_x
                 structure_tensor[1, 0] += full_grad_x * full_grad_y
@@ -180,10 +193,24 @@ def cuda_estimate_kernel(full_grads,
     k_1_sq = k[0]*k[0]
     k_2_sq = k[1]*k[1]
     
-    covs[pixel_idy, pixel_idx, 0, 0] = k_1_sq*e1[0]*e1[0] + k_2_sq*e2[0]*e2[0]
-    covs[pixel_idy, pixel_idx, 0, 1] = k_1_sq*e1[0]*e1[1] + k_2_sq*e2[0]*e2[1] 
-    covs[pixel_idy, pixel_idx, 1, 0] = k_1_sq*e1[0]*e1[1] + k_2_sq*e2[0]*e2[1]
-    covs[pixel_idy, pixel_idx, 1, 1] = k_1_sq*e1[1]*e1[1] + k_2_sq*e2[1]*e2[1]
+    cov_00 = k_1_sq*e1[0]*e1[0] + k_2_sq*e2[0]*e2[0]
+    cov_01 = k_1_sq*e1[0]*e1[1] + k_2_sq*e2[0]*e2[1]
+    cov_11 = k_1_sq*e1[1]*e1[1] + k_2_sq*e2[1]*e2[1]
+    
+    if store_inverse:
+        det = cov_00*cov_11 - cov_01*cov_01
+        if abs(det) > EPSILON_DIV: # checking if cov is invertible
+            covs[pixel_idy, pixel_idx, 0] = cov_11/det
+            covs[pixel_idy, pixel_idx, 1] = -cov_01/det
+            covs[pixel_idy, pixel_idx, 2] = cov_00/det
+        else: # if not invertible, identity matrix
+            covs[pixel_idy, pixel_idx, 0] = 1
+            covs[pixel_idy, pixel_idx, 1] = 0
+            covs[pixel_idy, pixel_idx, 2] = 1
+    else:
+        covs[pixel_idy, pixel_idx, 0] = cov_00
+        covs[pixel_idy, pixel_idx, 1] = cov_01
+        covs[pixel_idy, pixel_idx, 2] = cov_11
 
     
 @cuda.jit(device=True)
@@ -230,3 +257,71 @@ def compute_k(l1, l2, k, k_detail, k_denoise, D_th, D_tr, k_stretch,
     k[1] = k_detail * ((1-D)*k2 + D*k_denoise)
 
 
+def cpu_estimate_kernels(img, bayer_mode, alpha, iso, beta,
+                         k_detail, k_denoise, D_th, D_tr, k_stretch, k_shrink,
+                         store_inverse):
+    """
+    CPU counterpart of cuda_estimate_kernel, vectorized with numpy.
+
+    Returns
+    -------
+    covs : Array[grey_imshape_y, grey_imshape_x, 3]
+        Compact covariance matrices (or their inverses)
+
+    """
+    img = img.astype(DEFAULT_NUMPY_FLOAT_TYPE)
+    if bayer_mode:
+        grey_imshape_y, grey_imshape_x = img.shape[0]//2, img.shape[1]//2
+        img = img[:2*grey_imshape_y, :2*grey_imshape_x]
+        grey = (img[0::2, 0::2] + img[0::2, 1::2] + img[1::2, 0::2] + img[1::2, 1::2])/4
+    else:
+        grey = img
+    
+    # Generalized Anscombe Transform
+    grey = 2/alpha * iso*iso * np.sqrt(np.maximum(0, alpha*grey/iso + 3/8 * alpha*alpha + beta))
+    
+    # gradients at the corners of the grey pixels
+    grad_x = 0.25*(grey[:-1, 1:] - grey[:-1, :-1] + grey[1:, 1:] - grey[1:, :-1])
+    grad_y = 0.25*(grey[1:, :-1] - grey[:-1, :-1] + grey[1:, 1:] - grey[:-1, 1:])
+    
+    # structure tensor, summed on the 4 corners of each pixel
+    products = np.stack((grad_x*grad_x, grad_x*grad_y, grad_y*grad_y), axis=-1)
+    products = np.pad(products, ((1, 1), (1, 1), (0, 0)))
+    tensor = (products[:-1, :-1] + products[:-1, 1:] +
+              products[1:, :-1] + products[1:, 1:])
+    
+    # eigen decomposition
+    trace = tensor[..., 0] + tensor[..., 2]
+    delta = np.sqrt(np.maximum(0, (tensor[..., 0] - tensor[..., 2])**2 + 4*tensor[..., 1]**2))
+    l1 = (trace + delta)/2
+    l2 = (trace - delta)/2
+    
+    # e1 is the eigen vector of l1, e2 is orthogonal to it
+    angle = 0.5*np.arctan2(2*tensor[..., 1], tensor[..., 0] - tensor[..., 2])
+    e1_x, e1_y = np.cos(angle), np.sin(angle)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        A = 1 + np.sqrt((l1 - l2)/(l1 + l2))
+    D = np.clip(1 - np.sqrt(np.maximum(0, l1))/D_tr + D_th, 0, 1)
+    
+    anisotropic = A > 1.95 # A is Nan on flat areas, and then isotropic
+    k1 = np.where(anisotropic, 1/k_shrink, 1)
+    k2 = np.where(anisotropic, k_stretch, 1)
+    k_1_sq = (k_detail * ((1-D)*k1 + D*k_denoise))**2
+    k_2_sq = (k_detail * ((1-D)*k2 + D*k_denoise))**2
+    
+    cov_00 = k_1_sq*e1_x*e1_x + k_2_sq*e1_y*e1_y
+    cov_01 = (k_1_sq - k_2_sq)*e1_x*e1_y
+    cov_11 = k_1_sq*e1_y*e1_y + k_2_sq*e1_x*e1_x
+    
+    if store_inverse:
+        det = cov_00*cov_11 - cov_01*cov_01
+        invertible = np.abs(det) > EPSILON_DIV
+        det = np.where(invertible, det, 1)
+        covs = np.stack((np.where(invertible, cov_11/det, 1),
+                         np.where(invertible, -cov_01/det, 0),
+                         np.where(invertible, cov_00/det, 1)), axis=-1)
+    else:
+        covs = np.stack((cov_00, cov_01, cov_11), axis=-1)
+    
+    return covs.astype(DEFAULT_NUMPY_FLOAT_TYPE)
@@ -9,6 +9,8 @@ import math
 
 from numba import cuda
 
+from .utils import clamp
+
 @cuda.jit(device=True)
 def solve_2x2(A, B, X):
     """
@@ -186,17 +188,62 @@ def get_eighen_elmts_2x2(M, l, e1, e2):
     
      
 @cuda.jit(device=True) 
-def interpolate_cov(covs, center_pos, interpolated_cov):
-    reframed_posx, _ = math.modf(center_pos[1]) # these positions are between 0 and 1
-    reframed_posy, _ = math.modf(center_pos[0])
-    # cov 00 is in (0,0) ; cov 01 in (0, 1) ; cov 01 in (1, 0), cov 11 in (1, 1)
-    
-    for i in range(2):
-        for j in range(2):
-            interpolated_cov[i, j] = (covs[0,0,i,j]*(1 - reframed_posx)*(1 - reframed_posy) +
-                                      covs[0,1,i,j]*(reframed_posx)*(1 - reframed_posy) + 
-                                      covs[1,0,i,j]*(1 - reframed_posx)*(reframed_posy) + 
-                                      covs[1,1,i,j]*reframed_posx*reframed_posy)
+def interpolate_cov(covs, offset_y, offset_x, grey_size_y, grey_size_x,
+                    grey_pos, interpolated_cov):
+    """
+    Bilinearly interpolates the compact symmetric matrices covs at grey_pos.
+    The coordinates are clipped to stay in the grid.
+
+    Parameters
+    ----------
+    covs : device Array[..., ..., 3]
+        Symmetric matrices, stored as their coefficients [0, 0], [0, 1] and [1, 1].
+        It can be a tile of the grid, whose origin is at (offset_y, offset_x)
+    offset_y, offset_x : int
+        Position of covs in the grid
+    grey_size_y, grey_size_x : int
+        Shape of the grid
+    grey_pos : Array[2]
+        Position where interpolation must be done, on the grid. y, x
+    interpolated_cov : Array[2, 2]
+        Interpolated matrix
+
+    Returns
+    -------
+    None.
+
+    """
+    floor_x = int(clamp(math.floor(grey_pos[1]), 0, grey_size_x-1))
+    floor_y = int(clamp(math.floor(grey_pos[0]), 0, grey_size_y-1))
+    
+    ceil_x = min(floor_x + 1, grey_size_x-1)
+    ceil_y = min(floor_y + 1, grey_size_y-1)
+    
+    reframed_posx, _ = math.modf(grey_pos[1]) # these positions are between 0 and 1
+    reframed_posy, _ = math.modf(grey_pos[0])
+    
+    w_00 = (1 - reframed_posx)*(1 - reframed_posy)
+    w_01 = reframed_posx*(1 - reframed_posy)
+    w_10 = (1 - reframed_posx)*reframed_posy
+    w_11 = reframed_posx*reframed_posy
+    
+    floor_x -= offset_x
+    floor_y -= offset_y
+    ceil_x -= offset_x
+    ceil_y -= offset_y
+    
+    for k in range(3):
+        val = (covs[floor_y, floor_x, k]*w_00 +
+               covs[floor_y, ceil_x, k]*w_01 +
+               covs[ceil_y, floor_x, k]*w_10 +
+               covs[ceil_y, ceil_x, k]*w_11)
+        if k == 0:
+            interpolated_cov[0, 0] = val
+        elif k == 1:
+            interpolated_cov[0, 1] = val
+            interpolated_cov[1, 0] = val
+        else:
+            interpolated_cov[1, 1] = val
 
 @cuda.jit(device=True)
 def bilinear_interpolation(values, pos):
@@ -13,12 +13,20 @@ This script contains :
 
 import math
 
-from numba import uint8, cuda
+from numba import uint8, int32, cuda
 
-from .utils import DEFAULT_CUDA_FLOAT_TYPE, DEFAULT_NUMPY_FLOAT_TYPE, EPSILON_DIV, DEFAULT_THREADS
+from .utils import clamp, DEFAULT_CUDA_FLOAT_TYPE, DEFAULT_NUMPY_FLOAT_TYPE, EPSILON_DIV, DEFAULT_THREADS
 from .utils_image import denoise_power_merge, denoise_range_merge
 from .linalg import quad_mat_prod, invert_2x2, interpolate_cov
 
+# Size of the output tiles of the tiled engine, and maximal size of the input
+# tiles they read. At scale 1, an output tile reads MERGE_TILE_SIZE + 2 input
+# pixels in each direction, plus the variations of the flow. The shared memory
+# must be known at compile time : blocks that read more fall back to global
+# memory.
+MERGE_TILE_SIZE = DEFAULT_THREADS
+MAX_INPUT_TILE_SIZE = 2*MERGE_TILE_SIZE
+
 def merge_ref(ref_img, kernels, num, den, options, params, acc_rob=None):
     """
     Implementation of Alg. 11: AccumulationReference
@@ -30,8 +38,8 @@ def merge_ref(ref_img, kernels, num, den, options, params, acc_rob=None):
     ----------
     ref_img : device Array[imshape_y, imshape_x]
         Reference image J_1
-    kernels : device Array[imshape_y//2, imshape_x//2, 2, 2]
-        Covariance Matrices Omega_1
+    kernels : device Array[imshape_y//2, imshape_x//2, 3]
+        Covariance Matrices Omega_1 (or their inverses), in compact form
     num : device Array[s*imshape_y, s*imshape_x]
         Numerator of the accumulator
     den : device Array[s*imshape_y, s*imshape_x]
@@ -53,6 +61,7 @@ def merge_ref(ref_img, kernels, num, den, options, params, acc_rob=None):
     CFA_pattern = cuda.to_device(params['exif']['CFA Pattern'])
     bayer_mode = params['mode'] == 'bayer'
     iso_kernel = params['kernel'] == 'iso'
+    inverse_stored = params['kernel storage'] == 'inverse'
     
     robustness_denoise = params['accumulated robustness denoiser']['on']
     # numba is strict on types and dimension : let's use a consistent object
@@ -77,13 +86,14 @@ def merge_ref(ref_img, kernels, num, den, options, params, acc_rob=None):
     blockspergrid_y = math.ceil(output_shape_y/threadsperblock[0])
     blockspergrid = (blockspergrid_x, blockspergrid_y)
     
-    accumulate_ref[blockspergrid, threadsperblock](
-        ref_img, kernels, bayer_mode, iso_kernel, scale, CFA_pattern,
+    accumulate_engine = accumulate_ref_tiled if params['engine'] == 'tiled' else accumulate_ref
+    accumulate_engine[blockspergrid, threadsperblock](
+        ref_img, kernels, bayer_mode, iso_kernel, inverse_stored, scale, CFA_pattern,
         num, den, acc_rob, robustness_denoise, max_frame_count, rad_max, max_multiplier)
     
     
 @cuda.jit
-def accumulate_ref(ref_img, covs, bayer_mode, iso_kernel, scale, CFA_pattern,
+def accumulate_ref(ref_img, covs, bayer_mode, iso_kernel, inverse_stored, scale, CFA_pattern,
                    num, den, acc_rob,
                    robustness_denoise, max_frame_count, rad_max, max_multiplier):
     """
@@ -94,12 +104,15 @@ def accumulate_ref(ref_img, covs, bayer_mode, iso_kernel, scale, CFA_pattern,
     ----------
     ref_img : Array[imsize_y, imsize_x]
         The reference image
-    covs : device array[grey_imsize_y, grey_imsize_x, 2, 2]
-        covariance matrices sampled at the center of each grey pixel.
+    covs : device array[grey_imsize_y, grey_imsize_x, 3]
+        covariance matrices sampled at the center of each grey pixel, in
+        compact form.
     bayer_mode : bool
         Whether the burst is raw or grey
     iso_kernel : bool
         Whether isotropic kernels should be used, or handhled's kernels.
+    inverse_stored : bool
+        Whether covs contains the inverses of the covariance matrices.
     scale : float
         scaling factor
     CFA_pattern : Array[2, 2]
@@ -115,6 +128,7 @@ def accumulate_ref(ref_img, covs, bayer_mode, iso_kernel, scale, CFA_pattern,
 
     output_pixel_idx, output_pixel_idy = cuda.grid(2)
     output_size_y, output_size_x, _ = num.shape
+    input_size_y, input_size_x = ref_img.shape
     
     if not (0 <= output_pixel_idx < output_size_x and
             0 <= output_pixel_idy < output_size_y):
@@ -147,60 +161,22 @@ def accumulate_ref(ref_img, covs, bayer_mode, iso_kernel, scale, CFA_pattern,
         val[chan] = 0
 
     
-    # computing kernel
-    # TODO this is rather slow and could probably be sped up
-    if not iso_kernel:
-        interpolated_cov = cuda.local.array((2, 2), dtype = DEFAULT_CUDA_FLOAT_TYPE)
-        cov_i = cuda.local.array((2, 2), dtype=DEFAULT_CUDA_FLOAT_TYPE)
-        
-        
-        # fetching the 4 closest covs
-        close_covs = cuda.local.array((2, 2, 2 ,2), DEFAULT_CUDA_FLOAT_TYPE)
-        grey_pos = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
-        if bayer_mode:
-            grey_pos[0] = (coarse_ref_sub_pos[0]-0.5)/2 # grey grid is offseted and twice more sparse
-            grey_pos[1] = (coarse_ref_sub_pos[1]-0.5)/2
-            
-        else:
-            grey_pos[0] = coarse_ref_sub_pos[0] # grey grid is exactly the coarse grid
-            grey_pos[1] = coarse_ref_sub_pos[1]
-    
-    
-        # clipping the coordinates to stay in bound
-        floor_x = int(max(math.floor(grey_pos[1]), 0))
-        floor_y = int(max(math.floor(grey_pos[0]), 0))
-        
-        ceil_x = min(floor_x + 1, covs.shape[1]-1)
-        ceil_y = min(floor_y + 1, covs.shape[0]-1)
-        for i in range(0, 2):
-            for j in range(0, 2):
-                close_covs[0, 0, i, j] = covs[floor_y, floor_x,
-                                              i, j]
-                close_covs[0, 1, i, j] = covs[floor_y, ceil_x,
-                                              i, j]
-                close_covs[1, 0, i, j] = covs[ceil_y, floor_x,
-                                              i, j]
-                close_covs[1, 1, i, j] = covs[ceil_y, ceil_x,
-                                              i, j]
-
-        # interpolating covs
-        interpolate_cov(close_covs, grey_pos, interpolated_cov)
+    grey_pos = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
+    if bayer_mode:
+        grey_pos[0] = (coarse_ref_sub_pos[0]-0.5)/2 # grey grid is offseted and twice more sparse
+        grey_pos[1] = (coarse_ref_sub_pos[1]-0.5)/2
         
-        if abs(interpolated_cov[0, 0]*interpolated_cov[1, 1] - interpolated_cov[0, 1]*interpolated_cov[1, 0]) > EPSILON_DIV: # checking if cov is invertible
-            invert_2x2(interpolated_cov, cov_i)
-
-        else: # if not invertible, identity matrix
-            cov_i[0, 0] = 1
-            cov_i[0, 1] = 0
-            cov_i[1, 0] = 0
-            cov_i[1, 1] = 1
+    else:
+        grey_pos[0] = coarse_ref_sub_pos[0] # grey grid is exactly the coarse grid
+        grey_pos[1] = coarse_ref_sub_pos[1]
             
     
     # fetching acc robustness if required
     # The robustness of the center of the patch is picked through neirest neigbhoor interpolation
     if robustness_denoise : 
-        local_acc_r = acc_rob[round(grey_pos[0]),
-                              round(grey_pos[1])]
+        # the nearest grey pixel can be one past the border
+        local_acc_r = acc_rob[clamp(round(grey_pos[0]), 0, acc_rob.shape[0]-1),
+                              clamp(round(grey_pos[1]), 0, acc_rob.shape[1]-1)]
         
         additional_denoise_power = denoise_power_merge(local_acc_r, max_multiplier, max_frame_count)
         rad = denoise_range_merge(local_acc_r, rad_max, max_frame_count)
@@ -209,53 +185,10 @@ def accumulate_ref(ref_img, covs, bayer_mode, iso_kernel, scale, CFA_pattern,
         additional_denoise_power = 1
         rad = 1     
 
-        
-    center_x = round(coarse_ref_sub_pos[1])
-    center_y = round(coarse_ref_sub_pos[0])
-    for i in range(-rad, rad+1):
-        for j in range(-rad, rad+1):
-            pixel_idx = center_x + j
-            pixel_idy = center_y + i
-            
-            # in bound condition
-            if (0 <= pixel_idx < output_size_x and
-                0 <= pixel_idy < output_size_y):
-            
-                # checking if pixel is r, g or b
-                if bayer_mode : 
-                    channel = local_CFA[pixel_idy%2, pixel_idx%2]
-                else:
-                    channel = 0
-                    
-                # By fetching the value now, we can compute the kernel weight 
-                # while it is called from global memory
-                c = ref_img[pixel_idy, pixel_idx]
-            
-                # computing distance
-                dist_x = pixel_idx - coarse_ref_sub_pos[1]
-                dist_y = pixel_idy - coarse_ref_sub_pos[0]
-            
-                ### Computing w
-                if iso_kernel : 
-                    y = max(0, 2*(dist_x*dist_x + dist_y*dist_y))
-                else:
-                    y = max(0, quad_mat_prod(cov_i, dist_x, dist_y))
-                    # y can be slightly negative because of numerical precision.
-                    # I clamp it to not explode the error with exp
-                    
-                
-                # this is equivalent to multiplying the covariance,
-                # but at the cost of one scalar operation (instead of 4)
-                y/= additional_denoise_power
-                
-                if bayer_mode : 
-                    w = math.exp(-0.5*y)
-                else:
-                    w = math.exp(-0.5*4*y) # original kernel constants are designed for bayer distances, not greys, Hence x4
-                ############
-                
-                val[channel] += c*w
-                acc[channel] += w
+    accumulate_pixel(ref_img, 0, 0, input_size_y, input_size_x,
+                     covs, 0, 0, covs.shape[0], covs.shape[1],
+                     coarse_ref_sub_pos, grey_pos, rad, 1, additional_denoise_power,
+                     bayer_mode, iso_kernel, inverse_stored, local_CFA, val, acc)
     
     if robustness_denoise and local_acc_r < max_frame_count:
         # Overwritting values to enforce single frame
@@ -285,8 +218,8 @@ def merge(comp_img, alignments, covs, r, num, den,
         The non-reference image to merge (J_n)
     alignments : device Array[n_tiles_y, n_tiles_x, 2]
         The final estimation of the tiles' alignment V_n(p)
-    covs : device array[imsize_y//2, imsize_x//2, 2, 2]
-        covariance matrices Omega_n
+    covs : device array[imsize_y//2, imsize_x//2, 3]
+        covariance matrices Omega_n (or their inverses), in compact form
     r : Device_Array[imsize_y//2, imsize_x//2]
         Robustness mask r_n
     num : device Array[s*imshape_y, s*imshape_x]
@@ -309,6 +242,7 @@ def merge(comp_img, alignments, covs, r, num, den,
     CFA_pattern = cuda.to_device(params['exif']['CFA Pattern'])
     bayer_mode = params['mode'] == 'bayer'
     iso_kernel = params['kernel'] == 'iso'
+    inverse_stored = params['kernel storage'] == 'inverse'
     tile_size = params['tuning']['tileSize']
 
     native_im_size = comp_img.shape
@@ -322,16 +256,17 @@ def merge(comp_img, alignments, covs, r, num, den,
     blockspergrid_y = math.ceil(output_size[0]/threadsperblock[0])
     blockspergrid = (blockspergrid_x, blockspergrid_y)
                     
-    accumulate[blockspergrid, threadsperblock](
+    accumulate_engine = accumulate_tiled if params['engine'] == 'tiled' else accumulate
+    accumulate_engine[blockspergrid, threadsperblock](
         comp_img, alignments, covs, r,
-        bayer_mode, iso_kernel, scale, tile_size, CFA_pattern,
+        bayer_mode, iso_kernel, inverse_stored, scale, tile_size, CFA_pattern,
         num, den)
 
 
 
 @cuda.jit
 def accumulate(comp_img, alignments, covs, r,
-               bayer_mode, iso_kernel, scale, tile_size, CFA_pattern,
+               bayer_mode, iso_kernel, inverse_stored, scale, tile_size, CFA_pattern,
                num, den):
     """
 
@@ -343,14 +278,17 @@ def accumulate(comp_img, alignments, covs, r,
         The compared image
     alignements : Array[n_tiles_y, n_tiles_x, 2]
         The alignemnt vectors for each tile of the image
-    covs : device array[imsize_y/2, imsize_x/2, 2, 2]
-        covariance matrices sampled at the center of each bayer quad.
+    covs : device array[imsize_y/2, imsize_x/2, 3]
+        covariance matrices sampled at the center of each bayer quad, in
+        compact form.
     r : Device_Array[imsize_y/2, imsize_x/2, 3]
             Robustness of the moving images
     bayer_mode : bool
         Whether the burst is raw or grey
     iso_kernel : bool
         Whether isotropic kernels should be used, or handhled's kernels.
+    inverse_stored : bool
+        Whether covs contains the inverses of the covariance matrices.
     scale : float
         scaling factor
     tile_size : int
@@ -416,12 +354,13 @@ def accumulate(comp_img, alignments, covs, r,
     # The robustness of the center of the patch is picked through neirest neigbhoor interpolation
 
     if bayer_mode : 
-        local_r = r[round((coarse_ref_sub_pos[0] - 0.5)/2),
-                    round((coarse_ref_sub_pos[1] - 0.5)/2)]
+        # the nearest grey pixel can be one past the border
+        local_r = r[clamp(round((coarse_ref_sub_pos[0] - 0.5)/2), 0, r.shape[0]-1),
+                    clamp(round((coarse_ref_sub_pos[1] - 0.5)/2), 0, r.shape[1]-1)]
 
     else:
-        local_r = r[round(coarse_ref_sub_pos[0]),
-                    round(coarse_ref_sub_pos[1])]
+        local_r = r[clamp(round(coarse_ref_sub_pos[0]), 0, r.shape[0]-1),
+                    clamp(round(coarse_ref_sub_pos[1]), 0, r.shape[1]-1)]
         
     patch_center_pos[1] = coarse_ref_sub_pos[1] + local_optical_flow[0]
     patch_center_pos[0] = coarse_ref_sub_pos[0] + local_optical_flow[1]
@@ -432,62 +371,362 @@ def accumulate(comp_img, alignments, covs, r,
             0 <= patch_center_pos[0] < input_size_y):
         return
     
-    # computing kernel
-    if not iso_kernel:
-        interpolated_cov = cuda.local.array((2, 2), dtype = DEFAULT_CUDA_FLOAT_TYPE)
-        cov_i = cuda.local.array((2, 2), dtype=DEFAULT_CUDA_FLOAT_TYPE)
-        # fetching the 4 closest covs
-        close_covs = cuda.local.array((2, 2, 2 ,2), DEFAULT_CUDA_FLOAT_TYPE)
-        grey_pos = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
+    grey_pos = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
+    if bayer_mode :
+        grey_pos[0] = (patch_center_pos[0]-0.5)/2 # grey grid is offseted and twice more sparse
+        grey_pos[1] = (patch_center_pos[1]-0.5)/2
         
-        if bayer_mode :
-            grey_pos[0] = (patch_center_pos[0]-0.5)/2 # grey grid is offseted and twice more sparse
-            grey_pos[1] = (patch_center_pos[1]-0.5)/2
-            
-        else:
-            grey_pos[0] = patch_center_pos[0] # grey grid is exactly the coarse grid
-            grey_pos[1] = patch_center_pos[1]
+    else:
+        grey_pos[0] = patch_center_pos[0] # grey grid is exactly the coarse grid
+        grey_pos[1] = patch_center_pos[1]
+    
+    accumulate_pixel(comp_img, 0, 0, input_size_y, input_size_x,
+                     covs, 0, 0, covs.shape[0], covs.shape[1],
+                     patch_center_pos, grey_pos, 1, local_r, 1,
+                     bayer_mode, iso_kernel, inverse_stored, local_CFA, val, acc)
+        
+    for chan in range(n_channels):
+        num[output_pixel_idy, output_pixel_idx, chan] += val[chan] 
+        den[output_pixel_idy, output_pixel_idx, chan] += acc[chan]
+    
+    
+    
+    
+
+
+@cuda.jit
+def accumulate_ref_tiled(ref_img, covs, bayer_mode, iso_kernel, inverse_stored, scale, CFA_pattern,
+                         num, den, acc_rob,
+                         robustness_denoise, max_frame_count, rad_max, max_multiplier):
+    """
+    Tiled version of accumulate_ref : the input pixels and the covariances
+    read by the block are first loaded in shared memory. If they do not fit,
+    the block reads them from global memory, as accumulate_ref.
+
+    """
+    output_size_y, output_size_x, _ = num.shape
+    input_size_y, input_size_x = ref_img.shape
+    tx, ty = cuda.threadIdx.x, cuda.threadIdx.y
+    output_pixel_idx = cuda.blockIdx.x * MERGE_TILE_SIZE + tx
+    output_pixel_idy = cuda.blockIdx.y * MERGE_TILE_SIZE + ty
+    
+    img_tile = cuda.shared.array((MAX_INPUT_TILE_SIZE, MAX_INPUT_TILE_SIZE), DEFAULT_CUDA_FLOAT_TYPE)
+    cov_tile = cuda.shared.array((MAX_INPUT_TILE_SIZE, MAX_INPUT_TILE_SIZE, 3), DEFAULT_CUDA_FLOAT_TYPE)
+    bbox = cuda.shared.array(8, int32)
+    
+    if tx == 0 and ty == 0:
+        init_bbox(bbox)
+    
+    if bayer_mode:
+        n_channels = 3
+        acc = cuda.local.array(3, dtype=DEFAULT_CUDA_FLOAT_TYPE)
+        val = cuda.local.array(3, dtype=DEFAULT_CUDA_FLOAT_TYPE)
+    else:
+        n_channels = 1
+        acc = cuda.local.array(1, dtype=DEFAULT_CUDA_FLOAT_TYPE)
+        val = cuda.local.array(1, dtype=DEFAULT_CUDA_FLOAT_TYPE)
+    
+    local_CFA = cuda.local.array((2,2), uint8)
+    for i in range(2):
+        for j in range(2):
+            local_CFA[i,j] = uint8(CFA_pattern[i,j])
+    
+    coarse_ref_sub_pos = cuda.local.array(2, dtype=DEFAULT_CUDA_FLOAT_TYPE) # y, x
+    coarse_ref_sub_pos[0] = output_pixel_idy / scale          
+    coarse_ref_sub_pos[1] = output_pixel_idx / scale
+    
+    grey_pos = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
+    if bayer_mode:
+        grey_pos[0] = (coarse_ref_sub_pos[0]-0.5)/2 # grey grid is offseted and twice more sparse
+        grey_pos[1] = (coarse_ref_sub_pos[1]-0.5)/2
+    else:
+        grey_pos[0] = coarse_ref_sub_pos[0] # grey grid is exactly the coarse grid
+        grey_pos[1] = coarse_ref_sub_pos[1]
+    
+    active = (output_pixel_idx < output_size_x and
+              output_pixel_idy < output_size_y)
+    
+    local_acc_r = 0.
+    additional_denoise_power = 1.
+    rad = 1
+    if active and robustness_denoise:
+        # the nearest grey pixel can be one past the border
+        local_acc_r = acc_rob[clamp(round(grey_pos[0]), 0, acc_rob.shape[0]-1),
+                              clamp(round(grey_pos[1]), 0, acc_rob.shape[1]-1)]
+        
+        additional_denoise_power = denoise_power_merge(local_acc_r, max_multiplier, max_frame_count)
+        rad = denoise_range_merge(local_acc_r, rad_max, max_frame_count)
+    
+    cuda.syncthreads()
+    if active:
+        extend_bbox(bbox, coarse_ref_sub_pos, grey_pos, rad,
+                    input_size_y, input_size_x, covs.shape[0], covs.shape[1])
+    cuda.syncthreads()
+    
+    in_tile = load_tiles(ref_img, covs, bbox, img_tile, cov_tile, not iso_kernel)
+    cuda.syncthreads()
+    
+    if not active:
+        return
+    
+    for chan in range(n_channels):
+        acc[chan] = 0
+        val[chan] = 0
+    
+    if in_tile:
+        accumulate_pixel(img_tile, bbox[0], bbox[1], input_size_y, input_size_x,
+                         cov_tile, bbox[4], bbox[5], covs.shape[0], covs.shape[1],
+                         coarse_ref_sub_pos, grey_pos, rad, 1, additional_denoise_power,
+                         bayer_mode, iso_kernel, inverse_stored, local_CFA, val, acc)
+    else:
+        accumulate_pixel(ref_img, 0, 0, input_size_y, input_size_x,
+                         covs, 0, 0, covs.shape[0], covs.shape[1],
+                         coarse_ref_sub_pos, grey_pos, rad, 1, additional_denoise_power,
+                         bayer_mode, iso_kernel, inverse_stored, local_CFA, val, acc)
+    
+    if robustness_denoise and local_acc_r < max_frame_count:
+        # Overwritting values to enforce single frame
+        # demosaicing        
+        for chan in range(n_channels):
+            num[output_pixel_idy, output_pixel_idx, chan] = val[chan]
+            den[output_pixel_idy, output_pixel_idx, chan] = acc[chan]
         
-        # clipping the coordinates to stay in bound
-        floor_x = int(max(math.floor(grey_pos[1]), 0))
-        floor_y = int(max(math.floor(grey_pos[0]), 0))
+    else:
+        for chan in range(n_channels):
+            num[output_pixel_idy, output_pixel_idx, chan] += val[chan]
+            den[output_pixel_idy, output_pixel_idx, chan] += acc[chan]
+
+@cuda.jit
+def accumulate_tiled(comp_img, alignments, covs, r,
+                     bayer_mode, iso_kernel, inverse_stored, scale, tile_size, CFA_pattern,
+                     num, den):
+    """
+    Tiled version of accumulate : the input pixels and the covariances read
+    by the block are first loaded in shared memory. If they do not fit (for
+    instance when the flow varies a lot inside the block), the block reads
+    them from global memory, as accumulate.
+
+    """
+    output_size_y, output_size_x, _ = num.shape
+    input_size_y, input_size_x = comp_img.shape
+    tx, ty = cuda.threadIdx.x, cuda.threadIdx.y
+    output_pixel_idx = cuda.blockIdx.x * MERGE_TILE_SIZE + tx
+    output_pixel_idy = cuda.blockIdx.y * MERGE_TILE_SIZE + ty
+    
+    img_tile = cuda.shared.array((MAX_INPUT_TILE_SIZE, MAX_INPUT_TILE_SIZE), DEFAULT_CUDA_FLOAT_TYPE)
+    cov_tile = cuda.shared.array((MAX_INPUT_TILE_SIZE, MAX_INPUT_TILE_SIZE, 3), DEFAULT_CUDA_FLOAT_TYPE)
+    bbox = cuda.shared.array(8, int32)
+    
+    if tx == 0 and ty == 0:
+        init_bbox(bbox)
+    
+    if bayer_mode:
+        n_channels = 3
+        acc = cuda.local.array(3, dtype=DEFAULT_CUDA_FLOAT_TYPE)
+        val = cuda.local.array(3, dtype=DEFAULT_CUDA_FLOAT_TYPE)
+    else:
+        n_channels = 1
+        acc = cuda.local.array(1, dtype=DEFAULT_CUDA_FLOAT_TYPE)
+        val = cuda.local.array(1, dtype=DEFAULT_CUDA_FLOAT_TYPE)
+    
+    local_CFA = cuda.local.array((2,2), uint8)
+    for i in range(2):
+        for j in range(2):
+            local_CFA[i,j] = uint8(CFA_pattern[i,j])
+    
+    coarse_ref_sub_pos = cuda.local.array(2, dtype=DEFAULT_CUDA_FLOAT_TYPE) # y, x
+    coarse_ref_sub_pos[0] = output_pixel_idy / scale          
+    coarse_ref_sub_pos[1] = output_pixel_idx / scale
+    
+    patch_center_pos = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE) # y, x
+    grey_pos = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
+    
+    active = (output_pixel_idx < output_size_x and
+              output_pixel_idy < output_size_y)
+    
+    local_r = 0.
+    if active:
+        patch_idy = int(coarse_ref_sub_pos[0]//tile_size)
+        patch_idx = int(coarse_ref_sub_pos[1]//tile_size)
+        patch_center_pos[1] = coarse_ref_sub_pos[1] + alignments[patch_idy, patch_idx, 0]
+        patch_center_pos[0] = coarse_ref_sub_pos[0] + alignments[patch_idy, patch_idx, 1]
+        
+        # The robustness of the center of the patch is picked through neirest neigbhoor interpolation
+        if bayer_mode : 
+            # the nearest grey pixel can be one past the border
+            local_r = r[clamp(round((coarse_ref_sub_pos[0] - 0.5)/2), 0, r.shape[0]-1),
+                        clamp(round((coarse_ref_sub_pos[1] - 0.5)/2), 0, r.shape[1]-1)]
+        else:
+            local_r = r[clamp(round(coarse_ref_sub_pos[0]), 0, r.shape[0]-1),
+                        clamp(round(coarse_ref_sub_pos[1]), 0, r.shape[1]-1)]
         
-        ceil_x = min(floor_x + 1, covs.shape[1]-1)
-        ceil_y = min(floor_y + 1, covs.shape[0]-1)
-        for i in range(0, 2):
-            for j in range(0, 2):
-                close_covs[0, 0, i, j] = covs[floor_y, floor_x,
-                                              i, j]
-                close_covs[0, 1, i, j] = covs[floor_y, ceil_x,
-                                              i, j]
-                close_covs[1, 0, i, j] = covs[ceil_y, floor_x,
-                                              i, j]
-                close_covs[1, 1, i, j] = covs[ceil_y, ceil_x,
-                                              i, j]
-
-        # interpolating covs at the desired spot
-        interpolate_cov(close_covs, grey_pos, interpolated_cov)
-
-        if abs(interpolated_cov[0, 0]*interpolated_cov[1, 1] - interpolated_cov[0, 1]*interpolated_cov[1, 0]) > EPSILON_DIV: # checking if cov is invertible
-            invert_2x2(interpolated_cov, cov_i)
-
-        else: # if not invertible, identity matrix
-            cov_i[0, 0] = 1
-            cov_i[0, 1] = 0
-            cov_i[1, 0] = 0
-            cov_i[1, 1] = 1
-    
-    
-    center_x = round(patch_center_pos[1])
-    center_y = round(patch_center_pos[0])
-    for i in range(-1, 2):
-        for j in range(-1, 2):
+        # updating inbound condition
+        active = (0 <= patch_center_pos[1] < input_size_x and
+                  0 <= patch_center_pos[0] < input_size_y)
+    
+    if bayer_mode :
+        grey_pos[0] = (patch_center_pos[0]-0.5)/2 # grey grid is offseted and twice more sparse
+        grey_pos[1] = (patch_center_pos[1]-0.5)/2
+    else:
+        grey_pos[0] = patch_center_pos[0] # grey grid is exactly the coarse grid
+        grey_pos[1] = patch_center_pos[1]
+    
+    cuda.syncthreads()
+    if active:
+        extend_bbox(bbox, patch_center_pos, grey_pos, 1,
+                    input_size_y, input_size_x, covs.shape[0], covs.shape[1])
+    cuda.syncthreads()
+    
+    in_tile = load_tiles(comp_img, covs, bbox, img_tile, cov_tile, not iso_kernel)
+    cuda.syncthreads()
+    
+    if not active:
+        return
+    
+    for chan in range(n_channels):
+        acc[chan] = 0
+        val[chan] = 0
+    
+    if in_tile:
+        accumulate_pixel(img_tile, bbox[0], bbox[1], input_size_y, input_size_x,
+                         cov_tile, bbox[4], bbox[5], covs.shape[0], covs.shape[1],
+                         patch_center_pos, grey_pos, 1, local_r, 1,
+                         bayer_mode, iso_kernel, inverse_stored, local_CFA, val, acc)
+    else:
+        accumulate_pixel(comp_img, 0, 0, input_size_y, input_size_x,
+                         covs, 0, 0, covs.shape[0], covs.shape[1],
+                         patch_center_pos, grey_pos, 1, local_r, 1,
+                         bayer_mode, iso_kernel, inverse_stored, local_CFA, val, acc)
+    
+    for chan in range(n_channels):
+        num[output_pixel_idy, output_pixel_idx, chan] += val[chan] 
+        den[output_pixel_idy, output_pixel_idx, chan] += acc[chan]
+
+@cuda.jit(device=True)
+def init_bbox(bbox):
+    # input pixels : y0, x0, y1, x1, then covariances : y0, x0, y1, x1
+    for k in range(0, 8, 4):
+        bbox[k] = 2**30
+        bbox[k + 1] = 2**30
+        bbox[k + 2] = -1
+        bbox[k + 3] = -1
+
+@cuda.jit(device=True)
+def extend_bbox(bbox, center_pos, grey_pos, rad,
+                input_size_y, input_size_x, grey_size_y, grey_size_x):
+    """
+    Extends the bounding boxes of the block with the input pixels and the
+    covariances read by the thread.
+
+    """
+    center_x = round(center_pos[1])
+    center_y = round(center_pos[0])
+    cuda.atomic.min(bbox, 0, max(center_y - rad, 0))
+    cuda.atomic.min(bbox, 1, max(center_x - rad, 0))
+    cuda.atomic.max(bbox, 2, min(center_y + rad, input_size_y - 1))
+    cuda.atomic.max(bbox, 3, min(center_x + rad, input_size_x - 1))
+    
+    # same clipping as interpolate_cov
+    floor_x = int(clamp(math.floor(grey_pos[1]), 0, grey_size_x - 1))
+    floor_y = int(clamp(math.floor(grey_pos[0]), 0, grey_size_y - 1))
+    cuda.atomic.min(bbox, 4, floor_y)
+    cuda.atomic.min(bbox, 5, floor_x)
+    cuda.atomic.max(bbox, 6, min(floor_y + 1, grey_size_y - 1))
+    cuda.atomic.max(bbox, 7, min(floor_x + 1, grey_size_x - 1))
+
+@cuda.jit(device=True)
+def load_tiles(img, covs, bbox, img_tile, cov_tile, load_covs):
+    """
+    Cooperatively loads the bounding boxes of the block in shared memory.
+    Returns whether they fit in the tiles.
+
+    """
+    tx, ty = cuda.threadIdx.x, cuda.threadIdx.y
+    fits = (bbox[2] - bbox[0] < MAX_INPUT_TILE_SIZE and
+            bbox[3] - bbox[1] < MAX_INPUT_TILE_SIZE and
+            bbox[6] - bbox[4] < MAX_INPUT_TILE_SIZE and
+            bbox[7] - bbox[5] < MAX_INPUT_TILE_SIZE)
+    if not fits:
+        return False
+    
+    for i in range(ty, bbox[2] - bbox[0] + 1, MERGE_TILE_SIZE):
+        for j in range(tx, bbox[3] - bbox[1] + 1, MERGE_TILE_SIZE):
+            img_tile[i, j] = img[bbox[0] + i, bbox[1] + j]
+    
+    if load_covs:
+        for i in range(ty, bbox[6] - bbox[4] + 1, MERGE_TILE_SIZE):
+            for j in range(tx, bbox[7] - bbox[5] + 1, MERGE_TILE_SIZE):
+                for k in range(3):
+                    cov_tile[i, j, k] = covs[bbox[4] + i, bbox[5] + j, k]
+    return True
+
+@cuda.jit(device=True)
+def accumulate_pixel(img, offset_y, offset_x, input_size_y, input_size_x,
+                     covs, cov_offset_y, cov_offset_x, grey_size_y, grey_size_x,
+                     center_pos, grey_pos, rad, weight, denoise_power,
+                     bayer_mode, iso_kernel, inverse_stored, local_CFA, val, acc):
+    """
+    Accumulates in val and acc the input pixels around center_pos, weighted
+    by the kernel. img and covs may be the full arrays (with null offsets),
+    or tiles whose origin is at (offset_y, offset_x) and
+    (cov_offset_y, cov_offset_x).
+
+    Parameters
+    ----------
+    img : Array
+        Input image, or tile of the input image
+    offset_y, offset_x : int
+        Position of img in the input image
+    input_size_y, input_size_x : int
+        Shape of the input image
+    covs : Array
+        Compact covariances, or tile of the compact covariances
+    cov_offset_y, cov_offset_x : int
+        Position of covs in the covariance grid
+    grey_size_y, grey_size_x : int
+        Shape of the covariance grid
+    center_pos : Array[2]
+        Position of the center of the kernel in the input image. y, x
+    grey_pos : Array[2]
+        Position of the center of the kernel in the covariance grid. y, x
+    rad : int
+        Radius of the accumulated neighbourhood
+    weight : float
+        Weight of the frame (robustness)
+    denoise_power : float
+        Multiplier of the covariance
+    bayer_mode : bool
+        Whether the burst is raw or grey
+    iso_kernel : bool
+        Whether isotropic kernels should be used, or handhled's kernels.
+    inverse_stored : bool
+        Whether covs contains the inverses of the covariance matrices.
+    local_CFA : Array[2, 2]
+        CFA pattern of the burst
+    val, acc : Array[n_channels]
+        Accumulated values and weights
+
+    Returns
+    -------
+    None.
+
+    """
+    # computing kernel
+    if not iso_kernel:
+        cov_i = cuda.local.array((2, 2), dtype=DEFAULT_CUDA_FLOAT_TYPE)
+        get_kernel_inverse(covs, cov_offset_y, cov_offset_x, grey_size_y, grey_size_x,
+                           grey_pos, inverse_stored, cov_i)
+    
+    center_x = round(center_pos[1])
+    center_y = round(center_pos[0])
+    for i in range(-rad, rad+1):
+        for j in range(-rad, rad+1):
             pixel_idx = center_x + j
             pixel_idy = center_y + i
             
             # in bound condition
-            if (0 <= pixel_idx < output_size_x and
-                0 <= pixel_idy < output_size_y):
+            if (0 <= pixel_idx < input_size_x and
+                0 <= pixel_idy < input_size_y):
             
                 # checking if pixel is r, g or b
                 if bayer_mode : 
@@ -497,11 +736,11 @@ def accumulate(comp_img, alignments, covs, r,
                     
                 # By fetching the value now, we can compute the kernel weight 
                 # while it is called from global memory
-                c = comp_img[pixel_idy, pixel_idx]
+                c = img[pixel_idy - offset_y, pixel_idx - offset_x]
             
                 # computing distance
-                dist_x = pixel_idx - patch_center_pos[1]
-                dist_y = pixel_idy - patch_center_pos[0]
+                dist_x = pixel_idx - center_pos[1]
+                dist_y = pixel_idy - center_pos[0]
             
                 ### Computing w
                 if iso_kernel : 
@@ -510,19 +749,61 @@ def accumulate(comp_img, alignments, covs, r,
                     y = max(0, quad_mat_prod(cov_i, dist_x, dist_y))
                     # y can be slightly negative because of numerical precision.
                     # I clamp it to not explode the error with exp
+                
+                # this is equivalent to multiplying the covariance,
+                # but at the cost of one scalar operation (instead of 4)
+                y/= denoise_power
+                
                 if bayer_mode : 
                     w = math.exp(-0.5*y)
                 else:
                     w = math.exp(-0.5*4*y) # original kernel constants are designed for bayer distances, not greys, Hence x4
                 ############
                     
-                val[channel] += c*w*local_r
-                acc[channel] += w*local_r
-        
-    for chan in range(n_channels):
-        num[output_pixel_idy, output_pixel_idx, chan] += val[chan] 
-        den[output_pixel_idy, output_pixel_idx, chan] += acc[chan]
-    
-    
+                val[channel] += c*w*weight
+                acc[channel] += w*weight
+
+@cuda.jit(device=True)
+def get_kernel_inverse(covs, offset_y, offset_x, grey_size_y, grey_size_x,
+                       grey_pos, inverse_stored, cov_i):
+    """
+    Returns in cov_i the inverse of the kernel covariance at grey_pos. When
+    the inverses are stored, they are directly interpolated. Otherwise the
+    covariances are interpolated, then inverted.
+
+    Parameters
+    ----------
+    covs : Array[..., ..., 3]
+        covariance matrices (or their inverses), in compact form. It can be
+        a tile of the covariance grid, whose origin is at (offset_y, offset_x)
+    offset_y, offset_x : int
+        Position of covs in the covariance grid
+    grey_size_y, grey_size_x : int
+        Shape of the covariance grid
+    grey_pos : Array[2]
+        Position on the grey grid. y, x
+    inverse_stored : bool
+        Whether covs contains the inverses of the covariance matrices.
+    cov_i : Array[2, 2]
+        Inverse of the covariance
+
+    Returns
+    -------
+    None.
+
+    """
+    if inverse_stored:
+        interpolate_cov(covs, offset_y, offset_x, grey_size_y, grey_size_x, grey_pos, cov_i)
+        return
     
-    
\ No newline at end of file
+    interpolated_cov = cuda.local.array((2, 2), dtype = DEFAULT_CUDA_FLOAT_TYPE)
+    interpolate_cov(covs, offset_y, offset_x, grey_size_y, grey_size_x, grey_pos, interpolated_cov)
+
+    if abs(interpolated_cov[0, 0]*interpolated_cov[1, 1] - interpolated_cov[0, 1]*interpolated_cov[1, 0]) > EPSILON_DIV: # checking if cov is invertible
+        invert_2x2(interpolated_cov, cov_i)
+
+    else: # if not invertible, identity matrix
+        cov_i[0, 0] = 1
+        cov_i[0, 1] = 0
+        cov_i[1, 0] = 0
+        cov_i[1, 1] = 1
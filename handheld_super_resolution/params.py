@@ -18,19 +18,28 @@ def get_params(SNR):
         Ts = 32
     else:
         Ts = 16
-        
-    # TODO this could be adressed by reworking the block matching module
-    if Ts > 32:
-        Ts = 32
-        warnings.warn("Warning.... Tile sizes of more than 32 cannot be \
-                      processed by the bloc matching module at the moment.\
-                      Falling back to Ts=32") 
-        
     
     params = {'scale' : 1, # upscaling factor ( >=1 )
               'mode' : 'bayer', # 'bayer' or 'grey' (input image type)
-              'grey method' : 'FFT', # method to compute grey image for alignment. Only FFT is supported !
+              'grey method' : 'FFT', # method to compute grey image for alignment : 'FFT' or 'separable' (FIR approximation of the FFT low-pass)
               'debug': False, # when True, a dict is returned with debug infos.
+              'roi' : {
+                  'on' : False, # when True, only the region of interest is processed and returned
+                  'top' : 0, # position and size of the ROI, in reference frame pixels
+                  'left' : 0,
+                  'height' : 512,
+                  'width' : 512,
+                  },
+              'preview' : {
+                  'on' : False, # when True, a fast low resolution preview is computed
+                  'scale' : 0.25, # upscaling factor of the preview ( <1 )
+                  'levels' : 2, # number of coarse pyramid levels aligned for the preview
+                  'continue' : False, # when True, the full result is then computed, reusing the preview alignments
+                  },
+              'progressive' : {
+                  'on' : False, # when True, options['progressive callback'] receives intermediate results
+                  'every' : 1, # number of merged frames between two intermediate results
+                  },
               'block matching': {
                     'tuning': {
                         # WARNING: these parameters are defined fine-to-coarse!
@@ -38,6 +47,13 @@ def get_params(SNR):
                         'tileSizes': [Ts, Ts, Ts, Ts//2],
                         'searchRadia': [1, 4, 4, 4],
                         'distances': ['L1', 'L2', 'L2', 'L2'],
+                        # 'brute force', 'partial distance' (early termination),
+                        # 'sliding sum' (whole level difference images) or 'FFT' (L2 only), for large radii
+                        'searchEngines': ['brute force', 'brute force', 'brute force', 'brute force'],
+                        # quadratic fit of the distance surface at the finest level
+                        'subpixelRefinement': False,
+                        # search radius around the temporal prior, at the finest level
+                        'priorSearchRadius': 2,
                         }},
                 'kanade' : {
                     'tuning' : {
@@ -52,10 +68,37 @@ def get_params(SNR):
                         's1' : 2,         # 2
                         's2' : 12,        # 12
                         'Mt' : 0.8,       # 0.8
+                        'local stats radius' : 1, # radius of the window of the local stats (1 for 3x3)
+                        'local min radius' : 2, # radius of the window of the local min of R (2 for 5x5)
+                        }
+                    },
+                'frame rejection' : {
+                    'on':False,
+                    'tuning' : {
+                        'min sharpness' : 0.5,    # sharpness of G_n relative to G_1
+                        'max residual' : 0.1,     # mean ICA residual relative to the brightness of G_1
+                        'min robustness' : 0.05,  # mean value of r_n
+                        }
+                    },
+                'global motion' : {
+                    'on':False, # when True, the flow is generated from a global model when possible
+                    'tuning' : {
+                        'model' : 'affine',       # 'affine' or 'homography'
+                        'max residual' : 0.75,    # mean fit error, in pixels of the second finest pyramid level
+                        'IRLS iter' : 5,
+                        'kanadeIter' : 1,         # ICA iterations when the global model is used
+                        }
+                    },
+                'temporal prior' : {
+                    'on':False, # when True, the flow of the previous frame seeds the block matching
+                    'tuning' : {
+                        'max residual' : 0.1,     # block matching residual relative to the brightness of G_1
                         }
                     },
                 'merging': {
                     'kernel' : 'handheld', # 'iso' for isotropic kernel, 'handheld' for handhel kernel
+                    'kernel storage' : 'covariance', # 'inverse' to store the inverse covariances, instead of inverting them for every output pixel
+                    'engine' : 'gather', # 'tiled' (experimental) to load the input tiles of each block in shared memory once
                     'tuning': {
                         'k_detail' : 0.25 + (0.33 - 0.25)*(30 - SNR)/(30 - 6), # [0.25, ..., 0.33]
                         'k_denoise': 3 + (5 - 3)*(30 - SNR)/(30 - 6),    # [3.0, ...,5.0]
@@ -87,6 +130,8 @@ def get_params(SNR):
                     'do gamma' : True,
                     'do sharpening' : True,
                     'do devignette' : False,
+                    'fused' : False, # when True, the post processing is done on GPU by a single kernel (smoothstep tone curve only)
+                    'bit depth' : 8, # 8 or 16, the depth of the fused output
                     
                     'sharpening':{
                         'radius':3,
@@ -97,9 +142,45 @@ def get_params(SNR):
 
     return params
 
-def check_params_validity(params, imshape):
-    if params["grey method"] != "FFT":
-        raise NotImplementedError("Grey level images should be obtained with FFT")
+def get_reference_selection_params(custom_params=None):
+    """
+    Returns the parameters of the reference frame selection. Contrary to
+    the other parameters they do not depend on the SNR, which can only be
+    estimated once the reference frame is known.
+    """
+    params = {'on' : True, 
+              'candidates' : 3, # the reference is the sharpest of the first frames (HDR+)
+              'decimation' : 4, # the sharpness is scored on the grey image decimated by this factor
+              }
+    
+    if custom_params is not None and 'reference selection' in custom_params.keys():
+        params = merge_params(dominant=custom_params['reference selection'], recessive=params)
+    
+    assert params['candidates'] >= 1
+    assert params['decimation'] >= 1
+    
+    return params
+
+def get_search_engines(bm_tuning):
+    """
+    Returns the block matching search engine of every level of the pyramid,
+    fine-to-coarse. The levels missing from bm_tuning['searchEngines'] (for
+    instance when custom factors are given without engines) use the brute
+    force search, and the extra engines are ignored.
+    """
+    n_levels = len(bm_tuning['factors'])
+    engines = list(bm_tuning.get('searchEngines', []))[:n_levels]
+    return engines + ['brute force']*(n_levels - len(engines))
+
+def check_params_validity(params, imshape, check_roi=True):
+    """
+    Asserts that the parameters are valid for frames of shape imshape.
+    The ROI is given in full frame coordinates : check_roi must be False
+    when the frames have already been cropped around it.
+
+    """
+    if params["grey method"] not in ["FFT", "separable"]:
+        raise NotImplementedError("Grey level images should be obtained with FFT or separable")
         
     assert params['scale'] >= 1
     if params['scale'] > 3:
@@ -111,13 +192,57 @@ def check_params_validity(params, imshape):
         warnings.warn("Warning.... Robustness based denoising is enabled, "
                       "but robustness is disabled. No further denoising will be done.")
         
+    if params['roi']['on'] and check_roi:
+        roi = params['roi']
+        assert roi['height'] > 0 and roi['width'] > 0
+        assert 0 <= roi['top'] and roi['top'] + roi['height'] <= imshape[0]
+        assert 0 <= roi['left'] and roi['left'] + roi['width'] <= imshape[1]
+    
+    if params['progressive']['on']:
+        assert params['progressive']['every'] >= 1
+    
+    if params['preview']['on']:
+        assert params['preview']['scale'] > 0
+        assert 1 <= params['preview']['levels'] <= len(params['block matching']['tuning']['factors'])
+    
     assert params['merging']['kernel'] in ['handheld', 'iso']
+    assert params['merging']['kernel storage'] in ['covariance', 'inverse']
+    assert params['merging']['engine'] in ['gather', 'tiled']
     assert params['mode'] in ["bayer", 'grey']
     
+    if params['post processing']['on'] and params['post processing']['fused']:
+        assert params['post processing']['bit depth'] in [8, 16]
+    
     if (params['accumulated robustness denoiser']['median']['on'] and
         params['accumulated robustness denoiser']['gauss']['on']):
         warnings.warn("Warning.... 2 post processing blurrings are enabled. Is it a mistake?")
 
+    if params['frame rejection']['on']:
+        assert params['frame rejection']['tuning']['min sharpness'] >= 0
+        assert params['frame rejection']['tuning']['max residual'] > 0
+        assert 0 <= params['frame rejection']['tuning']['min robustness'] <= 1
+
+    if params['robustness']['on']:
+        assert params['robustness']['tuning']['local stats radius'] >= 1
+        assert params['robustness']['tuning']['local min radius'] >= 0
+
+    if params['global motion']['on']:
+        assert params['global motion']['tuning']['model'] in ['affine', 'homography']
+        assert params['global motion']['tuning']['max residual'] > 0
+        assert params['global motion']['tuning']['IRLS iter'] >= 1
+        assert params['global motion']['tuning']['kanadeIter'] >= 0
+        assert len(params['block matching']['tuning']['factors']) >= 2
+
+    if params['temporal prior']['on']:
+        assert params['temporal prior']['tuning']['max residual'] > 0
+        assert params['block matching']['tuning']['priorSearchRadius'] >= 0
+
+    bm_tuning = params['block matching']['tuning']
+    for engine, distance in zip(get_search_engines(bm_tuning), bm_tuning['distances']):
+        assert engine in ['brute force', 'partial distance', 'sliding sum', 'FFT']
+        if engine == 'FFT' and distance != 'L2':
+            raise ValueError("The FFT block matching engine only supports the L2 distance.")
+
     assert params['kanade']['tuning']['kanadeIter'] > 0
     assert params['kanade']['tuning']['sigma blur'] >= 0
     
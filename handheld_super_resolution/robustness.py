@@ -15,9 +15,12 @@ import time
 import math
 
 import numpy as np
+import scipy.ndimage
 from numba import cuda, uint8
+import torch as th
+import torch.nn.functional as F
 
-from .utils import getTime, DEFAULT_CUDA_FLOAT_TYPE,DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_THREADS, clamp
+from .utils import getTime, DEFAULT_CUDA_FLOAT_TYPE,DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_TORCH_FLOAT_TYPE, DEFAULT_THREADS, clamp
 
 def init_robustness(ref_img, options, params):
     """
@@ -71,7 +74,8 @@ def init_robustness(ref_img, options, params):
             current_time = getTime(
                 current_time, ' - Image decimated')
             
-        ref_local_stats = compute_local_stats(guide_ref_img)
+        ref_local_stats = compute_local_stats(guide_ref_img,
+                                              params['tuning']['local stats radius'])
         
         if verbose_3 :
             cuda.synchronize()
@@ -130,8 +134,6 @@ def compute_robustness(comp_img, ref_local_stats, flows, options, params):
         guide_imshape = imshape_y, imshape_x
           
     if r_on : 
-        r = cuda.device_array(guide_imshape, DEFAULT_NUMPY_FLOAT_TYPE)
-        
         # moving noise model to GPU
         cuda_std_curve = cuda.to_device(params['std_curve'])
         cuda_diff_curve = cuda.to_device(params['diff_curve'])
@@ -144,10 +146,8 @@ def compute_robustness(comp_img, ref_local_stats, flows, options, params):
         # Computing guide image
         if bayer_mode:
             guide_img = compute_guide_image(comp_img, CFA_pattern)
-            comp_local_stats = cuda.device_array(guide_imshape+(2, 3), dtype=DEFAULT_NUMPY_FLOAT_TYPE) # mu, sigma for rgb
         else:
             guide_img = comp_img[:, :, None] # addign 1 channel
-            comp_local_stats = cuda.device_array(guide_imshape + (2, 1), dtype=DEFAULT_NUMPY_FLOAT_TYPE) # mu, sigma
             
 
         # Computing local stats (before applying optical flow)
@@ -157,7 +157,8 @@ def compute_robustness(comp_img, ref_local_stats, flows, options, params):
             cuda.synchronize()
             current_time = getTime(current_time, ' - Image decimated to rgb')
             
-        comp_local_stats = compute_local_stats(guide_img)
+        comp_local_stats = compute_local_stats(guide_img,
+                                               params['tuning']['local stats radius'])
         
         if verbose_3 :
             cuda.synchronize()
@@ -199,7 +200,7 @@ def compute_robustness(comp_img, ref_local_stats, flows, options, params):
             current_time = getTime(
                 current_time, ' - Robustness Estimated')
 
-        r = local_min(R)
+        r = local_min(R, params['tuning']['local min radius'])
         
         if verbose_3:
             cuda.synchronize()
@@ -265,69 +266,63 @@ def cuda_compute_guide_image(raw_img, guide_img, CFA):
             
     guide_img[ty, tx, 1] = g/2
 
-def compute_local_stats(guide_img):
+def compute_local_stats(guide_img, radius=1):
     """
     Implementation of Algorithm 8: ComputeLocalStatistics
-    Computes the mean color and variance associated for each 3 by 3 patches of
-    the guide image G_n.
+    Computes the mean color and variance associated for each
+    (2*radius+1) by (2*radius+1) patches of the guide image G_n.
+    
+    The sums of the values and of their squares over the window are computed
+    with separable box filters, for all the channels at once, so that the
+    cost is linear in the radius. The image is extended by replicating its
+    borders.
 
     Parameters
     ----------
-    guide_img : device Array[guide_imshape_y, guide_imshape_x, channels]
-        Guide image G_n. 
+    guide_img : device Array[guide_imshape_y, guide_imshape_x, channels] or Array[guide_imshape_y, guide_imshape_x, channels]
+        Guide image G_n. numpy arrays are processed on the CPU.
+    radius : int, optional
+        Radius of the window. The default is 1 (3 by 3 patches).
         
     Returns
     -------
-    ref_local_stats : device Array[guide_imshape_y, guide_imshape_x, 2, channels]
+    ref_local_stats : device Array[guide_imshape_y, guide_imshape_x, 2, channels] or Array[guide_imshape_y, guide_imshape_x, 2, channels]
         Array that contains mu and sigma² for every position of the guide image.
 
 
     """
     *guide_imshape, n_channels = guide_img.shape
-    if n_channels == 1:
-        local_stats = cuda.device_array(guide_imshape + [2, 1], DEFAULT_NUMPY_FLOAT_TYPE) # mu, sigma
-    elif n_channels == 3:
-        local_stats = cuda.device_array(guide_imshape + [2, 3], DEFAULT_NUMPY_FLOAT_TYPE) # mu, sigma for rgb
-    else: 
+    if n_channels not in [1, 3]:
         raise ValueError("Incoherent number of channel : {}".format(n_channels))
     
-    threadsperblock = (DEFAULT_THREADS, DEFAULT_THREADS, 1) # maximum, we may take less
-    blockspergrid_x = math.ceil(guide_imshape[1]/threadsperblock[1])
-    blockspergrid_y = math.ceil(guide_imshape[0]/threadsperblock[0])
-    blockspergrid = (blockspergrid_x, blockspergrid_y, n_channels)
+    window = 2*radius + 1
     
-    cuda_compute_local_stats[blockspergrid, threadsperblock](guide_img, local_stats)
+    if isinstance(guide_img, np.ndarray):
+        values = guide_img.astype(DEFAULT_NUMPY_FLOAT_TYPE)
+        # E[x] and E[x²], stacked on a new axis
+        moments = np.stack((values, values*values), axis=2)
+        for axis in [0, 1]:
+            moments = scipy.ndimage.uniform_filter1d(moments, window, axis=axis, mode='nearest')
+        moments[:, :, 1] -= moments[:, :, 0]**2
+        return moments.astype(DEFAULT_NUMPY_FLOAT_TYPE)
     
-    return local_stats
+    th_guide_img = th.as_tensor(guide_img, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")
+    th_guide_img = th_guide_img.permute(2, 0, 1)[None] # [1, channels, y, x]
     
+    # E[x] and E[x²] for all channels
+    moments = th.cat((th_guide_img, th_guide_img*th_guide_img), dim=1)
+    moments = F.pad(moments, (radius, radius, radius, radius), mode='replicate')
+    moments = F.avg_pool2d(moments, (window, 1), stride=1) # box y
+    moments = F.avg_pool2d(moments, (1, window), stride=1) # box x
     
-@cuda.jit
-def cuda_compute_local_stats(guide_img, local_stats):
-    guide_imshape_y, guide_imshape_x, _ = guide_img.shape
+    moments = moments[0].reshape(2, n_channels, *guide_imshape).permute(2, 3, 0, 1)
     
-    idx, idy, channel = cuda.grid(3)
-    if not(0 <= idy < guide_imshape_y and
-           0 <= idx < guide_imshape_x):
-        return
-
-    local_stats_ = cuda.local.array(2, DEFAULT_CUDA_FLOAT_TYPE)
-    local_stats_[0] = 0
-    local_stats_[1] = 0
-
-    for i in range(-1, 2):
-        for j in range(-1, 2):
-            y = clamp(idy + i, 0, guide_imshape_y-1)
-            x = clamp(idx + j, 0, guide_imshape_x-1)
-
-            value = guide_img[y, x, channel]
-            local_stats_[0] += value
-            local_stats_[1] += value*value
-
-
-    # normalizing
-    channel_mean = local_stats_[0]/9
-    local_stats[idy, idx, 0, channel] = channel_mean
-    local_stats[idy, idx, 1, channel] = local_stats_[1]/9 - channel_mean*channel_mean
+    local_stats = cuda.device_array(guide_imshape + [2, n_channels], DEFAULT_NUMPY_FLOAT_TYPE) # mu, sigma
+    th_local_stats = th.as_tensor(local_stats, device="cuda")
+    th_local_stats[:, :, 0] = moments[:, :, 0]
+    th_local_stats[:, :, 1] = moments[:, :, 1] - moments[:, :, 0]**2
+    
+    return local_stats
         
         
 def compute_patch_dist(ref_local_stats, comp_local_stats, flows, tile_size):
@@ -583,51 +578,122 @@ def cuda_robustness_threshold(d_sq, sigma_sq, S, t, tile_size, bayer_mode, R):
     R[idy, idx] = clamp(S[patch_idy, patch_idx] * math.exp(-d_sq[idy, idx]/sigma_sq[idy, idx]) - t,
                         0, 1)
 
-def local_min(R):
+def local_min(R, radius=2):
     """
     Implementation of Algorithm 9: ComputeLocalMin
-    For each pixel of R, the minimum in a 5 by 5 window is estimated
-    and stored in r.
+    For each pixel of R, the minimum in a (2*radius+1) by (2*radius+1) window
+    is estimated and stored in r. The image is extended by replicating its
+    borders.
+    
+    The min filter is separable, and each 1D pass uses the van Herk/Gil-Werman
+    algorithm, so that the cost per pixel does not depend on the radius.
 
     Parameters
     ----------
-    R : Array[guide_imshape_y, guide_imshape_x]
-        Robustness map for every image
+    R : device Array[guide_imshape_y, guide_imshape_x] or Array[guide_imshape_y, guide_imshape_x]
+        Robustness map for every image. numpy arrays are processed on the CPU.
+    radius : int, optional
+        Radius of the window. The default is 2 (5 by 5 window).
 
     Returns
     -------
-    r : Array[guide_imshape_y, guide_imshape_x]
+    r : device Array[guide_imshape_y, guide_imshape_x] or Array[guide_imshape_y, guide_imshape_x]
         locally minimised version of R
 
     """
-    r = cuda.device_array(R.shape, DEFAULT_NUMPY_FLOAT_TYPE)
+    if isinstance(R, np.ndarray):
+        return scipy.ndimage.minimum_filter(R, size=2*radius+1, mode='nearest').astype(DEFAULT_NUMPY_FLOAT_TYPE)
     
-    threadsperblock = (DEFAULT_THREADS, DEFAULT_THREADS) # maximum, we may take less
-    blockspergrid_x = math.ceil(R.shape[1]/threadsperblock[1])
-    blockspergrid_y = math.ceil(R.shape[0]/threadsperblock[0])
-    blockspergrid = (blockspergrid_x, blockspergrid_y)
+    R_x = cuda.device_array(R.shape, R.dtype)
+    r = cuda.device_array(R.shape, DEFAULT_NUMPY_FLOAT_TYPE)
     
-    cuda_compute_local_min[blockspergrid, threadsperblock](R, r)
+    min_filter_1d(R, R_x, radius, axis=1)
+    min_filter_1d(R_x, r, radius, axis=0)
     
     return r
+
+def min_filter_1d(src, dst, radius, axis):
+    """
+    van Herk/Gil-Werman min filter along one axis. The extended line is cut
+    into blocks of the size of the window, and the running min is computed
+    forward and backward within each block. Any window then spans at most two
+    blocks, and its min is the min of a backward value and a forward value.
+
+    Parameters
+    ----------
+    src : device Array[imshape_y, imshape_x]
+        Input image
+    dst : device Array[imshape_y, imshape_x]
+        Filtered image
+    radius : int
+        Radius of the window
+    axis : int
+        Axis along which the image is filtered (0 or 1)
+
+    """
+    n_lines = src.shape[1 - axis]
+    length = src.shape[axis]
+    window = 2*radius + 1
+    n_blocks = math.ceil((length + 2*radius)/window)
     
-@cuda.jit
-def cuda_compute_local_min(R, r):
-    guide_imshape_y, guide_imshape_x = R.shape
+    forward_min = cuda.device_array((n_lines, n_blocks*window), DEFAULT_NUMPY_FLOAT_TYPE)
+    backward_min = cuda.device_array((n_lines, n_blocks*window), DEFAULT_NUMPY_FLOAT_TYPE)
     
-    idx, idy = cuda.grid(2)
-    if not(0 <= idy < guide_imshape_y and
-           0 <= idx < guide_imshape_x):
+    threadsperblock = (DEFAULT_THREADS, DEFAULT_THREADS) # maximum, we may take less
+    blockspergrid = (math.ceil(n_blocks/threadsperblock[0]),
+                     math.ceil(n_lines/threadsperblock[1]))
+    cuda_block_running_min[blockspergrid, threadsperblock](src, forward_min, backward_min, radius, axis)
+    
+    blockspergrid = (math.ceil(length/threadsperblock[0]),
+                     math.ceil(n_lines/threadsperblock[1]))
+    cuda_merge_running_min[blockspergrid, threadsperblock](forward_min, backward_min, dst, radius, axis)
+    
+@cuda.jit
+def cuda_block_running_min(src, forward_min, backward_min, radius, axis):
+    block, line = cuda.grid(2)
+    n_lines, extended_length = forward_min.shape
+    window = 2*radius + 1
+    if not(0 <= line < n_lines and
+           0 <= block*window < extended_length):
         return
+    
+    length = src.shape[axis]
+    start = block*window
+    
+    # The extended line is the line padded with radius replicated values
+    # on each side
+    mini = math.inf
+    for i in range(start, start + window):
+        pos = clamp(i - radius, 0, length - 1)
+        if axis == 1:
+            mini = min(mini, src[line, pos])
+        else:
+            mini = min(mini, src[pos, line])
+        forward_min[line, i] = mini
+    
+    mini = math.inf
+    for i in range(start + window - 1, start - 1, -1):
+        pos = clamp(i - radius, 0, length - 1)
+        if axis == 1:
+            mini = min(mini, src[line, pos])
+        else:
+            mini = min(mini, src[pos, line])
+        backward_min[line, i] = mini
 
-    mini = +1/0
+@cuda.jit
+def cuda_merge_running_min(forward_min, backward_min, dst, radius, axis):
+    pos, line = cuda.grid(2)
+    n_lines = forward_min.shape[0]
+    length = dst.shape[axis]
+    if not(0 <= line < n_lines and
+           0 <= pos < length):
+        return
     
-    #local min search
-    for i in range(-2, 3):
-        y = clamp(idy + i, 0, guide_imshape_y)
-        for j in range(-2, 3):
-            x = clamp(idx + j, 0, guide_imshape_x)
-            mini = min(mini, R[y, x])
+    # The window of pos covers [pos, pos + 2*radius] in the extended line
+    mini = min(backward_min[line, pos], forward_min[line, pos + 2*radius])
     
-    r[idy, idx] = mini
+    if axis == 1:
+        dst[line, pos] = mini
+    else:
+        dst[pos, line] = mini
         
\ No newline at end of file
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 15:27:48 2026
+
+This script contains the region of interest (ROI) handling : when only a
+crop of the output is needed, every frame of the burst is cropped around
+the ROI before being processed. The crop contains a margin, large enough
+for the alignment, the robustness, the kernels and the merge of the ROI
+to be the same as if the full frame was processed.
+
+
+@author: jamyl
+"""
+
+import math
+
+import numpy as np
+
+
+def get_roi_margin(params):
+    """
+    Returns the margin (in raw pixels) required around the ROI.
+
+    The compared frames must contain every pixel the ROI can be aligned
+    on, which is bounded by the search radius of each pyramid level of the
+    block matching. The blurs (pyramid, ICA gradients), the local
+    statistics and the merge also read a few neighbouring pixels.
+
+    Parameters
+    ----------
+    params : dict
+        paramters.
+
+    Returns
+    -------
+    margin : int
+
+    """
+    bm_params = params['block matching']['tuning']
+
+    # Maximum displacement found by block matching
+    bm_margin = 0
+    cumulative_factor = 1
+    for factor, search_radius in zip(bm_params['factors'], bm_params['searchRadia']):
+        cumulative_factor *= factor
+        bm_margin += search_radius * cumulative_factor
+
+    # Radius of the gaussian blur of the coarsest pyramid level
+    blur_margin = int(4*0.5*cumulative_factor + 0.5)
+    blur_margin += int(4*params['kanade']['tuning']['sigma blur'] + 0.5)
+
+    # Neighbourhood read by the merge, in raw pixels (the merge works on
+    # the guide image, which has half the resolution in bayer mode)
+    merge_params = params['accumulated robustness denoiser']['merge']
+    merge_rad = merge_params['rad max'] if merge_params['on'] else 1
+    merge_margin = 2*(merge_rad + 1)
+
+    # Local stats of the robustness and the post-processing denoisers
+    stats_margin = 2*(params['robustness']['tuning']['local stats radius'] +
+                      params['robustness']['tuning']['local min radius'])
+    median_params = params['accumulated robustness denoiser']['median']
+    gauss_params = params['accumulated robustness denoiser']['gauss']
+    denoise_margin = 0
+    if median_params['on']:
+        denoise_margin = max(denoise_margin, math.ceil(min(14, median_params['radius max'])/params['scale']))
+    if gauss_params['on']:
+        denoise_margin = max(denoise_margin, math.ceil(4*gauss_params['sigma max']/params['scale']))
+
+    return bm_margin + blur_margin + merge_margin + stats_margin + denoise_margin
+
+def get_roi_crop(imshape, params):
+    """
+    Returns the crop of the input frames required to process the ROI, and
+    where the ROI lies in the output of this crop.
+
+    The crop is aligned on the tile grid of the coarsest pyramid level
+    (which is also a multiple of the finest tile size and of the bayer
+    pattern), so that tiles, pyramid and CFA are the same as in the full
+    frame.
+
+    Parameters
+    ----------
+    imshape : tuple (int, int)
+        Shape of the reference frame.
+    params : dict
+        paramters.
+
+    Returns
+    -------
+    input_crop : tuple (slice, slice)
+        Crop of the input frames
+    output_crop : tuple (slice, slice)
+        Crop of the output of the pipeline that corresponds to the ROI
+
+    """
+    roi = params['roi']
+    imshape_y, imshape_x = imshape
+    scale = params['scale']
+
+    bm_params = params['block matching']['tuning']
+    total_factor = int(np.prod(bm_params['factors']))
+    Ts = bm_params['tileSizes'][0]
+    alignment = int(np.lcm(total_factor, Ts))
+
+    # The crop must be large enough for the coarsest pyramid level to
+    # contain at least one tile
+    min_size = max([int(np.prod(bm_params['factors'][:lv+1])) * ts
+                    for lv, ts in enumerate(bm_params['tileSizes'])])
+
+    margin = get_roi_margin(params)
+
+    bounds = []
+    for start, length, size in [(roi['top'], roi['height'], imshape_y),
+                                (roi['left'], roi['width'], imshape_x)]:
+        crop_start = max(0, start - margin)
+        crop_start = alignment * (crop_start // alignment)
+        crop_end = min(size, start + length + margin)
+
+        # enlarging the crop if it is too small
+        if crop_end - crop_start < min_size:
+            crop_end = min(size, crop_start + min_size)
+            crop_start = max(0, alignment * ((crop_end - min_size) // alignment))
+
+        bounds.append((crop_start, crop_end,
+                       round(scale*(start - crop_start)), round(scale*(start - crop_start + length))))
+
+    (y0, y1, out_y0, out_y1), (x0, x1, out_x0, out_x1) = bounds
+
+    input_crop = (slice(y0, y1), slice(x0, x1))
+    output_crop = (slice(out_y0, out_y1), slice(out_x0, out_x1))
+
+    return input_crop, output_crop
@@ -16,29 +16,40 @@ This script contains :
 
 import os
 import glob
+import warnings
 import time
+import math
+from concurrent.futures import ThreadPoolExecutor
 
 from pathlib import Path
 import numpy as np
 from numba import cuda
+import torch as th
 import exifread
 import rawpy
 
 from . import raw2rgb
-from .utils import getTime, DEFAULT_NUMPY_FLOAT_TYPE, divide, add
-from .utils_image import compute_grey_images, frame_count_denoising_gauss, frame_count_denoising_median
+from .finishing import finish
+from .utils import getTime, to_host, DEFAULT_NUMPY_FLOAT_TYPE, divide, add
+from .utils_image import compute_grey_images, compute_sharpness_score, frame_count_denoising_gauss, frame_count_denoising_median
 from .merge import merge, merge_ref
 from .kernels import estimate_kernels
-from .block_matching import init_block_matching, align_image_block_matching
-from .ICA import ICA_optical_flow, init_ICA
+from .block_matching import align_image_block_matching, align_image_from_prior, upscale_alignments
+from .global_motion import align_image_global_motion
+from .ICA import ICA_optical_flow
+from .grey_frame import GreyFrame, init_grey_frame
+from .cache import hash_array, make_key, select_params, REFERENCE_PARAMS, ALIGNMENT_PARAMS, ROBUSTNESS_PARAMS, STATE_PARAMS
 from .robustness import init_robustness, compute_robustness
-from .params import check_params_validity, get_params, merge_params
+from .accumulator import AccumulatorState
+from .roi import get_roi_crop
+from .frame_rejection import init_frame_rejection, compute_alignment_residual, check_sharpness, check_alignment, check_robustness, reject_frame
+from .params import check_params_validity, get_params, merge_params, get_reference_selection_params
 
 NOISE_MODEL_PATH = Path(os.getcwd()) / 'data' 
         
 
 
-def main(ref_img, comp_imgs, options, params):
+def main(ref_img, comp_imgs, options, params, coarse_alignments=None, state=None, normalize=True):
     """
     This is the implementation of Alg. 1: HandheldBurstSuperResolution.
     Some part of Alg. 2: Registration are also integrated for optimisation.
@@ -54,6 +65,21 @@ def main(ref_img, comp_imgs, options, params):
         verbose options.
     params : dict
         paramters.
+    coarse_alignments : list [device Array], optional
+        Alignments of the coarse pyramid levels computed by preview(). When
+        given, the block matching resumes from them instead of aligning
+        the coarse levels again. The default is None.
+    state : AccumulatorState, optional
+        State of a burst that has already been (partially) merged. When
+        given, the reference frame is not processed again (ref_img is
+        ignored), comp_imgs are merged into the state and the accumulators
+        of the state are not modified by the final normalisation, so that
+        more frames can be merged later. The default is None.
+    normalize : bool, optional
+        When False, the accumulators are not normalised : num is the
+        numerator, and the denominator is returned in debug_dict['den'], so
+        that the normalisation can be fused with the finishing. The default
+        is True.
 
     Returns
     -------
@@ -64,25 +90,61 @@ def main(ref_img, comp_imgs, options, params):
 
     """
     verbose = options['verbose'] >= 1
-    verbose_2 = options['verbose'] >= 2
-    verbose_3 = options['verbose'] >= 3
-    
-    bayer_mode = params['mode']=='bayer'
-    
-    debug_mode = params['debug']
-    debug_dict = {"robustness":[],
-                  "flow":[]}
     
     accumulate_r = params['accumulated robustness denoiser']['on']
-
-    #___ Moving to GPU
-    cuda_ref_img = cuda.to_device(ref_img)
-    cuda.synchronize()
+    # When the state is given by the caller, the accumulators are left
+    # untouched so that the burst can be extended later.
+    in_place = state is None
     
     if verbose :
-        print("\nProcessing reference image ---------\n")
         t1 = time.perf_counter()
     
+    if state is None:
+        state = init_accumulator(ref_img, options, params)
+    
+    debug_dict = merge_frames(state, comp_imgs, options, params, coarse_alignments)
+    
+    num, den = finalize(state, options, params, in_place=in_place, normalize=normalize)
+    if not normalize:
+        debug_dict['den'] = den
+    
+    if verbose :
+        print('\nTotal ellapsed time : ', time.perf_counter() - t1)
+    
+    if accumulate_r :
+        debug_dict['accumulated robustness'] = state.accumulated_r
+        
+    return num, debug_dict
+
+
+def init_reference(cuda_ref_img, options, params):
+    """
+    Computes what only depends on the reference frame and the alignment
+    and robustness parameters : the grey frame G_1 (with its pyramid,
+    gradients and hessian) and the local stats of J_1.
+
+    Parameters
+    ----------
+    cuda_ref_img : device Array[imshape_y, imshape_x]
+        Reference frame J_1
+    options : dict
+        verbose options.
+    params : dict
+        paramters.
+
+    Returns
+    -------
+    ref_frame : GreyFrame
+        Reference grey frame
+    ref_local_stats : device Array
+        Local statistics of J_1 used by the robustness
+
+    """
+    verbose_2 = options['verbose'] >= 2
+    verbose_3 = options['verbose'] >= 3
+    
+    bayer_mode = params['mode']=='bayer'
+    current_time = time.perf_counter()
     
     #___ Raw to grey
     grey_method = params['grey method']
@@ -91,34 +153,21 @@ def main(ref_img, comp_imgs, options, params):
         cuda_ref_grey = compute_grey_images(cuda_ref_img, grey_method)
         if verbose_3 :
             cuda.synchronize()
-            getTime(t1, "- Ref grey image estimated by {}".format(grey_method))
+            getTime(current_time, "- Ref grey image estimated by {}".format(grey_method))
     else:
         cuda_ref_grey = cuda_ref_img
         
-    #___ Block Matching
+    #___ Block Matching and ICA : compute pyramid, grad and hessian
     if verbose_2 :
         cuda.synchronize()
         current_time = time.perf_counter()
-        print('\nBeginning Block Matching initialisation')
-        
-    reference_pyramid = init_block_matching(cuda_ref_grey, options, params['block matching'])
-    
-    if verbose_2 :
-        cuda.synchronize()
-        current_time = getTime(current_time, 'Block Matching initialised (Total)')
+        print('\nBeginning Block Matching and ICA initialisation')
         
+    ref_frame = init_grey_frame(cuda_ref_grey, options, params, reference=True)
     
-    #___ ICA : compute grad and hessian    
     if verbose_2 :
         cuda.synchronize()
-        current_time = time.perf_counter()
-        print('\nBeginning ICA initialisation')
-        
-    ref_gradx, ref_grady, hessian = init_ICA(cuda_ref_grey, options, params['kanade'])
-    
-    if verbose_2 :
-        cuda.synchronize()
-        current_time = getTime(current_time, 'ICA initialised (Total)')
+        current_time = getTime(current_time, 'Block Matching and ICA initialised (Total)')
     
     
     #___ Local stats estimation
@@ -129,14 +178,84 @@ def main(ref_img, comp_imgs, options, params):
         
     ref_local_stats = init_robustness(cuda_ref_img,options, params['robustness'])
     
+    if verbose_2 :
+        cuda.synchronize()
+        current_time = getTime(current_time, 'Local stats estimated (Total)')
+    
+    return ref_frame, ref_local_stats
+
+
+def init_accumulator(ref_img, options, params):
+    """
+    Processes the reference frame J_1 : everything that only depends on it
+    is computed, and the accumulators are initialised.
+
+    Parameters
+    ----------
+    ref_img : Array[imshape_y, imshape_x]
+        Reference frame J_1
+    options : dict
+        verbose options.
+    params : dict
+        paramters.
+
+    Returns
+    -------
+    state : AccumulatorState
+        Reference-side state, with empty accumulators.
+
+    """
+    verbose = options['verbose'] >= 1
+    verbose_2 = options['verbose'] >= 2
+    
+    accumulate_r = params['accumulated robustness denoiser']['on']
+
+    #___ Moving to GPU
+    cuda_ref_img = cuda.to_device(ref_img)
+    cuda.synchronize()
+    
+    if verbose :
+        print("\nProcessing reference image ---------\n")
+        t1 = time.perf_counter()
+    
+    
+    #___ Reference-side cache
+    cache = options.get('cache', None)
+    cache_key = None
+    cached = None
+    if cache is not None:
+        cache_key = hash_array(ref_img)
+        reference_key = make_key('reference', cache_key, select_params(params, REFERENCE_PARAMS))
+        cached = cache.get(reference_key)
+    
+    if cached is not None:
+        ref_frame = GreyFrame.from_host(cached)
+        ref_local_stats = cuda.to_device(cached['local_stats'])
+        if verbose_2:
+            print('\nReference grey frame and local stats loaded from cache')
+    else:
+        ref_frame, ref_local_stats = init_reference(cuda_ref_img, options, params)
+        if cache is not None:
+            cache.put(reference_key, dict(ref_frame.to_host(),
+                                          local_stats=to_host(ref_local_stats)))
+    
     if accumulate_r:
         accumulated_r = cuda.to_device(np.zeros(ref_local_stats.shape[:2]))
-
+    else:
+        accumulated_r = None
     
+    #___ Ref kernel estimation
+    # They are needed at the very end, but also for every intermediate result
+    if verbose_2 : 
+        cuda.synchronize()
+        current_time = time.perf_counter()
+        print('\nEstimating kernels')
+        
+    ref_kernels = estimate_kernels(cuda_ref_img, options, params['merging'])
     
-    if verbose_2 :
+    if verbose_2 : 
         cuda.synchronize()
-        current_time = getTime(current_time, 'Local stats estimated (Total)')
+        current_time = getTime(current_time, 'Kernels estimated (Total)')
 
     # zeros init of num and den
     scale = params["scale"]
@@ -149,6 +268,201 @@ def main(ref_img, comp_imgs, options, params):
         cuda.synchronize()
         getTime(t1, '\nRef Img processed (Total)')
     
+    return AccumulatorState(cuda_ref_img, ref_frame,
+                            ref_local_stats, ref_kernels,
+                            num, den, accumulated_r, cache_key=cache_key)
+
+
+def align_frame(cuda_img, state, options, params, ref_stats=None, prior_flow=None,
+                coarse_alignment=None, global_kanade_params=None):
+    """
+    Computes the grey frame of J_n, and aligns it on the reference with
+    block matching (or one of its fast paths) and ICA. The frame rejection
+    checks that need the grey image are also run.
+
+    Parameters
+    ----------
+    cuda_img : device Array[imshape_y, imshape_x]
+        Compared frame J_n
+    state : AccumulatorState
+        Reference-side state
+    options : dict
+        verbose options.
+    params : dict
+        paramters.
+    ref_stats : tuple(float, float), optional
+        Sharpness and brightness of G_1, required for the frame rejection
+        and the temporal prior. The default is None.
+    prior_flow : device Array[n_tiles_y, n_tiles_x, 2], optional
+        Flow of the previous frame, used as a temporal prior. The default
+        is None.
+    coarse_alignment : device Array, optional
+        Alignment of the coarse pyramid levels computed by preview().
+        The default is None.
+    global_kanade_params : dict, optional
+        ICA parameters used when the flow is generated from the global
+        motion model. The default is None.
+
+    Returns
+    -------
+    cuda_final_alignment : device Array[n_tiles_y, n_tiles_x, 2] or None
+        Patchwise flow V_n. None if the frame was rejected before alignment.
+    reason : str or None
+        Reason of the rejection of the frame, if it is rejected.
+
+    """
+    verbose_2 = options['verbose'] >= 2
+    verbose_3 = options['verbose'] >= 3
+    current_time = time.perf_counter()
+    
+    bayer_mode = params['mode']=='bayer'
+    grey_method = params['grey method']
+    reject_frames = params['frame rejection']['on']
+    if ref_stats is not None:
+        ref_sharpness, ref_brightness = ref_stats
+    
+    #___ Compute Grey Images
+    if bayer_mode:
+        cuda_im_grey = compute_grey_images(cuda_img, grey_method)
+        if verbose_3 :
+            cuda.synchronize()
+            current_time = getTime(current_time, "- grey images estimated by {}".format(grey_method))
+    else:
+        cuda_im_grey = cuda_img
+    
+    #___ Frame rejection : sharpness
+    if reject_frames:
+        reason = check_sharpness(cuda_im_grey, ref_sharpness, params['frame rejection'])
+        if reason is not None:
+            return None, reason
+    
+    #___ Block Matching
+    if verbose_2 :
+        cuda.synchronize()
+        current_time = time.perf_counter()
+        print('Beginning block matching')
+    
+    # The padded grey image and its pyramid are shared with ICA
+    comp_frame = init_grey_frame(cuda_im_grey, options, params)
+    
+    pre_alignment = None
+    global_fit = False
+    if coarse_alignment is None and prior_flow is not None:
+        pre_alignment = align_image_from_prior(comp_frame.pyramid, state.ref_frame.pyramid, prior_flow,
+                                               options, params['block matching'])
+        # Falling back to the full search if the prior was wrong
+        residual = compute_alignment_residual(comp_frame.grey, state.ref_frame.grey, pre_alignment,
+                                              params['kanade']['tuning']['tileSize'])/ref_brightness
+        if not residual <= params['temporal prior']['tuning']['max residual']:
+            if verbose_2:
+                print('Temporal prior rejected (residual {:.3f}), full search'.format(residual))
+            pre_alignment = None
+    
+    if coarse_alignment is not None:
+        pre_alignment = align_image_block_matching(comp_frame.pyramid, state.ref_frame.pyramid, options, params['block matching'],
+                                                   first_level=params['preview']['levels'],
+                                                   previous_alignments=coarse_alignment)
+    elif pre_alignment is None and params['global motion']['on']:
+        pre_alignment, global_fit = align_image_global_motion(comp_frame, state.ref_frame.pyramid, options,
+                                                              params['block matching'], params['global motion'])
+        if verbose_2 and not global_fit:
+            print('Global motion rejected, full search')
+    elif pre_alignment is None:
+        pre_alignment = align_image_block_matching(comp_frame.pyramid, state.ref_frame.pyramid, options, params['block matching'])
+    
+    if verbose_2 :
+        cuda.synchronize()
+        current_time = getTime(current_time, 'Block Matching (Total)')
+        
+        
+    #___ ICA
+    if verbose_2 :
+        cuda.synchronize()
+        current_time = time.perf_counter()
+        print('\nBeginning ICA alignment')
+    
+    cuda_final_alignment = ICA_optical_flow(
+        comp_frame.grey, state.ref_frame.grey, state.ref_frame.gradx, state.ref_frame.grady, state.ref_frame.hessian,
+        pre_alignment, options, global_kanade_params if global_fit else params['kanade'])
+    
+    if verbose_2 : 
+        cuda.synchronize()
+        current_time = getTime(current_time, 'Image aligned using ICA (Total)')
+        
+    #___ Frame rejection : alignment residual
+    if reject_frames:
+        reason = check_alignment(comp_frame.grey, state.ref_frame.grey, ref_brightness,
+                                 cuda_final_alignment, params['frame rejection'])
+        if reason is not None:
+            return cuda_final_alignment, reason
+    
+    return cuda_final_alignment, None
+
+
+def merge_frames(state, comp_imgs, options, params, coarse_alignments=None):
+    """
+    Aligns the frames J_2, ..., J_N on the reference and accumulates them
+    into the accumulators of the state.
+
+    Parameters
+    ----------
+    state : AccumulatorState
+        Reference-side state and accumulators, which are updated.
+    comp_imgs : Array[N-1, imshape_y, imshape_x]
+        Frames to merge J_2, ..., J_N
+    options : dict
+        verbose options.
+    params : dict
+        paramters.
+    coarse_alignments : list [device Array], optional
+        Alignments of the coarse pyramid levels computed by preview().
+        The default is None.
+
+    Returns
+    -------
+    debug_dict : dict
+        Contains (if debugging is enabled) some debugging infos.
+
+    """
+    verbose = options['verbose'] >= 1
+    verbose_2 = options['verbose'] >= 2
+    verbose_3 = options['verbose'] >= 3
+    
+    debug_mode = params['debug']
+    debug_dict = {"robustness":[],
+                  "flow":[],
+                  "rejected frames":[],
+                  "merged frames":[]}
+    
+    accumulate_r = params['accumulated robustness denoiser']['on']
+    reject_frames = params['frame rejection']['on']
+    temporal_prior = params['temporal prior']['on']
+    global_kanade_params = None
+    if params['global motion']['on']:
+        # ICA only refines the flow generated from the global model
+        global_kanade_params = dict(params['kanade'])
+        global_kanade_params['tuning'] = dict(params['kanade']['tuning'],
+                                              kanadeIter=params['global motion']['tuning']['kanadeIter'])
+    progressive = params['progressive']['on']
+    if progressive:
+        assert 'progressive callback' in options.keys(), "A callback is required in progressive mode"
+        snapshot_num = cuda.device_array_like(state.num)
+        snapshot_den = cuda.device_array_like(state.den)
+    
+    #___ Frame rejection : reference statistics
+    ref_stats = None
+    if reject_frames or temporal_prior:
+        ref_stats = init_frame_rejection(state.ref_frame.grey)
+    
+    #___ Computation cache
+    cache = options.get('cache', None)
+    if cache is not None and state.cache_key is None:
+        # state loaded from a file saved without cache
+        state.cache_key = hash_array(state.ref_img.copy_to_host())
+    
+    # Final flow of the previous aligned frame, used as a prior
+    prior_flow = None
+    
 
     n_images = comp_imgs.shape[0]
     for im_id in range(n_images):
@@ -163,55 +477,76 @@ def main(ref_img, comp_imgs, options, params):
             cuda.synchronize()
             current_time = getTime(im_time, 'Arrays moved to GPU')
         
-        #___ Compute Grey Images
-        if bayer_mode:
-            cuda_im_grey = compute_grey_images(comp_imgs[im_id], grey_method)
-            if verbose_3 :
-                cuda.synchronize()
-                current_time = getTime(current_time, "- grey images estimated by {}".format(grey_method))
+        #___ Alignment (and the frame rejection checks that need the grey image)
+        cached = None
+        if cache is not None:
+            alignment_key = make_key('alignment', state.cache_key, hash_array(comp_imgs[im_id]),
+                                     select_params(params, ALIGNMENT_PARAMS),
+                                     None if prior_flow is None else prior_flow.copy_to_host(),
+                                     None if coarse_alignments is None else coarse_alignments[im_id].copy_to_host())
+            cached = cache.get(alignment_key)
+        
+        if cached is not None:
+            cuda_final_alignment = cached['flow']
+            if cuda_final_alignment is not None:
+                cuda_final_alignment = cuda.to_device(cuda_final_alignment)
+            reason = cached['reason']
+            if verbose_2:
+                print('Alignment loaded from cache')
         else:
-            cuda_im_grey = cuda_img
+            cuda_final_alignment, reason = align_frame(
+                cuda_img, state, options, params, ref_stats, prior_flow,
+                None if coarse_alignments is None else coarse_alignments[im_id],
+                global_kanade_params)
+            if cache is not None:
+                cache.put(alignment_key, {'flow' : None if cuda_final_alignment is None else cuda_final_alignment.copy_to_host(),
+                                          'reason' : reason})
         
-        #___ Block Matching
-        if verbose_2 :
-            cuda.synchronize()
-            current_time = time.perf_counter()
-            print('Beginning block matching')
+        if debug_mode and cuda_final_alignment is not None:
+            debug_dict["flow"].append(cuda_final_alignment.copy_to_host())
         
-        pre_alignment = align_image_block_matching(cuda_im_grey, reference_pyramid, options, params['block matching'])
+        if reason is not None:
+            reject_frame(debug_dict, im_id, reason, verbose)
+            continue
         
-        if verbose_2 :
-            cuda.synchronize()
-            current_time = getTime(current_time, 'Block Matching (Total)')
+        if temporal_prior:
+            prior_flow = cuda_final_alignment
             
             
-        #___ ICA
+        #___ Robustness
         if verbose_2 :
             cuda.synchronize()
             current_time = time.perf_counter()
-            print('\nBeginning ICA alignment')
+            print('\nEstimating robustness')
         
-        cuda_final_alignment = ICA_optical_flow(
-            cuda_im_grey, cuda_ref_grey, ref_gradx, ref_grady, hessian, pre_alignment, options, params['kanade'])
+        cached = None
+        if cache is not None:
+            robustness_key = make_key('robustness', alignment_key,
+                                      select_params(params, ROBUSTNESS_PARAMS))
+            cached = cache.get(robustness_key)
         
-        if debug_mode:
-            debug_dict["flow"].append(cuda_final_alignment.copy_to_host())
-            
-        if verbose_2 : 
-            cuda.synchronize()
-            current_time = getTime(current_time, 'Image aligned using ICA (Total)')
+        if cached is not None:
+            cuda_robustness = cuda.to_device(cached['robustness'])
+            reason = cached['reason']
+        else:
+            cuda_robustness = compute_robustness(cuda_img, state.ref_local_stats, cuda_final_alignment,
+                                                 options, params['robustness'])
             
+            #___ Frame rejection : mean robustness
+            reason = None
+            if reject_frames:
+                reason = check_robustness(cuda_robustness, params['frame rejection'])
             
-        #___ Robustness
-        if verbose_2 :
-            cuda.synchronize()
-            current_time = time.perf_counter()
-            print('\nEstimating robustness')
+            if cache is not None:
+                cache.put(robustness_key, {'robustness' : to_host(cuda_robustness),
+                                           'reason' : reason})
+        
+        if reason is not None:
+            reject_frame(debug_dict, im_id, reason, verbose)
+            continue
             
-        cuda_robustness = compute_robustness(cuda_img, ref_local_stats, cuda_final_alignment,
-                                             options, params['robustness'])
         if accumulate_r:
-            add(accumulated_r, cuda_robustness)
+            add(state.accumulated_r, cuda_robustness)
         
         if verbose_2 :
             cuda.synchronize()
@@ -236,9 +571,12 @@ def main(ref_img, comp_imgs, options, params):
             current_time = time.perf_counter()
             print('\nAccumulating Image')
             
-        merge(cuda_img, cuda_final_alignment, cuda_kernels, cuda_robustness, num, den,
+        merge(cuda_img, cuda_final_alignment, cuda_kernels, cuda_robustness, state.num, state.den,
               options, params['merging'])
         
+        state.n_merged += 1
+        debug_dict['merged frames'].append(im_id)
+        
         if verbose_2 :
             cuda.synchronize()
             current_time = getTime(current_time, 'Image accumulated (Total)')
@@ -248,52 +586,339 @@ def main(ref_img, comp_imgs, options, params):
             
         if debug_mode : 
             debug_dict['robustness'].append(cuda_robustness.copy_to_host())
+            
+        #___ Progressive output
+        if progressive and state.n_merged % params['progressive']['every'] == 0:
+            compute_snapshot(state.ref_img, state.ref_kernels, state.num, state.den,
+                             snapshot_num, snapshot_den,
+                             options, params, state.accumulated_r)
+            
+            stop = options['progressive callback'](snapshot_num.copy_to_host(), state.n_merged)
+            if stop:
+                if verbose:
+                    print('\nStopped after {} merged images'.format(state.n_merged))
+                break
     
-    #___ Ref kernel estimation
-    if verbose_2 : 
-        cuda.synchronize()
-        current_time = time.perf_counter()
-        print('\nEstimating kernels')
-        
-    cuda_kernels = estimate_kernels(cuda_ref_img, options, params['merging'])
-    
-    if verbose_2 : 
-        cuda.synchronize()
-        current_time = getTime(current_time, 'Kernels estimated (Total)')
+    return debug_dict
+
+
+def finalize(state, options, params, in_place=False, normalize=True):
+    """
+    Merges the reference frame and normalizes the accumulators.
+
+    Parameters
+    ----------
+    state : AccumulatorState
+        Reference-side state and accumulators.
+    options : dict
+        verbose options.
+    params : dict
+        paramters.
+    in_place : bool, optional
+        When True, the result is written in the accumulators of the state,
+        which cannot be extended anymore. Otherwise, new buffers are
+        allocated. The default is False.
+    normalize : bool, optional
+        When False, num is left unnormalized. The default is True.
+
+    Returns
+    -------
+    num : device Array[imshape_y*s, imshape_y*s, 3]
+        generated RGB image WITHOUT any post-processing, or its numerator
+        if normalize is False.
+    den : device Array[imshape_y*s, imshape_y*s, 3]
+        Denominator of the output.
+
+    """
+    verbose_2 = options['verbose'] >= 2
     
     #___ Merge ref
     if verbose_2 :
         cuda.synchronize()
+        current_time = time.perf_counter()
         print('\nAccumulating ref Img')
     
-    if accumulate_r:     
-        merge_ref(cuda_ref_img, cuda_kernels,
-                  num, den,
-                  options, params["merging"], accumulated_r)
+    if in_place:
+        num, den = state.num, state.den
     else:
-        merge_ref(cuda_ref_img, cuda_kernels,
-                  num, den,
-                  options, params["merging"])
+        num = cuda.device_array_like(state.num)
+        den = cuda.device_array_like(state.den)
     
-    if verbose_2 : 
-        cuda.synchronize()
-        getTime(current_time, 'Ref Img accumulated (Total)')
-        
-    # num is outwritten into num/den
-    divide(num, den)
+    # num is outwritten into num/den, unless the normalization is deferred
+    compute_snapshot(state.ref_img, state.ref_kernels, state.num, state.den,
+                     num, den,
+                     options, params, state.accumulated_r, normalize)
     
     if verbose_2 :
         print('\n------------------------')
         cuda.synchronize()
-        current_time = getTime(current_time, 'Image normalized (Total)')
+        current_time = getTime(current_time, 'Ref Img accumulated and image normalized (Total)')
+    
+    return num, den
+
+
+def compute_snapshot(cuda_ref_img, ref_kernels, num, den,
+                     snapshot_num, snapshot_den,
+                     options, params, accumulated_r=None, normalize=True):
+    """
+    Computes the normalized output that would be obtained if the merge
+    stopped now, without modifying the accumulators : num and den are
+    copied into the snapshot buffers, where the reference image is merged
+    and the normalization is done.
+
+    Parameters
+    ----------
+    cuda_ref_img : device Array[imshape_y, imshape_x]
+        Reference frame J_1
+    ref_kernels : device Array[imshape_y//2, imshape_x//2, 3]
+        Covariance Matrices Omega_1
+    num : device Array[s*imshape_y, s*imshape_x, 3]
+        Numerator of the accumulator
+    den : device Array[s*imshape_y, s*imshape_x, 3]
+        Denominator of the accumulator
+    snapshot_num : device Array[s*imshape_y, s*imshape_x, 3]
+        Buffer where the snapshot is written
+    snapshot_den : device Array[s*imshape_y, s*imshape_x, 3]
+        Buffer for the denominator of the snapshot
+    options : dict
+        verbose options.
+    params : dict
+        paramters.
+    accumulated_r : device Array[imshape_y//2, imshape_x//2], optional
+        Robustness accumulated so far. The default is None.
+    normalize : bool, optional
+        When False, the snapshot is not divided by snapshot_den. The
+        default is True.
+
+    Returns
+    -------
+    snapshot_num : device Array[s*imshape_y, s*imshape_x, 3]
+        Normalized snapshot
+
+    """
+    # the snapshot can be computed in place, when the accumulators are not needed anymore
+    if snapshot_num is not num:
+        snapshot_num.copy_to_device(num)
+        snapshot_den.copy_to_device(den)
+    
+    merge_ref(cuda_ref_img, ref_kernels,
+              snapshot_num, snapshot_den,
+              options, params["merging"], accumulated_r)
+    
+    if normalize:
+        divide(snapshot_num, snapshot_den)
+    
+    return snapshot_num
+
+
+def preview(ref_img, comp_imgs, options, params):
+    """
+    Fast, low resolution version of main(). The frames are only aligned on
+    the coarse levels of the pyramid (no ICA), no robustness is estimated,
+    and they are merged with the isotropic kernel onto an output grid
+    reduced by params['preview']['scale'].
+
+    Parameters
+    ----------
+    ref_img : Array[imshape_y, imshape_x]
+        Reference frame J_1
+    comp_imgs : Array[N-1, imshape_y, imshape_x]
+        Remaining frames of the burst J_2, ..., J_N
+    options : dict
+        verbose options.
+    params : dict
+        paramters.
+
+    Returns
+    -------
+    num : device Array[imshape_y*s_p, imshape_y*s_p, 3]
+        generated RGB preview WITHOUT any post-processing.
+    coarse_alignments : list [device Array]
+        Alignments of the coarse levels for each compared frame, that can be
+        given to main() to compute the full result.
+
+    """
+    verbose = options['verbose'] >= 1
+    verbose_2 = options['verbose'] >= 2
+    
+    bayer_mode = params['mode']=='bayer'
+    grey_method = params['grey method']
+    
+    n_levels = params['preview']['levels']
+    tile_size = params['kanade']['tuning']['tileSize']
+    
+    # The preview is merged with isotropic kernels, without any robustness
+    # aware denoising.
+    preview_merging_params = params['merging'].copy()
+    preview_merging_params['scale'] = params['preview']['scale']
+    preview_merging_params['kernel'] = 'iso'
+    preview_merging_params['accumulated robustness denoiser'] = {'on' : False}
     
     if verbose :
-        print('\nTotal ellapsed time : ', time.perf_counter() - t1)
+        print("\nProcessing preview ---------\n")
+        t1 = time.perf_counter()
     
-    if accumulate_r :
-        debug_dict['accumulated robustness'] = accumulated_r
+    cuda_ref_img = cuda.to_device(ref_img)
+    if bayer_mode :
+        cuda_ref_grey = compute_grey_images(cuda_ref_img, grey_method)
+    else:
+        cuda_ref_grey = cuda_ref_img
+    
+    ref_frame = init_grey_frame(cuda_ref_grey, options, params)
+    
+    # Alignments are upscaled to the tile grid of the finest level
+    imshape_y, imshape_x = cuda_ref_img.shape
+    n_tiles = (math.ceil(imshape_y/tile_size), math.ceil(imshape_x/tile_size))
+    
+    if bayer_mode:
+        guide_imshape = imshape_y//2, imshape_x//2
+    else:
+        guide_imshape = imshape_y, imshape_x
+    cuda_robustness = cuda.to_device(np.ones(guide_imshape, DEFAULT_NUMPY_FLOAT_TYPE))
+    # Covariances are not used by the isotropic kernel, but numba needs an array
+    cuda_kernels = cuda.device_array((1, 1, 3), DEFAULT_NUMPY_FLOAT_TYPE)
+    
+    output_size = (round(preview_merging_params['scale']*imshape_y), round(preview_merging_params['scale']*imshape_x))
+    num = cuda.to_device(np.zeros(output_size+(3,), dtype = DEFAULT_NUMPY_FLOAT_TYPE))
+    den = cuda.to_device(np.zeros(output_size+(3,), dtype = DEFAULT_NUMPY_FLOAT_TYPE))
+    
+    coarse_alignments = []
+    for im_id in range(comp_imgs.shape[0]):
+        cuda_img = cuda.to_device(comp_imgs[im_id])
+        if bayer_mode:
+            cuda_im_grey = compute_grey_images(cuda_img, grey_method)
+        else:
+            cuda_im_grey = cuda_img
         
-    return num, debug_dict
+        comp_frame = init_grey_frame(cuda_im_grey, options, params)
+        alignments = align_image_block_matching(comp_frame.pyramid, ref_frame.pyramid, options, params['block matching'],
+                                                last_level=n_levels)
+        coarse_alignments.append(alignments)
+        
+        upscaled_alignments = upscale_alignments(alignments, n_levels - 1, params['block matching'],
+                                                 tile_size, n_tiles)
+        
+        merge(cuda_img, upscaled_alignments, cuda_kernels, cuda_robustness, num, den,
+              options, preview_merging_params)
+        
+        if verbose_2 :
+            cuda.synchronize()
+            getTime(t1, 'Image {} merged in preview'.format(im_id+1))
+    
+    merge_ref(cuda_ref_img, cuda_kernels,
+              num, den,
+              options, preview_merging_params)
+    
+    divide(num, den)
+    
+    if verbose :
+        cuda.synchronize()
+        getTime(t1, '\nPreview processed (Total)')
+    
+    return num, coarse_alignments
+
+
+def apply_post_processing(handheld_output, raw, xyz2cam, params_pp, verbose=False, den=None):
+    """
+    Moves the output of the pipeline to the host and applies the
+    post-processing (if enabled).
+
+    Parameters
+    ----------
+    handheld_output : device Array[s*imshape_y, s*imshape_x, 3]
+        Output of the handheld pipeline
+    raw : rawpy object
+        Reference raw file
+    xyz2cam : Array[3, 3]
+        Color matrix of the camera
+    params_pp : dict
+        Post processing parameters
+    verbose : bool, optional
+        The default is False.
+    den : device Array[s*imshape_y, s*imshape_x, 3], optional
+        If given, handheld_output is the numerator of the accumulators and
+        is not normalized yet. The default is None.
+
+    Returns
+    -------
+    output_image : Array[s*imshape_y, s*imshape_x, 3]
+        float image, or uint8/uint16 image if the fused post-processing
+        is enabled.
+
+    """
+    fused = params_pp['on'] and params_pp['fused']
+    
+    # the normalization is fused with the finishing when possible
+    if den is not None and not fused:
+        divide(handheld_output, den)
+    
+    if fused:
+        if verbose:
+            print('-- Fused post processing of the image')
+        
+        output_image = finish(handheld_output, raw, xyz2cam, params_pp, den=den)
+        
+    elif params_pp['on']:
+        if verbose:
+            print('-- Post processing image')
+            
+        output_image = raw2rgb.postprocess(raw, handheld_output.copy_to_host(),
+                                           params_pp['do color correction'],
+                                           params_pp['do tonemapping'],
+                                           params_pp['do gamma'],
+                                           params_pp['do sharpening'],
+                                           params_pp['do devignette'],
+                                           xyz2cam,
+                                           params_pp['sharpening']
+                                           ) 
+    else:
+        output_image = handheld_output.copy_to_host()
+    
+    return output_image
+
+
+def read_burst(raw_path_list, ref_selection_params):
+    """
+    Reads the raw bayer data of every file of the burst. The files are read
+    in parallel, and when the reference selection is enabled, the sharpness
+    of the reference candidates is scored as soon as they are read, while the
+    remaining files are still being read.
+
+    Parameters
+    ----------
+    raw_path_list : list of str
+        Paths of the raw files, in the capture order
+    ref_selection_params : dict
+        Parameters of the reference selection
+
+    Returns
+    -------
+    raws : list of Array[imshape_y, imshape_x]
+        Raw images of the burst
+    sharpness_scores : list of float
+        Sharpness scores of the reference candidates. Empty when the
+        reference selection is disabled.
+
+    """
+    n_candidates = ref_selection_params['candidates'] if ref_selection_params['on'] else 0
+    decimation = ref_selection_params['decimation']
+    
+    def read_raw(index):
+        with rawpy.imread(raw_path_list[index]) as rawObject:
+            raw_img = rawObject.raw_image.copy()  # copy otherwise image data is lost when the rawpy object is closed
+        
+        score = None
+        if index < n_candidates:
+            score = compute_sharpness_score(raw_img, decimation)
+        return raw_img, score
+    
+    with ThreadPoolExecutor() as executor:
+        results = list(executor.map(read_raw, range(len(raw_path_list))))
+    
+    raws = [raw_img for raw_img, _ in results]
+    sharpness_scores = [score for _, score in results[:n_candidates]]
+    
+    return raws, sharpness_scores
 
 
 def process(burst_path, options=None, custom_params=None):
@@ -320,26 +945,48 @@ def process(burst_path, options=None, custom_params=None):
     currentTime, verbose_1, verbose_2 = (time.perf_counter(),
                                          options['verbose'] >= 1,
                                          options['verbose'] >= 2)
-    params = {}
     
-    ref_id = 0 #TODO Select ref id based on HDR+ method
+    # Get the list of raw images in the burst path, in the capture order
+    raw_path_list = sorted(glob.glob(os.path.join(burst_path, '*.dng')))
+    assert len(raw_path_list) != 0, 'At least one raw .dng file must be present in the burst folder.'
     
-    raw_comp = []
+    ref_selection_params = get_reference_selection_params(custom_params)
+    
+    #___ Extending a burst that was already merged
+    state = None
+    if 'load state' in options.keys():
+        state = AccumulatorState.load(options['load state'])
+        # The reference is the one of the state, and only the files that
+        # were not processed yet are read
+        assert state.reference_path in raw_path_list, 'The reference file of the state is missing from the burst folder.'
+        raw_path_list = [state.reference_path] + [path for path in raw_path_list
+                                                  if path != state.reference_path and
+                                                  path not in state.merged_paths]
+        ref_selection_params['on'] = False
+        if verbose_1:
+            print('{} new frames to merge into the loaded state'.format(len(raw_path_list) - 1))
     
-    # Get the list of raw images in the burst path
-    raw_path_list = glob.glob(os.path.join(burst_path, '*.dng'))
-    assert len(raw_path_list) != 0, 'At least one raw .dng file must be present in the burst folder.'
 	# Read the raw bayer data from the DNG files
-    for index, raw_path in enumerate(raw_path_list):
-        with rawpy.imread(raw_path) as rawObject:
-            if index != ref_id :
-                
-                raw_comp.append(rawObject.raw_image.copy())  # copy otherwise image data is lost when the rawpy object is closed
-    raw_comp = np.array(raw_comp)
-    
-    # Reference image selection and metadata     
+    raws, sharpness_scores = read_burst(raw_path_list, ref_selection_params)
+    
+    # Reference image selection : the sharpest of the first candidates
+    if ref_selection_params['on']:
+        ref_id = int(np.argmax(sharpness_scores))
+    else:
+        ref_id = 0
+    
+    if verbose_2:
+        currentTime = getTime(currentTime, ' -- Read raw files')
+    if verbose_1:
+        print('Reference frame : {}'.format(os.path.basename(raw_path_list[ref_id])))
+    
+    # The burst is reordered so that the reference comes first
+    raw_comp = np.array([raw_img for index, raw_img in enumerate(raws) if index != ref_id])
+    
+    # Reference image metadata
     raw = rawpy.imread(raw_path_list[ref_id])
-    ref_raw = raw.raw_image.copy()
+    ref_raw = raws[ref_id]
+    del raws
     xyz2cam = raw2rgb.get_xyz2cam_from_exif(raw_path_list[ref_id])
     
     
@@ -370,10 +1017,6 @@ def process(burst_path, options=None, custom_params=None):
     std_curve = np.load(std_noise_model_path)
     diff_curve = np.load(diff_noise_model_path)
     
-    
-    if verbose_2:
-        currentTime = getTime(currentTime, ' -- Read raw files')
-
 
     
     if np.issubdtype(type(ref_raw[0,0]), np.integer):
@@ -393,7 +1036,7 @@ def process(burst_path, options=None, custom_params=None):
         ref_raw = np.clip(ref_raw, 0.0, 1.0)
         # ## The division by the green WB value is important because WB may come with integer coefficients instead
         
-    if np.issubdtype(type(raw_comp[0,0,0]), np.integer):
+    if np.issubdtype(raw_comp.dtype, np.integer):
         raw_comp = raw_comp.astype(DEFAULT_NUMPY_FLOAT_TYPE)
         ## raw_comp is a (N, H,W) array
         for i in range(2):
@@ -427,6 +1070,9 @@ def process(burst_path, options=None, custom_params=None):
     if custom_params is not None :
         params = merge_params(dominant=custom_params, recessive=SNR_params)
         check_params_validity(params, ref_raw.shape)
+    else:
+        params = SNR_params
+    params['reference selection'] = ref_selection_params
         
     #__ adding metadatas to dict 
     if not 'noise' in params['merging'].keys(): 
@@ -471,6 +1117,8 @@ def process(burst_path, options=None, custom_params=None):
         params["robustness"]["tuning"]['tileSize'] = params['kanade']['tuning']['tileSize']
     if 'tileSize' not in params["merging"]["tuning"].keys():
         params["merging"]["tuning"]['tileSize'] = params['kanade']['tuning']['tileSize']
+    if 'tileSize' not in params["frame rejection"]["tuning"].keys():
+        params["frame rejection"]["tuning"]['tileSize'] = params['kanade']['tuning']['tileSize']
 
 
     if 'mode' not in params["kanade"].keys():
@@ -503,12 +1151,58 @@ def process(burst_path, options=None, custom_params=None):
         
     
     
-    #___ Running the handheld pipeline
-    handheld_output, debug_dict = main(ref_raw.astype(DEFAULT_NUMPY_FLOAT_TYPE), raw_comp.astype(DEFAULT_NUMPY_FLOAT_TYPE), options, params)
-    
-    
+    ref_img = ref_raw.astype(DEFAULT_NUMPY_FLOAT_TYPE)
+    comp_imgs = raw_comp.astype(DEFAULT_NUMPY_FLOAT_TYPE)
+    
+    comp_paths = [path for index, path in enumerate(raw_path_list) if index != ref_id]
+    
+    #___ Cropping the frames around the region of interest
+    if params['roi']['on']:
+        input_crop, output_crop = get_roi_crop(ref_img.shape, params)
+        ref_img = np.ascontiguousarray(ref_img[input_crop])
+        comp_imgs = np.ascontiguousarray(comp_imgs[(slice(None),) + input_crop])
+        check_params_validity(params, ref_img.shape, check_roi=False)
+        if verbose_1:
+            print('Processing a crop of shape {} for the region of interest'.format(ref_img.shape))
+    
+    #___ Initialising the state when it has to be saved
+    # The accumulators and the reference-side results depend on these
+    # parameters : frames merged with other ones would be inconsistent.
+    params_key = make_key(select_params(params, STATE_PARAMS))
+    if state is None and 'save state' in options.keys():
+        state = init_accumulator(ref_img, options, params)
+        state.reference_path = raw_path_list[ref_id]
+        state.params_key = params_key
+    if state is not None:
+        assert state.ref_img.shape == ref_img.shape, 'The loaded state does not match the size of the burst.'
+        if state.params_key is None:
+            # state saved before the parameters were recorded
+            warnings.warn("Warning.... The parameters of the loaded state are unknown, "
+                          "they cannot be checked against the current ones.")
+            state.params_key = params_key
+        assert state.params_key == params_key, \
+            'The loaded state was computed with other parameters, the burst must be extended with the same ones.'
+    
+    #___ Running the fast preview if enabled
+    coarse_alignments = None
+    if params['preview']['on']:
+        assert 'load state' not in options.keys(), 'The preview cannot be computed when extending a burst.'
+        preview_output, coarse_alignments = preview(ref_img, comp_imgs, options, params)
+        preview_image = apply_post_processing(preview_output, raw, xyz2cam, params['post processing'], verbose_2)
+        
+        if not params['preview']['continue']:
+            if params['debug']:
+                return preview_image, {'coarse alignments' : coarse_alignments}
+            else:
+                return preview_image
+        
+        # The preview is handed over while the full result is computed
+        if 'preview callback' in options.keys():
+            options['preview callback'](preview_image)
     
-    #___ Performing frame count aware denoising if enabled
+    #___ Running the handheld pipeline
+    # The frame count aware denoising works on the normalized output,
+    # otherwise the normalization is fused with the finishing
     median_params = params['accumulated robustness denoiser']['median']
     gauss_params = params['accumulated robustness denoiser']['gauss']
     
@@ -516,6 +1210,27 @@ def process(burst_path, options=None, custom_params=None):
     gauss = gauss_params['on']
     post_frame_count_denoise = (median or gauss)
     
+    fused_normalization = (params['post processing']['on'] and
+                           params['post processing']['fused'] and
+                           not post_frame_count_denoise)
+    
+    handheld_output, debug_dict = main(ref_img, comp_imgs, options, params, coarse_alignments, state,
+                                       normalize=not fused_normalization)
+    handheld_den = debug_dict.pop('den', None)
+    
+    #___ Saving the state, so that the burst can be extended later
+    if 'save state' in options.keys():
+        # Rejected frames are not merged again either
+        processed_ids = debug_dict['merged frames'] + [rejection['frame'] - 1 for rejection in debug_dict['rejected frames']]
+        state.merged_paths += [comp_paths[im_id] for im_id in sorted(processed_ids)]
+        state.save(options['save state'])
+        if verbose_1:
+            print('State saved : {} frames merged'.format(state.n_merged))
+    
+    if params['preview']['on']:
+        debug_dict['preview'] = preview_image
+    
+    #___ Performing frame count aware denoising if enabled
     if post_frame_count_denoise : 
         if verbose_2:
             print('-- Robustness aware bluring')
@@ -528,25 +1243,18 @@ def process(burst_path, options=None, custom_params=None):
                                                           gauss_params)
 
 
-    #___ post processing
-    params_pp = params['post processing']
-    post_processing_enabled = params_pp['on']
+    #___ Keeping the region of interest only
+    if params['roi']['on']:
+        # a contiguous copy is required to move the crop to the host
+        th_output = th.as_tensor(handheld_output, device="cuda")
+        handheld_output = cuda.as_cuda_array(th_output[output_crop].contiguous())
+        if handheld_den is not None:
+            th_den = th.as_tensor(handheld_den, device="cuda")
+            handheld_den = cuda.as_cuda_array(th_den[output_crop].contiguous())
     
-    if post_processing_enabled:
-        if verbose_2:
-            print('-- Post processing image')
-            
-        output_image = raw2rgb.postprocess(raw, handheld_output.copy_to_host(),
-                                           params_pp['do color correction'],
-                                           params_pp['do tonemapping'],
-                                           params_pp['do gamma'],
-                                           params_pp['do sharpening'],
-                                           params_pp['do devignette'],
-                                           xyz2cam,
-                                           params_pp['sharpening']
-                                           ) 
-    else:
-        output_image = handheld_output.copy_to_host()
+    #___ post processing
+    output_image = apply_post_processing(handheld_output, raw, xyz2cam, params['post processing'], verbose_2,
+                                         den=handheld_den)
         
     #__ return
     
@@ -18,6 +18,7 @@ DEFAULT_NUMPY_FLOAT_TYPE = np.float32
 
 DEFAULT_TORCH_FLOAT_TYPE = th.float32
 DEFAULT_TORCH_COMPLEX_TYPE = th.complex64
+
 EPSILON_DIV = 1e-10
 
 DEFAULT_THREADS = 16
@@ -29,6 +30,11 @@ def getTime(currentTime, labelName, printTime=True, spaceSize=50):
 		print(labelName, ' ' * (spaceSize - len(labelName)), ': ', round((time.perf_counter() - currentTime) * 1000, 2), 'milliseconds')
 	return time.perf_counter()
 
+def to_host(cuda_array):
+	'''Copy a device array to the host. Some arrays (such as the gradients) are strided views
+	of torch tensors, that numba cannot copy to the host directly.'''
+	return th.as_tensor(cuda_array, device="cuda").cpu().numpy()
+
 def isTypeInt(array):
 	'''Check if the type of a numpy array is an int type.'''
 	return array.dtype in [np.uint8, np.uint16, np.uint32, np.uint64, np.int8, np.int16, np.int32, np.int64, np.uint, np.int]
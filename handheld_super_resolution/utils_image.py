@@ -1,6 +1,11 @@
+import os
 import math
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import scipy.fft
+import scipy.ndimage
 from scipy.ndimage._filters import _gaussian_kernel1d
 from numba import cuda
 import torch as th
@@ -9,6 +14,90 @@ import torch.nn.functional as F
 
 from .utils import getSigned, DEFAULT_NUMPY_FLOAT_TYPE, DEFAULT_CUDA_FLOAT_TYPE, DEFAULT_TORCH_FLOAT_TYPE, DEFAULT_THREADS
 
+# Radius of the FIR filter of the separable grey method
+GREY_FIR_RADIUS = 8
+
+def map_row_bands(function, n_rows, n_bands=None):
+    """
+    Calls function(start, stop) on contiguous bands of rows covering
+    [0, n_rows), in a pool of threads. numpy and scipy release the GIL
+    while they filter, so the bands are processed in parallel.
+
+    Parameters
+    ----------
+    function : callable
+        Processes the rows start to stop (excluded)
+    n_rows : int
+        Number of rows
+    n_bands : int, optional
+        Number of bands. The default is the number of CPUs.
+
+    """
+    if n_bands is None:
+        n_bands = os.cpu_count() or 1
+    n_bands = max(1, min(n_bands, n_rows))
+    bounds = np.linspace(0, n_rows, n_bands + 1).round().astype(int)
+    with ThreadPoolExecutor(n_bands) as executor:
+        # list() raises the exceptions of the threads
+        list(executor.map(function, bounds[:-1], bounds[1:]))
+
+@lru_cache(maxsize=4)
+def get_grey_fft_mask(imshape, on_gpu=True):
+    """
+    Returns the low-pass mask of the FFT grey image computation, in the
+    unshifted layout of the real-to-complex transform. The masks are cached
+    per shape, since all the frames of a burst share the same one.
+
+    The original mask (see Alg. 3) keeps the central half of the shifted
+    spectrum. It is symmetrized, which gives exactly the real part of
+    the complex filtering, even when the mask itself is not symmetric
+    (odd sizes).
+
+    Parameters
+    ----------
+    imshape : tuple(int, int)
+        Shape of the raw image
+    on_gpu : bool, optional
+        Whether the mask is returned as a GPU tensor or a numpy array.
+        The default is True.
+
+    Returns
+    -------
+    mask : Tensor or Array[imshape_y, imshape_x//2 + 1]
+
+    """
+    masks_1d = []
+    for size in imshape:
+        # kept positions of the shifted spectrum, brought back to the
+        # frequency indices : fftshift rolls the spectrum by size//2
+        kept = np.arange(size//4, size - (-(-size//4)))
+        mask_1d = np.zeros(size, DEFAULT_NUMPY_FLOAT_TYPE)
+        mask_1d[(kept - size//2) % size] = 1
+        masks_1d.append(mask_1d)
+
+    mask = np.outer(*masks_1d)
+    # M(-f) : frequency index f is mapped to (size - f) % size
+    flipped_mask = np.roll(mask[::-1, ::-1], 1, axis=(0, 1))
+    mask = (mask + flipped_mask)/2
+
+    mask = np.ascontiguousarray(mask[:, :imshape[1]//2 + 1])
+    if on_gpu:
+        return th.as_tensor(mask, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")
+    return mask
+
+@lru_cache(maxsize=None)
+def get_grey_fir_kernel(radius=GREY_FIR_RADIUS):
+    """
+    Returns the 1D FIR approximation of the low-pass filter of the FFT grey
+    image computation : the ideal filter keeps the frequencies below a quarter
+    of the sampling rate, and its impulse response (a sinc) is truncated with
+    a Lanczos window.
+
+    """
+    n = np.arange(-radius, radius + 1)
+    kernel = 0.5 * np.sinc(n/2) * np.sinc(n/(radius + 1))
+    return (kernel / kernel.sum()).astype(DEFAULT_NUMPY_FLOAT_TYPE)
+
 def compute_grey_images(img, method):
     """
     This function converts a raw image to a grey image, using the decimation or
@@ -16,10 +105,12 @@ def compute_grey_images(img, method):
 
     Parameters
     ----------
-    img : device Array[:, :]
-        Raw image J to convert to gray level.
+    img : device Array[:, :] or Array[:, :]
+        Raw image J to convert to gray level. The FFT and separable methods
+        also support numpy arrays, and are then computed on the CPU.
     method : str
-        FFT or decimatin.
+        FFT, separable or decimatin. The separable method approximates the
+        low-pass of the FFT method with a short separable FIR filter.
 
     Raises
     ------
@@ -28,30 +119,63 @@ def compute_grey_images(img, method):
 
     Returns
     -------
-    img_grey : device Array[:, :]
+    img_grey : device Array[:, :] or Array[:, :]
         Corresponding grey scale image G
 
     """
     imsize_y, imsize_x = img.shape
-    if method == "FFT":
+    if method == "FFT" and isinstance(img, np.ndarray):
+        # CPU path : pocketfft, multithreaded
+        spectrum = scipy.fft.rfft2(img.astype(DEFAULT_NUMPY_FLOAT_TYPE), workers=-1)
+        spectrum *= get_grey_fft_mask((imsize_y, imsize_x), on_gpu=False)
+        return scipy.fft.irfft2(spectrum, s=(imsize_y, imsize_x), workers=-1).astype(DEFAULT_NUMPY_FLOAT_TYPE)
+    
+    elif method == "FFT":
         torch_img_grey = th.as_tensor(img, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")
-        torch_img_grey = torch.fft.fft2(torch_img_grey) 
-        # th FFT induces copy on the fly : this is good because we dont want to 
-        # modify the raw image, it is needed in the future
-        # Note : the complex dtype of the fft2 is inherited from DEFAULT_TORCH_FLOAT_TYPE.
+        # Real-to-complex transform : only half of the spectrum is computed.
+        # The FFT plans are cached by torch, and are reused for all the
+        # frames of the burst.
+        # Note : the complex dtype of the rfft2 is inherited from DEFAULT_TORCH_FLOAT_TYPE.
         # Therefore, for DEFAULT_TORCH_FLOAT_TYPE = float32 we directly get complex64
-        torch_img_grey = torch.fft.fftshift(torch_img_grey)
+        spectrum = torch.fft.rfft2(torch_img_grey)
+        spectrum *= get_grey_fft_mask((imsize_y, imsize_x))
         
-        torch_img_grey[:imsize_y//4, :] = 0
-        torch_img_grey[:, :imsize_x//4] = 0
-        torch_img_grey[-imsize_y//4:, :] = 0
-        torch_img_grey[:, -imsize_x//4:] = 0
-        
-        torch_img_grey = torch.fft.ifftshift(torch_img_grey)
-        torch_img_grey = torch.fft.ifft2(torch_img_grey)
-        # Here, .real() type inherits once again from the complex type.
+        # irfft2 directly returns a real image, with the same type as the raw image.
         # numba type is read directly from the torch tensor, so everything goes fine.
-        return cuda.as_cuda_array(torch_img_grey.real)
+        return cuda.as_cuda_array(torch.fft.irfft2(spectrum, s=(imsize_y, imsize_x)))
+    elif method == "separable" and isinstance(img, np.ndarray):
+        # CPU path : both passes are computed by bands of rows, in a pool of
+        # threads. The wrap mode reproduces the periodic boundaries of the FFT
+        kernel = get_grey_fir_kernel()
+        radius = GREY_FIR_RADIUS
+        img = img.astype(DEFAULT_NUMPY_FLOAT_TYPE, copy=False)
+        temp = np.empty_like(img)
+        img_grey = np.empty_like(img)
+        
+        def convolve_y(start, stop):
+            # the band is extended by the radius, wrapping around the image
+            band = np.take(img, np.arange(start - radius, stop + radius) % imsize_y, axis=0)
+            temp[start:stop] = scipy.ndimage.correlate1d(band, kernel, axis=0)[radius:radius + stop - start]
+        
+        def convolve_x(start, stop):
+            img_grey[start:stop] = scipy.ndimage.correlate1d(temp[start:stop], kernel, axis=1, mode='wrap')
+        
+        map_row_bands(convolve_y, imsize_y)
+        map_row_bands(convolve_x, imsize_y)
+        return img_grey
+    
+    elif method == "separable":
+        th_kernel = th.as_tensor(get_grey_fir_kernel(), dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")
+        radius = GREY_FIR_RADIUS
+        
+        # The circular padding reproduces the periodic boundaries of the FFT
+        torch_img = th.as_tensor(img, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")[None, None]
+        temp = F.conv2d(F.pad(torch_img, (0, 0, radius, radius), 'circular'),
+                        th_kernel[None, None, :, None]) # convolve y
+        torch_img_grey = F.conv2d(F.pad(temp, (radius, radius, 0, 0), 'circular'),
+                                  th_kernel[None, None, None, :]) # convolve x
+        return cuda.as_cuda_array(torch_img_grey.squeeze())
+    
     elif method == "decimating":
         grey_imshape_y, grey_imshape_x = grey_imshape = imsize_y//2, imsize_x//2
         
@@ -68,6 +192,39 @@ def compute_grey_images(img, method):
     else:
         raise NotImplementedError('Computation of gray level on GPU is only supported for FFT')
 
+def compute_sharpness_score(raw_img, decimation):
+    """
+    Cheap sharpness score of a raw frame, computed on the host. The raw image
+    is decimated to a coarse grey image by averaging blocks of
+    2*decimation x 2*decimation pixels (each block containing complete bayer
+    quads), and the score is the mean energy of its finite differences.
+
+    Parameters
+    ----------
+    raw_img : Array[imshape_y, imshape_x]
+        Raw image J
+    decimation : int
+        Decimation factor applied on top of the bayer to grey decimation.
+
+    Returns
+    -------
+    score : float
+        Sharpness score. Only meaningful when compared to the scores of
+        the other frames of the same burst.
+
+    """
+    block = 2*decimation
+    imsize_y, imsize_x = raw_img.shape
+    coarse_imsize_y, coarse_imsize_x = imsize_y//block, imsize_x//block
+
+    coarse_img = raw_img[:coarse_imsize_y*block, :coarse_imsize_x*block].astype(DEFAULT_NUMPY_FLOAT_TYPE)
+    coarse_img = coarse_img.reshape(coarse_imsize_y, block, coarse_imsize_x, block).mean(axis=(1, 3))
+
+    gradx = np.diff(coarse_img, axis=1)
+    grady = np.diff(coarse_img, axis=0)
+
+    return float(np.mean(gradx*gradx) + np.mean(grady*grady))
+
 def GAT(image, alpha, iso, beta):
     """
     Generalized Ascombe Transform
@@ -308,41 +465,95 @@ def cuda_decimate_to_grey(img, grey_img):
         grey_img[y, x] = c/4
         
 
+@lru_cache(maxsize=None)
+def get_downsampling_kernel(factor, on_gpu=True):
+    """
+    Returns the 1D gaussian kernel applied before downsampling by factor.
+    It only depends on the factor, and is cached on the GPU, or as a numpy
+    array when on_gpu is False.
+
+    """
+    # This is the default kernel of scipy gaussian_filter1d
+    # Note that pytorch Convolve is actually a correlation, hence the ::-1 flip.
+    # copy to avoid negative stride
+    gaussian_kernel = _gaussian_kernel1d(sigma=factor * 0.5, order=0, radius=int(4*factor * 0.5 + 0.5))[::-1].copy()
+    if on_gpu:
+        return torch.as_tensor(gaussian_kernel, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")
+    return gaussian_kernel.astype(DEFAULT_NUMPY_FLOAT_TYPE)
+
+def strided_correlate1d(img, kernel, stride, n_out, axis):
+    """
+    Valid correlation of img by a 1D kernel along axis, only evaluated at
+    one sample over stride : output[i] = sum_k kernel[k] * img[stride*i + k].
+
+    """
+    output = None
+    for k, weight in enumerate(kernel):
+        index = [slice(None)] * img.ndim
+        index[axis] = slice(k, k + stride*(n_out - 1) + 1, stride)
+        if output is None:
+            output = weight * img[tuple(index)]
+        else:
+            output += weight * img[tuple(index)]
+    return output
+
 def cuda_downsample(th_img, kernel='gaussian', factor=2):
     '''Apply a convolution by a kernel if required, then downsample an image.
+    The filter is only evaluated at the retained samples (strided convolution).
+    numpy arrays are processed on the CPU, by bands of output rows in a pool
+    of threads, and give the same result.
     Args:
-     	image: Device Array the input image (WARNING: single channel only!)
+     	image: Device Array or numpy array the input image, whose last two
+     	    axes are the image (WARNING: single channel only!)
      	kernel: None / str ('gaussian' / 'bayer') / 2d numpy array
      	factor: downsampling factor
     '''
     # Special case
     if factor == 1:
-     	return th_img
+        return th_img
 
     # Filter the image before downsampling it
     if kernel is None:
-     	raise ValueError('use Kernel')
-    elif kernel == 'gaussian':
-     	# gaussian kernel std is proportional to downsampling factor
-    	 # filteredImage = gaussian_filter(image, sigma=factor * 0.5, order=0, output=None, mode='reflect')
-         
-          # This is the default kernel of scipy gaussian_filter1d
-          # Note that pytorch Convolve is actually a correlation, hence the ::-1 flip.
-          # copy to avoid negative stride
-    	 gaussian_kernel = _gaussian_kernel1d(sigma=factor * 0.5, order=0, radius=int(4*factor * 0.5 + 0.5))[::-1].copy()
-    	 th_gaussian_kernel = torch.as_tensor(gaussian_kernel, dtype=DEFAULT_TORCH_FLOAT_TYPE, device="cuda")
+        raise ValueError('use Kernel')
+    elif kernel == 'gaussian' and isinstance(th_img, np.ndarray):
+        gaussian_kernel = get_downsampling_kernel(factor, on_gpu=False)
+        kernel_size = gaussian_kernel.shape[0]
+        img = th_img.astype(DEFAULT_NUMPY_FLOAT_TYPE, copy=False)
+        
+        h2 = (img.shape[-2] - kernel_size + 1) // factor
+        w2 = (img.shape[-1] - kernel_size + 1) // factor
+        downsampled = np.empty(img.shape[:-2] + (h2, w2), DEFAULT_NUMPY_FLOAT_TYPE)
         
+        def downsample_band(start, stop):
+            # output rows start to stop only need the input rows from factor*start
+            temp = strided_correlate1d(img[..., factor*start:, :], gaussian_kernel,
+                                       factor, stop - start, axis=-2) # convolve y
+            downsampled[..., start:stop, :] = strided_correlate1d(temp, gaussian_kernel,
+                                                                  factor, w2, axis=-1) # convolve x
+        
+        map_row_bands(downsample_band, h2)
+        return downsampled
+    
+    elif kernel == 'gaussian':
+        # gaussian kernel std is proportional to downsampling factor
+        # filteredImage = gaussian_filter(image, sigma=factor * 0.5, order=0, output=None, mode='reflect')
+        th_gaussian_kernel = get_downsampling_kernel(factor)
+        kernel_size = th_gaussian_kernel.shape[0]
 
-        # 2 times gaussian 1d is faster than gaussian 2d
-    	 temp = F.conv2d(th_img, th_gaussian_kernel[None, None, :, None]) # convolve y
-    	 th_filteredImage = F.conv2d(temp, th_gaussian_kernel[None, None, None, :]) # convolve x
+        # 2 times gaussian 1d is faster than gaussian 2d. Each pass is strided
+        # along its own axis, so that the discarded rows and columns are
+        # never filtered.
+        temp = F.conv2d(th_img, th_gaussian_kernel[None, None, :, None], stride=(factor, 1)) # convolve y
+        th_filteredImage = F.conv2d(temp, th_gaussian_kernel[None, None, None, :], stride=(1, factor)) # convolve x
     else:
         raise ValueError("please use gaussian kernel")
 
-    # Shape of the downsampled image
-    h2, w2 = np.floor(np.array(th_filteredImage.shape[2:]) / float(factor)).astype(np.int)
+    # Shape of the downsampled image : same as filtering the whole image
+    # (valid convolution) then keeping one sample over factor
+    h2 = (th_img.shape[2] - kernel_size + 1) // factor
+    w2 = (th_img.shape[3] - kernel_size + 1) // factor
 
-    return th_filteredImage[:, :, :h2 * factor:factor, :w2 * factor:factor]
+    return th_filteredImage[:, :, :h2, :w2]
 
 def computeRMSE(image1, image2):
     '''computes the Root Mean Square Error between two images'''